@@ -0,0 +1,6 @@
+"""
+Benchmarks of the HTTP/2 server and of the websocket server, run over the loopback without any external service.
+
+`python -m benchmarks run h2|ws|all -o results.json` runs every combination of payload size and concurrency and saves
+the results, `python -m benchmarks compare baseline.json candidate.json` shows how they changed between two runs.
+"""
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import gevent
+
+from .compare import compare
+from .framing import framing_benchmark
+from .h2_load import create_files, h2_load, start_h2_server
+from .runner import PROJECT_DIR, get_free_port, run_scenario
+from .ws_load import start_ws_server, ws_load
+
+
+def int_list(value: str) -> List[int]:
+    try:
+        values = [int(item) for item in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a comma separated list of integers') from None
+    if any(item < 1 for item in values):
+        raise argparse.ArgumentTypeError('values must be strictly positive')
+    return values
+
+
+def get_metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'gevent': gevent.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'warmup': args.warmup,
+        'duration': args.duration,
+        'in_process': args.in_process,
+    }
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    server_cpu = result.get('server_cpu_percent')
+    server_rss = result.get('server_rss_mib')
+    print(
+        f"{result['target']:<3} size={result['size']:<8} concurrency={result['concurrency']:<5} "
+        f"{result['requests_per_second']:>10.1f} req/s {result['mib_per_second']:>9.2f} MiB/s "
+        f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms p99.9={result['p99.9_ms']:.2f}ms "
+        f"errors={result['errors']} "
+        f"server cpu={'?' if server_cpu is None else f'{server_cpu:.0f}%'} "
+        f"rss={'?' if server_rss is None else f'{server_rss:.1f}MiB'}",
+        flush=True
+    )
+
+
+def run_h2(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory(prefix='h2-bench-') as directory:
+        create_files(Path(directory), args.sizes)
+        port = get_free_port()
+        server = start_h2_server(Path(directory), port, args.in_process)
+        try:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    load = h2_load(port, f'/payload-{size}.bin', concurrency, args.streams_per_connection)
+                    result = {'target': 'h2', 'size': size, 'concurrency': concurrency,
+                              **run_scenario(load, server.pid, args.warmup, args.duration)}
+                    print_result(result)
+                    results.append(result)
+        finally:
+            server.stop()
+    return results
+
+
+def run_ws(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    port = get_free_port()
+    server = start_ws_server(port, args.in_process)
+    try:
+        for size in args.sizes:
+            for concurrency in args.concurrency:
+                load = ws_load(port, size, concurrency)
+                result = {'target': 'ws', 'size': size, 'concurrency': concurrency,
+                          **run_scenario(load, server.pid, args.warmup, args.duration)}
+                print_result(result)
+                results.append(result)
+    finally:
+        server.stop()
+    return results
+
+
+def run(args: argparse.Namespace) -> None:
+    results = []
+    if args.target in ('h2', 'all'):
+        results += run_h2(args)
+    if args.target in ('ws', 'all'):
+        results += run_ws(args)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': get_metadata(args), 'results': results}, f, indent=2)
+        print(f'results saved in {args.output}')
+
+
+def run_compare(args: argparse.Namespace) -> None:
+    lines, regressions = compare(Path(args.baseline), Path(args.candidate), args.threshold)
+    print('\n'.join(lines))
+    if regressions:
+        print(f'\n{len(regressions)} regression(s) above {args.threshold}%:')
+        print('\n'.join(regressions))
+        sys.exit(1)
+
+
+def run_framing(args: argparse.Namespace) -> None:
+    for result in framing_benchmark(args.sizes, args.count):
+        size = '' if result['size'] is None else f"size={result['size']}"
+        print(f"{result['operation']:<16} {size:<12} baseline {result['baseline_us']:>8.2f} us  "
+              f"fast {result['fast_us']:>8.2f} us  x{result['speedup']:.1f}")
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                 description='Benchmarks of the HTTP/2 and websocket servers over the loopback.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+run_parser = subparsers.add_parser('run', help='run benchmarks')
+run_parser.add_argument('target', choices=['h2', 'ws', 'all'])
+run_parser.add_argument('--sizes', type=int_list, default=[1024, 65536, 1048576],
+                        help='comma separated sizes of the files downloaded or of the messages echoed, in bytes')
+run_parser.add_argument('--concurrency', type=int_list, default=[1, 10, 100],
+                        help='comma separated numbers of requests in flight or of websocket clients')
+run_parser.add_argument('--streams-per-connection', type=int, default=100,
+                        help='maximum number of requests in flight on one HTTP/2 connection')
+run_parser.add_argument('--duration', type=float, default=5.0, help='number of seconds measured per scenario')
+run_parser.add_argument('--warmup', type=float, default=1.0,
+                        help='number of seconds of load before the measures of a scenario start')
+run_parser.add_argument('--in-process', action='store_true',
+                        help='run the server in the benchmark process instead of a subprocess')
+run_parser.add_argument('--output', '-o', help='JSON file where the results are saved')
+run_parser.set_defaults(handler=run)
+
+compare_parser = subparsers.add_parser('compare', help='compare two result files')
+compare_parser.add_argument('baseline')
+compare_parser.add_argument('candidate')
+compare_parser.add_argument('--threshold', type=float, default=5.0,
+                            help='percentage from which a lower throughput or a higher p99 latency is a regression')
+compare_parser.set_defaults(handler=run_compare)
+
+framing_parser = subparsers.add_parser(
+    'framing', help='compare the encoding of websocket frames by wsproto and by websockets.framing'
+)
+framing_parser.add_argument('--sizes', type=int_list, default=[100, 1024, 65536], help='comma separated message sizes')
+framing_parser.add_argument('--count', type=int, default=20000, help='number of messages encoded per measure')
+framing_parser.set_defaults(handler=run_framing)
+
+arguments = parser.parse_args()
+arguments.handler(arguments)
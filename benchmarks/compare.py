@@ -0,0 +1,56 @@
+"""
+Comparison of two result files, to spot the regressions brought by a change.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+# metrics compared, with True when a higher value is better
+COMPARED_METRICS = {
+    'requests_per_second': True,
+    'mib_per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'p99.9_ms': False,
+    'server_cpu_seconds': False,
+    'server_peak_rss_mib': False,
+}
+
+ScenarioKey = Tuple[str, int, int]
+
+
+def load_results(path: Path) -> Dict[ScenarioKey, Dict[str, Any]]:
+    with path.open() as f:
+        data = json.load(f)
+    return {(result['target'], result['size'], result['concurrency']): result for result in data['results']}
+
+
+def compare(baseline_path: Path, candidate_path: Path, threshold: float) -> Tuple[List[str], List[str]]:
+    """
+    Returns the report lines of the comparison and the regressions: metrics worse by more than threshold percent in the
+    candidate results. Latencies and resources are noisy, so only the throughput and the p99 latency count as
+    regressions, the other metrics are reported for information.
+    """
+    baseline = load_results(baseline_path)
+    candidate = load_results(candidate_path)
+    lines = []
+    regressions = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        target, size, concurrency = key
+        lines.append(f'{target} size={size} concurrency={concurrency}')
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = baseline[key].get(metric), candidate[key].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold and metric in ('requests_per_second', 'mib_per_second', 'p99_ms'):
+                flag = '  <-- regression'
+                regressions.append(f'{target} size={size} concurrency={concurrency} {metric} {change:+.1f}%')
+            lines.append(f'    {metric:<22} {before:>12.2f} -> {after:>12.2f}  {change:+7.1f}%{flag}')
+
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        where = 'baseline' if key in baseline else 'candidate'
+        lines.append(f'{key[0]} size={key[1]} concurrency={key[2]} only in the {where} results')
+    return lines, regressions
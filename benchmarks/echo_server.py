@@ -0,0 +1,38 @@
+"""
+Websocket server echoing every message, the target of the websocket benchmarks.
+
+Run it alone with `python -m benchmarks.echo_server [port] [workers]`.
+"""
+import sys
+from typing import Any
+
+from wsproto.events import Request
+
+from websockets.server import BaseServer
+
+
+class EchoServer(BaseServer):
+    def handle_request(self, request: Request) -> None:
+        self.accept_request()
+
+    def handle_pong(self, data: bytes) -> None:
+        pass
+
+    def receive_bytes(self, data: bytes) -> None:
+        self.send(data)
+
+    def receive_text(self, data: str) -> None:
+        self.send(data)
+
+    def receive_json(self, data: Any) -> None:
+        self.send_json(data)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    server = EchoServer('127.0.0.1', port)
+    try:
+        server.run(workers=workers or None)
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,83 @@
+"""
+Micro benchmark of the encoding of websocket frames: wsproto against websockets.framing, for clients (masked frames)
+and servers, and of the dispatch of the received events: isinstance chain against a dict keyed by type.
+"""
+import os
+import time
+from typing import Any, Callable, Dict, List
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection, BytesMessage, CloseConnection, Message, Ping, Pong, Request, TextMessage
+)
+
+from websockets.framing import encode_frame
+
+
+def _open_connections() -> Dict[str, WSConnection]:
+    client, server = WSConnection(ConnectionType.CLIENT), WSConnection(ConnectionType.SERVER)
+    server.receive_data(client.send(Request(host='localhost', target='/bench')))
+    next(server.events())
+    client.receive_data(server.send(AcceptConnection()))
+    next(client.events())
+    return {'client': client, 'server': server}
+
+
+def _time_per_call(func: Callable[[], Any], count: int) -> float:
+    """Returns the average duration of a call of func, in microseconds."""
+    started_at = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - started_at) / count * 1e6
+
+
+def framing_benchmark(sizes: List[int], count: int) -> List[Dict[str, Any]]:
+    results = []
+    connections = _open_connections()
+    for size in sizes:
+        message = os.urandom(size)
+        for role, ws in connections.items():
+            mask = role == 'client'
+            wsproto_time = _time_per_call(lambda: ws.send(Message(message)), count)
+            fast_time = _time_per_call(lambda: encode_frame(message, mask), count)
+            results.append({
+                'operation': f'{role} encoding', 'size': size, 'baseline_us': wsproto_time, 'fast_us': fast_time,
+                'speedup': wsproto_time / fast_time,
+            })
+
+    events = [TextMessage('a'), BytesMessage(b'a'), Ping(b''), Pong(b''), CloseConnection(1000)]
+
+    def handle(_) -> None:
+        pass
+
+    handlers = {type(event): handle for event in events}
+
+    def isinstance_chain() -> None:
+        for event in events:
+            # the order of the former read loops
+            if isinstance(event, Request):
+                handle(event)
+            elif isinstance(event, CloseConnection):
+                handle(event)
+            elif isinstance(event, Ping):
+                handle(event)
+            elif isinstance(event, Pong):
+                handle(event)
+            elif isinstance(event, TextMessage):
+                handle(event)
+            elif isinstance(event, BytesMessage):
+                handle(event)
+
+    def dict_dispatch() -> None:
+        for event in events:
+            handler = handlers.get(type(event))
+            if handler is not None:
+                handler(event)
+
+    chain_time = _time_per_call(isinstance_chain, count) / len(events)
+    dict_time = _time_per_call(dict_dispatch, count) / len(events)
+    results.append({
+        'operation': 'event dispatch', 'size': None, 'baseline_us': chain_time, 'fast_us': dict_time,
+        'speedup': chain_time / dict_time,
+    })
+    return results
@@ -0,0 +1,132 @@
+"""
+Load of the HTTP/2 server: connections keeping a number of GET requests in flight, each request being sent again as
+soon as its response is complete. The server is used in cleartext mode (prior knowledge), so the numbers measure the
+HTTP/2 work, not TLS.
+"""
+import os
+import time
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Union
+
+import gevent
+from gevent import socket
+from gevent.event import Event
+from gevent.server import StreamServer
+from h2 import events
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.settings import SettingCodes
+
+from h2_server import H2Worker
+from h2_server.cache import FileCache
+from .runner import InProcessServer, LoadFactory, ServerProcess
+from .stats import Recorder
+
+# the client windows are opened wide, the benchmark measures the server, not flow control
+CLIENT_WINDOW_SIZE = 2 ** 31 - 1
+
+
+def create_files(directory: Path, sizes: List[int]) -> None:
+    """Creates the files downloaded by the benchmarks, one per size, filled with random bytes."""
+    for size in sizes:
+        path = directory / f'payload-{size}.bin'
+        if not path.exists() or path.stat().st_size != size:
+            path.write_bytes(os.urandom(size))
+
+
+class H2LoadConnection:
+    """
+    Connection keeping a number of requests for the same path in flight until stop is set.
+    """
+
+    def __init__(self, port: int, path: str, streams: int, recorder: Recorder, stop: Event):
+        self._port = port
+        self._path = path
+        self._streams = streams
+        self._recorder = recorder
+        self._stop = stop
+        self._sock: socket.socket = None
+        self._connection = H2Connection(H2Configuration(client_side=True, header_encoding='utf-8'))
+        self._started_at: Dict[int, float] = {}
+        self._received: Dict[int, int] = {}
+
+    def _send_request(self) -> None:
+        stream_id = self._connection.get_next_available_stream_id()
+        self._connection.send_headers(stream_id, [
+            (':method', 'GET'), (':path', self._path), (':scheme', 'http'), (':authority', f'127.0.0.1:{self._port}')
+        ], end_stream=True)
+        self._started_at[stream_id] = time.perf_counter()
+        self._received[stream_id] = 0
+
+    def _end_stream(self, stream_id: int, failed: bool) -> None:
+        started_at = self._started_at.pop(stream_id, None)
+        size = self._received.pop(stream_id, 0)
+        if started_at is None:
+            return
+        if failed:
+            self._recorder.error()
+        else:
+            self._recorder.record(time.perf_counter() - started_at, size)
+        if not self._stop.is_set():
+            self._send_request()
+
+    def run(self) -> None:
+        self._sock = socket.create_connection(('127.0.0.1', self._port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._connection.initiate_connection()
+            self._connection.update_settings({SettingCodes.INITIAL_WINDOW_SIZE: CLIENT_WINDOW_SIZE})
+            self._connection.increment_flow_control_window(CLIENT_WINDOW_SIZE - 65535)
+            for _ in range(self._streams):
+                self._send_request()
+            self._sock.sendall(self._connection.data_to_send())
+
+            while self._started_at:
+                data = self._sock.recv(65535)
+                if not data:
+                    break
+                for event in self._connection.receive_data(data):
+                    if isinstance(event, events.DataReceived):
+                        self._received[event.stream_id] = self._received.get(event.stream_id, 0) + len(event.data)
+                        # the window is huge but not infinite
+                        self._connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, events.StreamEnded):
+                        self._end_stream(event.stream_id, failed=False)
+                    elif isinstance(event, events.StreamReset):
+                        self._end_stream(event.stream_id, failed=True)
+                    elif isinstance(event, events.ConnectionTerminated):
+                        return
+                data = self._connection.data_to_send()
+                if data:
+                    self._sock.sendall(data)
+        finally:
+            self._sock.close()
+
+
+def h2_load(port: int, path: str, concurrency: int, streams_per_connection: int) -> LoadFactory:
+    """Returns the load of concurrency requests in flight, spread over connections of streams_per_connection."""
+
+    def start(recorder: Recorder, stop: Event) -> List[gevent.Greenlet]:
+        greenlets = []
+        remaining = concurrency
+        while remaining > 0:
+            streams = min(remaining, streams_per_connection)
+            remaining -= streams
+            connection = H2LoadConnection(port, path, streams, recorder, stop)
+            greenlets.append(gevent.spawn(connection.run))
+        return greenlets
+
+    return start
+
+
+def start_h2_server(directory: Path, port: int, in_process: bool) -> Union[ServerProcess, InProcessServer]:
+    """Starts the HTTP/2 server on the given directory, in this process or in a subprocess."""
+    if not in_process:
+        server = ServerProcess('h2_server', [str(directory), '--cleartext', '--port', str(port)], port)
+        server.start()
+        return server
+
+    server = StreamServer(('127.0.0.1', port), partial(H2Worker, source_dir=str(directory), file_cache=FileCache()))
+    server.start()
+    return InProcessServer(server.stop)
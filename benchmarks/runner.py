@@ -0,0 +1,123 @@
+"""
+Servers under test and the loop running a load scenario against them.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import gevent
+from gevent import socket, subprocess
+from gevent.event import Event
+
+from .stats import ProcessUsage, Recorder
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+# starts the load of a scenario: called with the recorder and an event set when the load must stop, it returns the
+# greenlets generating the load
+LoadFactory = Callable[[Recorder, Event], List[gevent.Greenlet]]
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'nothing listens on port {port} after {timeout} seconds') from None
+            gevent.sleep(0.05)
+
+
+class ServerProcess:
+    """
+    A server run with `python -m <module> <args>` from the project directory.
+    """
+
+    def __init__(self, module: str, args: List[str], port: int):
+        self.port = port
+        self._command = [sys.executable, '-m', module, *args]
+        self._process: Optional[subprocess.Popen] = None
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    def start(self) -> None:
+        self._process = subprocess.Popen(self._command, cwd=PROJECT_DIR, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(self.port)
+        except TimeoutError:
+            self.stop()
+            raise
+
+    def stop(self) -> None:
+        if self._process is None:
+            return
+        self._process.terminate()
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class InProcessServer:
+    """A server run by greenlets of this process, its usage includes the one of the client."""
+
+    def __init__(self, stop: Callable[[], None]):
+        self.pid = os.getpid()
+        self._stop = stop
+
+    def stop(self) -> None:
+        self._stop()
+
+
+def run_scenario(load_factory: LoadFactory, server_pid: int, warmup: float, duration: float) -> Dict[str, float]:
+    """
+    Runs a load during warmup seconds without measuring it, then during duration seconds while measuring it. Returns
+    the throughput and latencies, and the resources used by the server and the client.
+    """
+    recorder = Recorder()
+    stop = Event()
+    greenlets = load_factory(recorder, stop)
+    client_usage = ProcessUsage()
+    server_usage = ProcessUsage(server_pid)
+    try:
+        gevent.sleep(warmup)
+        recorder.recording = True
+        client_usage.start()
+        server_usage.start()
+        started_at = time.perf_counter()
+        gevent.sleep(duration)
+        recorder.recording = False
+        elapsed = time.perf_counter() - started_at
+        server = server_usage.stop()
+        client = client_usage.stop()
+    finally:
+        stop.set()
+        gevent.joinall(greenlets, timeout=10)
+        gevent.killall(greenlets)
+
+    result = recorder.summary(elapsed)
+    result.update({f'server_{name}': value for name, value in server.items()})
+    if server_pid != client_usage.pid:  # in-process servers share the usage of the client
+        result.update({f'client_{name}': value for name, value in client.items()})
+    return result
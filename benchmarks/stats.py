@@ -0,0 +1,113 @@
+"""
+Measures of a benchmark run: latency percentiles, throughput and resources used by the processes involved.
+"""
+import math
+import os
+import resource
+import time
+from typing import Dict, List, Optional
+
+PERCENTILES = (50, 99, 99.9)
+
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+
+def percentile(sorted_values: List[float], rank: float) -> float:
+    """Nearest-rank percentile of values sorted in ascending order."""
+    if not sorted_values:
+        return 0.0
+    index = max(math.ceil(rank / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class ProcessUsage:
+    """
+    CPU time and memory of a process. Other processes are read from /proc, so their usage is only known on Linux.
+
+    :param pid: the process to watch, the current one by default.
+    """
+
+    def __init__(self, pid: int = None):
+        self.pid = os.getpid() if pid is None else pid
+        self._started_at = 0.0
+        self._start_cpu: Optional[float] = None
+
+    def cpu_time(self) -> Optional[float]:
+        """User and system CPU seconds used by the process so far."""
+        if self.pid == os.getpid():
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                # the command name may contain spaces, the fields we want come after its closing parenthesis
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def memory(self) -> Dict[str, Optional[float]]:
+        """Current and peak resident memory of the process, in MiB."""
+        values = {'rss_mib': None, 'peak_rss_mib': None}
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    name, _, value = line.partition(':')
+                    if name == 'VmRSS':
+                        values['rss_mib'] = int(value.split()[0]) / 1024
+                    elif name == 'VmHWM':
+                        values['peak_rss_mib'] = int(value.split()[0]) / 1024
+        except OSError:
+            if self.pid == os.getpid():  # ru_maxrss is in KiB on Linux, bytes on macOS, close enough for a fallback
+                values['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return values
+
+    def start(self) -> None:
+        self._started_at = time.perf_counter()
+        self._start_cpu = self.cpu_time()
+
+    def stop(self) -> Dict[str, Optional[float]]:
+        """Returns the CPU used since start, in seconds and in percent of one core, and the memory of the process."""
+        elapsed = time.perf_counter() - self._started_at
+        cpu = self.cpu_time()
+        cpu_seconds = None if cpu is None or self._start_cpu is None else cpu - self._start_cpu
+        return {
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': None if cpu_seconds is None or not elapsed else cpu_seconds / elapsed * 100,
+            **self.memory(),
+        }
+
+
+class Recorder:
+    """Latencies and bytes transferred during a run."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.bytes = 0
+        self.errors = 0
+        self.recording = False  # nothing is recorded during the warmup
+
+    def record(self, latency: float, size: int) -> None:
+        if self.recording:
+            self.latencies.append(latency)
+            self.bytes += size
+
+    def error(self) -> None:
+        if self.recording:
+            self.errors += 1
+
+    def summary(self, duration: float) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        result = {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'duration': duration,
+            'requests_per_second': len(latencies) / duration if duration else 0.0,
+            'mib_per_second': self.bytes / 1024 / 1024 / duration if duration else 0.0,
+        }
+        for rank in PERCENTILES:
+            result[f'p{rank:g}_ms'] = percentile(latencies, rank) * 1000
+        result['max_ms'] = latencies[-1] * 1000 if latencies else 0.0
+        return result
@@ -0,0 +1,63 @@
+"""
+Load of the websocket server: clients sending a binary message and waiting for its echo before sending the next one.
+"""
+import os
+import time
+from typing import List, Union
+
+import gevent
+from gevent.event import AsyncResult, Event
+
+from websockets.client import Client
+from .echo_server import EchoServer
+from .runner import InProcessServer, LoadFactory, ServerProcess, wait_for_port
+from .stats import Recorder
+
+# number of seconds after which a message without echo counts as an error
+ECHO_TIMEOUT = 10.0
+
+
+class EchoClient(Client):
+    """Client whose callbacks are set per instance by the benchmark, not shared with the other Client classes."""
+
+
+def _run_client(port: int, message: bytes, recorder: Recorder, stop: Event) -> None:
+    client = EchoClient(f'ws://localhost:{port}/bench')  # the client does not parse ip addresses
+    waiter = AsyncResult()
+    client.on_binary_message(lambda _, payload: waiter.set(len(payload)))
+    try:
+        while not stop.is_set():
+            waiter = AsyncResult()
+            started_at = time.perf_counter()
+            client.send(message)
+            try:
+                size = waiter.get(timeout=ECHO_TIMEOUT)
+            except gevent.Timeout:
+                recorder.error()
+                continue
+            recorder.record(time.perf_counter() - started_at, size)
+    finally:
+        client.close()
+
+
+def ws_load(port: int, size: int, concurrency: int) -> LoadFactory:
+    """Returns the load of concurrency clients echoing messages of the given size."""
+    message = os.urandom(size)
+
+    def start(recorder: Recorder, stop: Event) -> List[gevent.Greenlet]:
+        return [gevent.spawn(_run_client, port, message, recorder, stop) for _ in range(concurrency)]
+
+    return start
+
+
+def start_ws_server(port: int, in_process: bool) -> Union[ServerProcess, InProcessServer]:
+    """Starts the echo server, in this process or in a subprocess."""
+    if not in_process:
+        server = ServerProcess('benchmarks.echo_server', [str(port)], port)
+        server.start()
+        return server
+
+    server = EchoServer('127.0.0.1', port)
+    gevent.spawn(server.run)
+    wait_for_port(port)
+    return InProcessServer(server.close)
@@ -0,0 +1,3 @@
+"""
+Helpers shared by the HTTP/2 server and the websocket client and server.
+"""
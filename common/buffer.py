@@ -0,0 +1,167 @@
+"""
+Output buffer coalescing the writes made on a socket.
+"""
+import os
+import ssl
+from collections import deque
+from typing import Deque, List, Optional, Union
+
+from gevent import socket, spawn, ssl as gevent_ssl
+from gevent.event import Event
+
+from .metrics import Counter
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16  # the minimum value POSIX allows
+# number of seconds close waits for the remaining data to be sent, a peer not reading anymore must not block it forever
+CLOSE_TIMEOUT = 10.0
+
+
+class OutputBuffer:
+    """
+    Per-connection output buffer. Data written to it is sent by a dedicated writer greenlet, so everything written
+    during a loop iteration goes out in one sendall call, or one sendmsg scatter-gather call for plain sockets.
+
+    :param sock: the socket to write to.
+    :param high_watermark: once this amount of bytes is waiting to be sent, drain blocks...
+    :param low_watermark: ...until the amount of bytes waiting goes down to this value.
+    :param sent_bytes: counter incremented with the bytes sent on the socket.
+    """
+
+    def __init__(self, sock: socket, high_watermark: int = 64 * 1024, low_watermark: int = 16 * 1024,
+                 sent_bytes: Counter = None):
+        if not isinstance(high_watermark, int) or high_watermark < 1:
+            raise ValueError('high_watermark must be a strictly positive integer')
+        if not isinstance(low_watermark, int) or not 0 <= low_watermark <= high_watermark:
+            raise ValueError('low_watermark must be a positive integer not greater than high_watermark')
+
+        self._sock = sock
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._sent_bytes = sent_bytes
+        self._vectored = not isinstance(sock, (ssl.SSLSocket, gevent_ssl.SSLSocket))
+        self._chunks: Deque[Buffer] = deque()
+        self._size = 0  # bytes written and not yet sent, including the ones being sent
+        self._data_written = Event()
+        self._writable = Event()
+        self._writable.set()
+        self._flushed = Event()
+        self._flushed.set()
+        self._closed = False
+        self._error: Optional[OSError] = None
+        self._writer = spawn(self._write_loop)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def write(self, data: Buffer) -> None:
+        """
+        Queues data to be sent. It never blocks, call drain to wait for the buffer to go below the low watermark.
+        """
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ConnectionError('the output buffer is closed')
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        self._flushed.clear()
+        self._data_written.set()
+        if self._size >= self._high_watermark:
+            self._writable.clear()
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Blocks while the buffer is above its high watermark. Returns False if the timeout expired before.
+        """
+        result = self._writable.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return result
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Blocks until all the data written so far is sent. Returns False if the timeout expired before.
+        """
+        result = self._flushed.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return result
+
+    def close(self, timeout: Optional[float] = CLOSE_TIMEOUT) -> bool:
+        """
+        Sends the remaining data and stops the writer greenlet. The socket itself is not closed. Returns False if the
+        data could not be sent within the timeout, the writer is then killed and the data discarded.
+        """
+        if self._closed:
+            return self._error is None
+        self._closed = True
+        self._data_written.set()
+        self._writer.join(timeout)
+        if not self._writer.dead:
+            self._writer.kill()
+            self._error = ConnectionError('the output buffer was closed before its data could be sent')
+            self._chunks.clear()
+            self._size = 0
+            self._writable.set()
+            self._flushed.set()
+            return False
+        return self._error is None
+
+    def _send(self, chunks: List[Buffer]) -> None:
+        if not self._vectored:
+            self._sock.sendall(chunks[0] if len(chunks) == 1 else b''.join(chunks))
+            return
+
+        while chunks:
+            sent = self._sock.sendmsg(chunks[:IOV_MAX])
+            index = 0
+            while index < len(chunks) and sent >= len(chunks[index]):
+                sent -= len(chunks[index])
+                index += 1
+            chunks = chunks[index:]
+            if sent:
+                chunks[0] = memoryview(chunks[0])[sent:]
+
+    def _write_loop(self) -> None:
+        while True:
+            if not self._chunks:
+                self._flushed.set()
+                # checked before waiting, a close coming with the last write only sets _data_written once
+                if self._closed:
+                    break
+                self._data_written.wait()
+                self._data_written.clear()
+                continue
+
+            chunks = list(self._chunks)
+            self._chunks.clear()
+            size = sum(len(chunk) for chunk in chunks)
+            try:
+                self._send(chunks)
+            except OSError as e:
+                self._error = e
+                self._closed = True
+                self._chunks.clear()
+                self._size = 0
+                # wake up everyone waiting on the buffer, they will get the error
+                self._writable.set()
+                self._flushed.set()
+                break
+
+            self._size -= size
+            if self._sent_bytes is not None:
+                self._sent_bytes.inc(size)
+            if self._size <= self._low_watermark:
+                self._writable.set()
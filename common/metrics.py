@@ -0,0 +1,207 @@
+"""
+Counters, gauges and histograms describing what the servers and clients do, exported in the Prometheus text format.
+
+Metrics are only updated from greenlets, which switch on I/O and never in the middle of an update, so plain integer and
+float operations need no lock. Each process has its own values: the workers of a pre-forked server each export theirs.
+
+The instrumented classes hold their metrics in an attribute which is None by default and only touch them behind an
+`if metrics is not None` check, so the instrumentation costs nothing when it is not enabled.
+"""
+import bisect
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+from gevent.pywsgi import WSGIServer
+
+# in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# in bytes, from 64 bytes to 16 MiB
+SIZE_BUCKETS = tuple(4 ** power for power in range(3, 13))
+
+# a sample is the name of a series, its labels already formatted and its value
+Sample = Tuple[str, str, float]
+
+
+class Metric(ABC):
+    type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    @abstractmethod
+    def samples(self) -> Iterator[Sample]:
+        """Yields the samples of the metric, at the time the metrics are collected."""
+        pass
+
+
+class Counter(Metric):
+    """Value which only goes up, like a number of bytes sent."""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, '', self.value
+
+
+class Gauge(Metric):
+    """
+    Value which goes up and down, like a number of open connections.
+
+    :param function: when given, the value is the one it returns at the time the metrics are collected.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] = None):
+        super().__init__(name, documentation)
+        self.value = 0
+        self._function = function
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, '', self.value if self._function is None else self._function()
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, like latencies or message sizes, counted in buckets of increasing upper bounds.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        if not buckets:
+            raise ValueError('buckets must not be empty')
+        self.buckets = tuple(sorted(buckets))
+        # the last count is for the values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # the bounds are inclusive, a value equal to a bound goes in its bucket
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> Iterator[Sample]:
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket', f'{{le="{format_value(bound)}"}}', cumulative
+        yield f'{self.name}_sum', '', self.sum
+        yield f'{self.name}_count', '', self.count
+
+
+class Registry:
+    """The metrics of a process, an exporter publishes all of them."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'a metric named {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def collect(self) -> Iterator[Metric]:
+        """Returns the metrics in the order they were registered, for exporters."""
+        return iter(list(self._metrics.values()))
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render_prometheus(registry: Registry) -> str:
+    """Returns the metrics of a registry in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry.collect():
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {format_value(value)}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class PrometheusExporter:
+    """
+    Serves the metrics of a registry on http://host:port/metrics. Other exporters only need Registry.collect.
+
+    :param port_range: number of consecutive ports tried from port until one is free, so that the workers of a
+    pre-forked server, which each have their own metrics, can all be scraped.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, registry: Registry, host: str = '127.0.0.1', port: int = 9100, port_range: int = 1):
+        if not isinstance(port_range, int) or port_range < 1:
+            raise ValueError('port_range must be a strictly positive integer')
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._port_range = port_range
+        self._server: Optional[WSGIServer] = None
+
+    @property
+    def port(self) -> Optional[int]:
+        """The port the metrics are served on once the exporter is started."""
+        return None if self._server is None else self._server.server_port
+
+    def _application(self, environ: dict, start_response: Callable) -> list:
+        if environ['PATH_INFO'] not in ('/', '/metrics'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+            return []
+        body = render_prometheus(self._registry).encode()
+        start_response('200 OK', [('Content-Type', self.content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def start(self) -> None:
+        """Starts serving the metrics in the background. Raises OSError if none of the ports is free."""
+        for port in range(self._port, self._port + self._port_range):
+            server = WSGIServer((self._host, port), self._application, log=None)
+            try:
+                server.start()
+            except OSError:
+                if port == self._port + self._port_range - 1:
+                    raise
+                continue
+            self._server = server
+            return
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
@@ -0,0 +1,144 @@
+"""
+Pre-fork mode running a gevent server in several worker processes.
+
+The supervisor process binds the listening socket and forks the workers, which inherit the socket and everything built
+before the fork (TLS context, handler, file cache...). Each worker then runs its own StreamServer on the shared socket,
+the kernel spreading the connections between them. With reuse_port, each worker binds its own socket with SO_REUSEPORT
+instead, which balances the connections more evenly on Linux.
+
+The supervisor restarts the workers which die and stops them all gracefully on SIGTERM or SIGINT.
+"""
+import os
+import signal
+import sys
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import gevent
+from gevent import socket
+from gevent.os import fork_gevent
+from gevent.server import StreamServer
+
+ServerFactory = Callable[[socket.socket], StreamServer]
+
+# a worker dying sooner than this number of seconds after its start is restarted after a delay, to avoid fork loops
+MIN_WORKER_UPTIME = 1.0
+
+
+def describe_exit_status(status: int) -> str:
+    """Describes a status returned by os.waitpid, os.waitstatus_to_exitcode only exists from Python 3.9."""
+    if os.WIFSIGNALED(status):
+        return f'killed by signal {os.WTERMSIG(status)}'
+    if os.WIFEXITED(status):
+        return f'exited with status {os.WEXITSTATUS(status)}'
+    return f'stopped with status {status}'
+
+
+class PreforkServer:
+    """
+    :param address: the (host, port) to listen on.
+    :param server_factory: builds the StreamServer of a worker given the listening socket. It is called in the worker.
+    :param workers: number of worker processes, the number of CPUs by default.
+    :param backlog: backlog of the listening socket.
+    :param reuse_port: gives each worker its own listening socket bound with SO_REUSEPORT.
+    :param stop_timeout: number of seconds given to a worker to finish its connections when it is stopped.
+    """
+
+    def __init__(self, address: Tuple[str, int], server_factory: ServerFactory, workers: int = None,
+                 backlog: int = 256, reuse_port: bool = False, stop_timeout: float = 10.0):
+        workers = (os.cpu_count() or 1) if workers is None else workers
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError('workers must be a strictly positive integer')
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+
+        self._address = address
+        self._server_factory = server_factory
+        self._workers = workers
+        self._backlog = backlog
+        self._reuse_port = reuse_port
+        self._stop_timeout = stop_timeout
+        self._listener: Optional[socket.socket] = None
+        self._children: Dict[int, float] = {}  # pid -> start time
+        self._stopping = False
+
+    def _create_listener(self) -> socket.socket:
+        family = socket.AF_INET6 if ':' in self._address[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self._address)
+        sock.listen(self._backlog)
+        return sock
+
+    def _run_worker(self) -> None:
+        # the supervisor signal handlers are not ours
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl+c reaches the whole group, the supervisor handles it
+
+        listener = self._create_listener() if self._reuse_port else self._listener
+        server = self._server_factory(listener)
+        gevent.signal_handler(signal.SIGTERM, server.stop, self._stop_timeout)
+        server.serve_forever()
+
+    def _spawn_worker(self) -> None:
+        # not gevent.fork, its child watchers would reap the workers before os.waitpid sees them
+        pid = fork_gevent()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker()
+            except BaseException as e:
+                print(f'worker {os.getpid()} failed: {e!r}', file=sys.stderr)
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # never go back to the code of the supervisor
+                os._exit(status)
+        self._children[pid] = time.monotonic()
+
+    def _handle_stop_signal(self, signum: int, _) -> None:
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def serve_forever(self) -> None:
+        """Starts the workers and supervises them until a SIGTERM or SIGINT is received."""
+        if not self._reuse_port:
+            self._listener = self._create_listener()
+        else:
+            # fails now rather than in each worker if the address cannot be bound. The socket must not stay open,
+            # the kernel would give it connections nobody accepts
+            self._create_listener().close()
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+
+        for _ in range(self._workers):
+            self._spawn_worker()
+
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            started_at = self._children.pop(pid, None)
+            if started_at is None or self._stopping:
+                continue
+
+            print(f'worker {pid} {describe_exit_status(status)}, restarting it', file=sys.stderr)
+            if time.monotonic() - started_at < MIN_WORKER_UPTIME:
+                time.sleep(MIN_WORKER_UPTIME)
+            if not self._stopping:
+                self._spawn_worker()
+
+        if self._listener is not None:
+            self._listener.close()
+
+    def stop(self) -> None:
+        """Stops the workers, serve_forever returns once they all exited."""
+        self._handle_stop_signal(signal.SIGTERM, None)
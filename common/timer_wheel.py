@@ -0,0 +1,123 @@
+"""
+Timer wheel running the timeouts of many connections from a single greenlet.
+
+A greenlet or a loop timer per connection and per timeout gets expensive with hundreds of thousands of connections,
+and most of these timers are cancelled or pushed back long before they expire. The wheel keeps the timers in a ring of
+slots, one per tick: scheduling and cancelling a timer are a set insertion and a set removal, and every tick only looks
+at the timers of one slot. Timers fire up to one tick late, which is fine for timeouts counted in seconds.
+"""
+import math
+import os
+import sys
+import time
+from typing import Any, Callable, List, Optional, Set
+
+from gevent import get_hub, sleep, spawn
+from gevent.event import Event
+from gevent.greenlet import Greenlet
+
+
+class Timer:
+    __slots__ = ('tick', 'callback', 'args', '_wheel')
+
+    def __init__(self, wheel: 'TimerWheel', tick: int, callback: Callable, args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+
+    @property
+    def active(self) -> bool:
+        return self._wheel is not None
+
+    def cancel(self) -> None:
+        """Cancels the timer if it has not fired yet, it does nothing otherwise."""
+        if self._wheel is not None:
+            self._wheel._remove(self)
+            self._wheel = None
+
+
+class TimerWheel:
+    """
+    :param resolution: duration of a tick, in seconds.
+    :param slots: number of slots of the ring. Timers further than slots ticks away stay in their slot for several
+    turns, so it should cover the usual timeouts.
+    """
+
+    def __init__(self, resolution: float = 0.1, slots: int = 1024):
+        if not isinstance(resolution, (int, float)) or resolution <= 0:
+            raise ValueError('resolution must be a strictly positive number')
+        if not isinstance(slots, int) or slots < 1:
+            raise ValueError('slots must be a strictly positive integer')
+
+        self._resolution = resolution
+        self._slots: List[Set[Timer]] = [set() for _ in range(slots)]
+        self._origin = time.monotonic()
+        self._processed = 0  # last tick whose timers were run
+        self._count = 0
+        self._scheduled = Event()
+        self._runner: Optional[Greenlet] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _current_tick(self) -> int:
+        return int((time.monotonic() - self._origin) / self._resolution)
+
+    def schedule(self, delay: float, callback: Callable, *args: Any) -> Timer:
+        """Runs callback(*args) in the greenlet of the wheel in delay seconds. The callback must not block."""
+        if self._count == 0:  # the ticks passed while the wheel was empty don't need to be processed
+            self._processed = max(self._processed, self._current_tick())
+        tick = self._processed + max(1, math.ceil(delay / self._resolution))
+        timer = Timer(self, tick, callback, args)
+        self._slots[tick % len(self._slots)].add(timer)
+        self._count += 1
+        if self._runner is None:
+            self._runner = spawn(self._run)
+        self._scheduled.set()
+        return timer
+
+    def _remove(self, timer: Timer) -> None:
+        self._slots[timer.tick % len(self._slots)].discard(timer)
+        self._count -= 1
+
+    def _run_tick(self, tick: int) -> None:
+        slot = self._slots[tick % len(self._slots)]
+        expired = [timer for timer in slot if timer.tick <= tick]
+        for timer in expired:
+            if not timer.active:  # cancelled by a previous callback of the same tick
+                continue
+            timer.cancel()
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                # reported like the errors of a greenlet, the other timers must still run
+                get_hub().handle_error(timer.callback, *sys.exc_info())
+
+    def _run(self) -> None:
+        while True:
+            if self._count == 0:
+                self._scheduled.clear()
+                self._scheduled.wait()
+            current = self._current_tick()
+            while self._processed < current and self._count:
+                self._processed += 1
+                self._run_tick(self._processed)
+            next_tick_at = self._origin + (self._processed + 1) * self._resolution
+            sleep(max(next_tick_at - time.monotonic(), 0))
+
+
+_wheel: Optional[TimerWheel] = None
+_wheel_pid: Optional[int] = None
+
+
+def get_timer_wheel() -> TimerWheel:
+    """
+    Returns the wheel shared by all the connections of the process. A forked worker gets its own, the greenlet of the
+    wheel of its parent does not run in it.
+    """
+    global _wheel, _wheel_pid
+    if _wheel is None or _wheel_pid != os.getpid():
+        _wheel = TimerWheel()
+        _wheel_pid = os.getpid()
+    return _wheel
@@ -4,65 +4,226 @@ gevent-server.py
 
 A simple HTTP/2 server written for gevent serving static files from a directory specified as input.
 If no directory is provided, the current directory will be used.
+Run it with `python -m h2_server [directory]`.
+
+Over TLS, HTTP/2 is negotiated with ALPN. On cleartext connections (h2c), for example behind a proxy terminating TLS,
+clients either start with the HTTP/2 preface (prior knowledge) or upgrade an HTTP/1.1 request with `Upgrade: h2c`.
 
 Requires Python 3.6+.
 """
-import mimetypes
-import sys
-from functools import partial
+import mmap
+import time
+import uuid
 from pathlib import Path
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional, Set, Union
 
-from gevent import socket, ssl
-from gevent.event import Event
-from gevent.server import StreamServer
+import h11
+from gevent import socket, ssl, spawn
+from gevent.greenlet import Greenlet
+from gevent.pool import Group
 from h2 import events
 from h2.config import H2Configuration
 from h2.connection import H2Connection
+from h2.exceptions import ProtocolError, StreamClosedError
+from h2.settings import SettingCodes
+
+from common.buffer import OutputBuffer
+from .cache import FileCache, CachedFile
+from .compression import CompressionCache, get_accepted_encodings, is_compressible
+from .conditional import Range, RangeNotSatisfiable, if_range_matches, is_not_modified, parse_ranges
+from .metrics import H2Metrics
+from .priority import DEFAULT_WEIGHT, StreamScheduler, StreamState, parse_priority_header
+from .push import PushManifest, get_cookie_digests, make_push_cookie, resource_digest
+
+CERTIFICATES_DIR = Path(__file__).parent
+# first bytes sent by a client speaking HTTP/2, RFC 7540 Section 3.5
+CONNECTION_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+# maximum size of the HTTP/1.1 request upgraded to h2c
+MAX_UPGRADE_REQUEST_SIZE = 64 * 1024
 
 
 # noinspection PyUnresolvedReferences
-def get_http2_tls_context() -> ssl.SSLContext:
-    ctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+def get_http2_tls_context(certfile: Union[str, Path] = None, keyfile: Union[str, Path] = None,
+                          tls13_only: bool = False, session_tickets: bool = True) -> ssl.SSLContext:
+    """
+    Returns a TLS context for HTTP/2. The certificate and key default to the self-signed ones shipped with the package.
+
+    :param tls13_only: refuses TLS 1.2. TLS 1.3 handshakes take one round trip less and only offer AEAD cipher suites.
+    :param session_tickets: lets clients resume their sessions with a ticket, which skips the key exchange and the
+    certificate signature of a full handshake. The ticket keys are generated with the context, so a context built before
+    forking the workers lets a client resume its session on any of them.
+    """
+    # create_default_context returns a standard library context on recent gevent versions, its sockets would block
+    # the whole process, so we build gevent's context directly.
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     # RFC 7540 Section 9.2: Implementations of HTTP/2 MUST use TLS version 1.2
     # or higher. Disable TLS 1.1 and lower.
     ctx.options |= (
             ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
     )
+    if tls13_only:
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_3
     # RFC 7540 Section 9.2.1: A deployment of HTTP/2 over TLS 1.2 MUST disable
     # compression.
     ctx.options |= ssl.OP_NO_COMPRESSION
+    # TLS 1.2 only, the TLS 1.3 suites are all AEAD and cannot be changed from Python
     ctx.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20')
-    ctx.load_cert_chain(certfile='localhost.crt', keyfile='localhost.key')
+    if session_tickets:
+        ctx.options &= ~ssl.OP_NO_TICKET
+    else:
+        # clients can still resume their sessions from the session cache of the worker they reach
+        ctx.options |= ssl.OP_NO_TICKET
+        if hasattr(ctx, 'num_tickets'):  # TLS 1.3 tickets can only be disabled from Python 3.8
+            ctx.num_tickets = 0
+    if certfile is None:
+        certfile, keyfile = CERTIFICATES_DIR / 'localhost.crt', CERTIFICATES_DIR / 'localhost.key'
+    ctx.load_cert_chain(certfile=certfile, keyfile=keyfile)
     ctx.set_alpn_protocols(['h2'])
     try:
         ctx.set_npn_protocols(['h2'])
-    except NotImplementedError:
+    except (NotImplementedError, AttributeError):  # NPN support was removed from recent OpenSSL builds
         pass
 
     return ctx
 
 
+class HandshakeStats:
+    """TLS handshakes done by the connections of a process."""
+
+    def __init__(self):
+        self.count = 0
+        self.resumed = 0  # sessions resumed with a ticket or from the session cache
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def average_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
+
+    def record(self, duration: float, resumed: bool) -> None:
+        self.count += 1
+        self.resumed += resumed
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def __str__(self):
+        return (
+            f'{self.count} TLS handshakes, {self.resumed} resumed, {self.failed} failed, '
+            f'average {self.average_time * 1000:.2f} ms, max {self.max_time * 1000:.2f} ms'
+        )
+
+
 class H2Worker:
+    # cache shared by all the connections of the process when none is given to the worker
+    default_file_cache = FileCache()
+    # bounds of the per-connection output buffer, streams stop producing DATA frames above the high watermark
+    high_watermark: int = 64 * 1024
+    low_watermark: int = 16 * 1024
+    # number of seconds given to a client to complete the TLS handshake, when the server does not do it before handing
+    # over the socket (do_handshake_on_connect=False)
+    handshake_timeout: float = 10.0
+    handshake_stats = HandshakeStats()
+    # metrics of all the connections of the process, nothing is measured when it is None
+    metrics: Optional[H2Metrics] = None
 
     # noinspection PyTypeChecker
-    def __init__(self, sock: socket, address: Tuple[str, str], source_dir: str = None):
+    def __init__(self, sock: socket, address: Tuple[str, str], source_dir: str = None, file_cache: FileCache = None,
+                 initial_window_size: int = 65535, max_frame_size: int = 16384, max_concurrent_streams: int = 100,
+                 connection_window_size: int = 65535, max_chunk_size: int = None,
+                 compression_cache: CompressionCache = None, push_manifest: PushManifest = None):
+        """
+        :param initial_window_size: SETTINGS_INITIAL_WINDOW_SIZE advertised to the client.
+        :param max_frame_size: SETTINGS_MAX_FRAME_SIZE advertised to the client.
+        :param max_concurrent_streams: SETTINGS_MAX_CONCURRENT_STREAMS advertised to the client.
+        :param connection_window_size: the connection flow control window is raised to this value as soon as the
+        connection starts.
+        :param max_chunk_size: maximum size of a DATA frame sent. When None, frames are as large as the client's
+        SETTINGS_MAX_FRAME_SIZE and the current flow control window allow.
+        :param compression_cache: compresses text files with gzip on the fly for the clients accepting it, when they
+        have no precompressed sibling. Files are only sent compressed if they have a sibling when it is None.
+        :param push_manifest: resources pushed with the HTML pages requested, nothing is pushed when it is None.
+        """
+        self._check_settings(initial_window_size, max_frame_size, max_concurrent_streams, connection_window_size,
+                             max_chunk_size)
         self._sock = sock
         self._address = address
-        self._flow_control_events: Dict[int, Event] = {}
+        self._scheduler = StreamScheduler()
+        self._sender: Greenlet = None
+        self._stream_greenlets: Dict[int, Greenlet] = {}
+        self._streams = Group()
+        self._buffer: OutputBuffer = None
         self._server_name = 'gevent-h2'
         self._connection: H2Connection = None
-        self._read_chunk_size = 8192  # The maximum amount of a file we'll send in a single DATA frame
+        self._read_chunk_size = max_chunk_size  # The maximum amount of a file we'll send in a single DATA frame
+        self._initial_window_size = initial_window_size
+        self._max_frame_size = max_frame_size
+        self._max_concurrent_streams = max_concurrent_streams
+        self._connection_window_size = connection_window_size
 
         self._check_sources_dir(source_dir)
         self._sources_dir = source_dir
+        self._file_cache = file_cache if file_cache is not None else self.default_file_cache
+        self._compression_cache = compression_cache
+        self._push_manifest = push_manifest
+        # resources of the manifest requested by the client or pushed on this connection
+        self._known_resources: Set[str] = set()
 
         self._run()
 
-    def _initiate_connection(self):
+    @staticmethod
+    def _check_settings(initial_window_size: int, max_frame_size: int, max_concurrent_streams: int,
+                        connection_window_size: int, max_chunk_size: int) -> None:
+        # bounds are given by RFC 7540 Section 6.5.2 and 6.9.1
+        max_window_size = 2 ** 31 - 1
+        if not isinstance(initial_window_size, int) or not 0 <= initial_window_size <= max_window_size:
+            raise ValueError(f'initial_window_size must be an integer between 0 and {max_window_size}')
+        if not isinstance(max_frame_size, int) or not 2 ** 14 <= max_frame_size <= 2 ** 24 - 1:
+            raise ValueError(f'max_frame_size must be an integer between {2 ** 14} and {2 ** 24 - 1}')
+        if not isinstance(max_concurrent_streams, int) or max_concurrent_streams < 1:
+            raise ValueError('max_concurrent_streams must be a strictly positive integer')
+        if not isinstance(connection_window_size, int) or not 65535 <= connection_window_size <= max_window_size:
+            raise ValueError(f'connection_window_size must be an integer between 65535 and {max_window_size}')
+        if max_chunk_size is not None and (not isinstance(max_chunk_size, int) or max_chunk_size < 1):
+            raise ValueError('max_chunk_size must be a strictly positive integer')
+
+    def _initiate_connection(self, upgrade_settings: bytes = None) -> None:
+        """
+        :param upgrade_settings: the HTTP2-Settings header of an HTTP/1.1 request upgraded to h2c.
+        """
         self._connection = H2Connection(H2Configuration(client_side=False, header_encoding='utf-8'))
-        self._connection.initiate_connection()
-        self._sock.sendall(self._connection.data_to_send())
+        if upgrade_settings is None:
+            self._connection.initiate_connection()
+        else:
+            self._connection.initiate_upgrade_connection(upgrade_settings)
+        self._connection.update_settings({
+            SettingCodes.INITIAL_WINDOW_SIZE: self._initial_window_size,
+            SettingCodes.MAX_FRAME_SIZE: self._max_frame_size,
+            SettingCodes.MAX_CONCURRENT_STREAMS: self._max_concurrent_streams,
+        })
+        # the connection window can only be changed with a WINDOW_UPDATE frame, better to send it right away
+        increment = self._connection_window_size - self._connection.inbound_flow_control_window
+        if increment > 0:
+            self._connection.increment_flow_control_window(increment)
+        self._flush()
+        self._sender = spawn(self._send_loop)
+
+    def _chunk_size(self, stream_id: int) -> int:
+        """
+        Size of the next DATA frame of a stream: as much as the flow control window and the client allow.
+        """
+        size = min(self._connection.local_flow_control_window(stream_id), self._connection.max_outbound_frame_size)
+        if self._read_chunk_size is not None:
+            size = min(size, self._read_chunk_size)
+        return size
+
+    def _flush(self) -> None:
+        """
+        Moves everything h2 has buffered so far to the output buffer.
+        """
+        data = self._connection.data_to_send()
+        if data:
+            self._buffer.write(data)
 
     @staticmethod
     def _check_sources_dir(sources_dir: str) -> None:
@@ -71,121 +232,480 @@ class H2Worker:
             raise NotADirectoryError(f'{sources_dir} does not exists')
 
     def _send_error_response(self, status_code: str, event: events.RequestReceived) -> None:
-        self._connection.send_headers(
-            stream_id=event.stream_id,
-            headers=[
-                (':status', status_code),
-                ('content-length', '0'),
-                ('server', self._server_name),
-            ],
-            end_stream=True
-        )
-        self._sock.sendall(self._connection.data_to_send())
+        self._send_headers(event.stream_id, status_code, [('content-length', '0')], end_stream=True)
 
     def _handle_request(self, event: events.RequestReceived) -> None:
         headers = dict(event.headers)
-        if headers[':method'] != 'GET':
+        method = headers[':method']
+        if method not in ('GET', 'HEAD'):
             self._send_error_response('405', event)
             return
 
         file_path = Path(self._sources_dir) / headers[':path'].lstrip('/')
-        if not file_path.is_file():
+        if self._push_manifest is not None and headers[':path'] in self._push_manifest.paths:
+            self._known_resources.add(headers[':path'])
+        cached_file = self._file_cache.get(file_path)
+        if cached_file is None:
             self._send_error_response('404', event)
             return
 
-        self._send_file(file_path, event.stream_id)
+        cached_file, vary = self._negotiate_encoding(cached_file, headers.get('accept-encoding', ''))
+        extra_headers = [('vary', 'accept-encoding')] if vary else []
+        self._scheduler.guess_urgency(event.stream_id, cached_file.content_type)
 
-    def _send_file(self, file_path: Path, stream_id: int) -> None:
+        if is_not_modified(headers, cached_file.etag, cached_file.mtime):
+            self._send_headers(event.stream_id, '304', [*cached_file.validator_headers, *extra_headers],
+                               end_stream=True)
+            return
+        if method == 'HEAD':
+            self._send_headers(event.stream_id, '200', [*cached_file.headers, *extra_headers], end_stream=True)
+            return
+
+        ranges = None
+        if 'range' in headers and if_range_matches(headers, cached_file.etag, cached_file.mtime):
+            try:
+                ranges = parse_ranges(headers['range'], cached_file.size)
+            except RangeNotSatisfiable as e:
+                self._send_headers(event.stream_id, '416', [
+                    ('content-range', str(e)), ('content-length', '0'), *cached_file.validator_headers
+                ], end_stream=True)
+                return
+
+        if ranges is None:
+            if self._push_manifest is not None and event.stream_id % 2:  # pushed streams cannot push
+                extra_headers = [*extra_headers, *self._push_resources(event, headers)]
+            self._send_file(cached_file, event.stream_id, extra_headers)
+        else:
+            self._send_ranges(cached_file, ranges, event.stream_id, extra_headers)
+
+    def _push_resources(self, event: events.RequestReceived, headers: Dict[str, str]) -> List[Tuple[str, str]]:
         """
-        Send a file, obeying the rules of HTTP/2 flow control.
+        Promises the resources of the manifest of a page the client does not have yet and starts serving them, before
+        the response of the page, so the client does not request them while reading it. Returns the set-cookie header
+        of the response, if the push cookie changed.
         """
-        file_size = file_path.stat().st_size
-        content_type, content_encoding = mimetypes.guess_type(str(file_path))
-        response_headers = [
-            (':status', '200'),
-            ('content-length', str(file_size)),
-            ('server', self._server_name)
-        ]
-        if content_type:
-            response_headers.append(('content-type', content_type))
-        if content_encoding:
-            response_headers.append(('content-encoding', content_encoding))
+        resources = self._push_manifest.get(headers[':path'])
+        if not resources or not self._connection.remote_settings.enable_push:
+            return []
+
+        client_digests = get_cookie_digests(event.headers)
+        page_digests = []
+        # the pushed requests look like the ones the client would send, so the negotiated encoding is the same
+        pseudo_headers = [(':method', 'GET'), (':scheme', headers[':scheme'])]
+        if ':authority' in headers:
+            pseudo_headers.append((':authority', headers[':authority']))
+        request_headers = [('accept-encoding', headers['accept-encoding'])] if 'accept-encoding' in headers else []
+        can_push = True
+        for path in resources:
+            cached_file = self._file_cache.get(Path(self._sources_dir) / path.lstrip('/'))
+            if cached_file is None:
+                continue
+            digest = resource_digest(path, cached_file.etag)
+            page_digests.append(digest)
+            if path in self._known_resources or digest in client_digests:
+                if self.metrics is not None:
+                    self.metrics.skipped_pushes.inc()
+                continue
+            # the client does not accept more streams, it will request the other resources itself. h2 does not count
+            # the promised streams whose response did not start yet, the streams pushed and not served yet are counted
+            can_push = can_push and (
+                    sum(not stream_id % 2 for stream_id in self._stream_greenlets)
+                    < self._connection.remote_settings.max_concurrent_streams
+            )
+            if not can_push:
+                continue
+
+            pushed = events.RequestReceived(stream_id=self._connection.get_next_available_stream_id())
+            pushed.headers = [*pseudo_headers, (':path', path), *request_headers]
+            try:
+                self._connection.push_stream(event.stream_id, pushed.stream_id, pushed.headers)
+            except ProtocolError:
+                can_push = False
+                continue
+            self._known_resources.add(path)
+            if self.metrics is not None:
+                self.metrics.pushed_streams.inc()
+            self._start_stream(pushed)
+        self._flush()
+
+        digests = list(dict.fromkeys([*page_digests, *client_digests]))
+        if set(digests) == set(client_digests):
+            return []
+        return [('set-cookie', make_push_cookie(digests, secure=headers[':scheme'] == 'https'))]
+
+    def _negotiate_encoding(self, cached_file: CachedFile, accept_encoding: str) -> Tuple[CachedFile, bool]:
+        """
+        Returns the representation of a file to send given the Accept-Encoding header of the request: a precompressed
+        sibling, a version compressed on the fly or the file itself. The boolean tells if the response must vary on
+        Accept-Encoding.
+        """
+        if cached_file.content_encoding is not None:  # already compressed, sent as is
+            return cached_file, False
+
+        vary = is_compressible(cached_file.content_type)
+        for encoding in get_accepted_encodings(accept_encoding):
+            compressed_file = self._file_cache.get_precompressed(cached_file, encoding)
+            if compressed_file is None and encoding == 'gzip' and self._compression_cache is not None:
+                compressed_file = self._compression_cache.get(cached_file)
+            if compressed_file is not None:
+                return compressed_file, True
+        return cached_file, vary
+
+    def _send_headers(self, stream_id: int, status: str, headers: List[Tuple[str, str]], end_stream: bool = False):
+        self._connection.send_headers(
+            stream_id, [(':status', status), *headers, ('server', self._server_name)], end_stream=end_stream
+        )
+        if self.metrics is not None:
+            self.metrics.sent_frames.inc()
+        self._flush()
 
-        self._connection.send_headers(stream_id, response_headers)
-        self._sock.sendall(self._connection.data_to_send())
+    def _get_view(self, cached_file: CachedFile) -> memoryview:
+        return cached_file.data if cached_file.in_memory else self._map_file(cached_file)
 
-        with file_path.open(mode='rb', buffering=0) as f:
-            self._send_file_data(f, stream_id)
+    def _send_file(self, cached_file: CachedFile, stream_id: int, extra_headers: List[Tuple[str, str]]) -> None:
+        """
+        Send a file, obeying the rules of HTTP/2 flow control.
+        """
+        self._send_headers(stream_id, '200', [*cached_file.headers, *extra_headers])
+        if self.metrics is not None:
+            self.metrics.response_size.observe(cached_file.size)
+        self._send_view(self._get_view(cached_file), stream_id)
 
-    def _send_file_data(self, file_obj, stream_id: int) -> None:
+    def _send_ranges(self, cached_file: CachedFile, ranges: List[Range], stream_id: int,
+                     extra_headers: List[Tuple[str, str]]) -> None:
         """
-        Send the data portion of a file. Handles flow control rules.
+        Sends parts of a file in a 206 response, as a multipart/byteranges body if there are several of them.
         """
-        while True:
-            while self._connection.local_flow_control_window(stream_id) < 1:
-                self._wait_for_flow_control(stream_id)
+        view = self._get_view(cached_file)
+        headers = [*cached_file.validator_headers, ('accept-ranges', 'bytes'), *extra_headers]
+        if cached_file.content_encoding:
+            headers.append(('content-encoding', cached_file.content_encoding))
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self._send_headers(stream_id, '206', [
+                ('content-length', str(end - start + 1)), ('content-range', f'bytes {start}-{end}/{cached_file.size}'),
+                *([('content-type', cached_file.content_type)] if cached_file.content_type else []),
+                *headers
+            ])
+            if self.metrics is not None:
+                self.metrics.response_size.observe(end - start + 1)
+            self._send_view(view[start:end + 1], stream_id)
+            return
 
-            chunk_size = min(self._connection.local_flow_control_window(stream_id), self._read_chunk_size)
-            data = file_obj.read(chunk_size)
-            keep_reading = (len(data) == chunk_size)
+        boundary = uuid.uuid4().hex
+        content_type = cached_file.content_type or 'application/octet-stream'
+        parts = []
+        for start, end in ranges:
+            part_headers = (
+                f'\r\n--{boundary}\r\ncontent-type: {content_type}\r\n'
+                f'content-range: bytes {start}-{end}/{cached_file.size}\r\n\r\n'
+            )
+            parts.append((part_headers.encode(), view[start:end + 1]))
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+        length = sum(len(part_headers) + len(data) for part_headers, data in parts) + len(closing)
+
+        self._send_headers(stream_id, '206', [
+            ('content-length', str(length)), ('content-type', f'multipart/byteranges; boundary={boundary}'), *headers
+        ])
+        if self.metrics is not None:
+            self.metrics.response_size.observe(length)
+        for part_headers, data in parts:
+            self._send_view(memoryview(part_headers), stream_id, end_stream=False)
+            self._send_view(data, stream_id, end_stream=False)
+        self._send_view(memoryview(closing), stream_id)
 
-            self._connection.send_data(stream_id, data, not keep_reading)
-            self._sock.sendall(self._connection.data_to_send())
+    @staticmethod
+    def _map_file(cached_file: CachedFile) -> memoryview:
+        """
+        Maps a file in memory so that its content can be sent without intermediate read buffers.
+        The mapping is released when the returned view is garbage collected, i.e when the stream is done with it.
+        Note that truncating a file while it is being served leads to a SIGBUS.
+        """
+        if not cached_file.size:  # empty files cannot be mapped
+            return memoryview(b'')
 
-            if not keep_reading:
-                break
+        with cached_file.path.open(mode='rb') as f:
+            mapped = mmap.mmap(f.fileno(), cached_file.size, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return memoryview(mapped)
 
-    def _wait_for_flow_control(self, stream_id: int) -> None:
+    def _send_view(self, view: memoryview, stream_id: int, end_stream: bool = True) -> None:
+        """
+        Queues data held in memory for the sender greenlet and waits until it is sent.
+        """
+        if not view and not end_stream:
+            return
+        self._scheduler.push(stream_id, view, end_stream).get()
+
+    def _is_ready(self, stream: StreamState) -> bool:
+        view = stream.pending[0][0]
+        if stream.offset == len(view):  # an empty DATA frame ending the stream is not flow controlled
+            return True
+        try:
+            return self._connection.local_flow_control_window(stream.stream_id) > 0
+        except ProtocolError:  # the stream is closed, sending will remove it
+            return True
+
+    def _send_loop(self) -> None:
         """
-        Blocks until the flow control window for a given stream is opened.
+        Sends the DATA frames of all the streams, one at a time, in the order chosen by the scheduler.
         """
-        event = Event()
-        self._flow_control_events[stream_id] = event
-        event.wait()
+        metrics = self.metrics
+        try:
+            while True:
+                stream = self._scheduler.next_stream(self._is_ready)
+                if stream is None:
+                    if metrics is not None and self._scheduler.has_pending():
+                        # everything left to send is blocked by flow control
+                        stalled_at = time.perf_counter()
+                        self._scheduler.wait()
+                        metrics.flow_control_stall.inc(time.perf_counter() - stalled_at)
+                    else:
+                        self._scheduler.wait()
+                    continue
+
+                view, end_stream, result = stream.pending[0]
+                try:
+                    size = self._chunk_size(stream.stream_id) if stream.offset < len(view) else 0
+                    chunk = view[stream.offset:stream.offset + size]
+                    stream.offset += len(chunk)
+                    finished = stream.offset >= len(view)
+                    self._connection.send_data(stream.stream_id, chunk, finished and end_stream)
+                except ProtocolError:  # the stream was reset or closed
+                    self._scheduler.remove(stream.stream_id)
+                    continue
+                if metrics is not None:
+                    metrics.sent_frames.inc()
+
+                if finished:
+                    stream.pending.popleft()
+                    stream.offset = 0
+                    result.set()
+                    if end_stream:
+                        self._scheduler.remove(stream.stream_id)
+                self._flush()
+                # once the output buffer is full, the next frame goes to the stream with the highest priority at the
+                # time the buffer drains, not when this one was sent
+                self._buffer.drain()
+        except OSError:  # the connection is lost, the read loop will stop too
+            self._scheduler.clear()
+
+    def _handle_window_update(self, event: Union[events.WindowUpdated, events.RemoteSettingsChanged]) -> None:
+        """
+        Lets the sender know that a stream blocked by flow control may be ready.
+        """
+        self._scheduler.wake()
+
+    def _serve_stream(self, event: events.RequestReceived) -> None:
+        metrics = self.metrics
+        if metrics is not None:
+            started_at = time.perf_counter()
+            metrics.streams.inc()
+            metrics.open_streams.inc()
+        try:
+            self._handle_request(event)
+        except (StreamClosedError, ProtocolError, OSError):
+            # the client reset the stream, or the connection is gone: h2 refuses to send on a closed connection, and a
+            # stream greenlet may only run once the connection ended
+            pass
+        finally:
+            self._scheduler.remove(event.stream_id)
+            self._stream_greenlets.pop(event.stream_id, None)
+            if metrics is not None:
+                metrics.open_streams.dec()
+                # noinspection PyUnboundLocalVariable
+                metrics.stream_duration.observe(time.perf_counter() - started_at)
+
+    def _start_stream(self, event: events.RequestReceived) -> None:
+        priority = dict(event.headers).get('priority')
+        urgency = incremental = None
+        if priority is not None:
+            urgency, incremental = parse_priority_header(priority)
+        weight = event.priority_updated.weight if event.priority_updated is not None else DEFAULT_WEIGHT
+        self._scheduler.add(event.stream_id, urgency, incremental, weight)
+        self._stream_greenlets[event.stream_id] = self._streams.spawn(self._serve_stream, event)
+
+    def _handle_stream_reset(self, event: events.StreamReset) -> None:
+        """
+        Stops the greenlet serving a stream the client does not want anymore.
+        """
+        self._scheduler.remove(event.stream_id)
+        green = self._stream_greenlets.pop(event.stream_id, None)
+        if green is not None:
+            green.kill(block=False)
 
-    def _handle_window_update(self, event: events.WindowUpdated) -> None:
+    def _release_streams(self) -> None:
         """
-        Unblock streams waiting on flow control, if needed.
+        Stops the sender and the stream greenlets.
         """
-        stream_id = event.stream_id
+        if self._sender is not None:
+            self._sender.kill()
+        self._scheduler.clear()
+        self._streams.kill(block=True)
 
-        if stream_id and stream_id in self._flow_control_events:
-            g_event = self._flow_control_events.pop(stream_id)
-            g_event.set()
-        elif not stream_id:
-            # Need to keep a real list here to use only the events present at this time.
-            blocked_streams = list(self._flow_control_events.keys())
-            for stream_id in blocked_streams:
-                g_event = self._flow_control_events.pop(stream_id)
-                g_event.set()
+    def _read_preface(self) -> bytes:
+        """
+        Reads the first bytes of a cleartext connection, until we know if they start with the HTTP/2 preface.
+        """
+        data = b''
+        while len(data) < len(CONNECTION_PREFACE) and CONNECTION_PREFACE.startswith(data):
+            chunk = self._sock.recv(65535)
+            if not chunk:
+                break
+            data += chunk
+        return data
 
-    def _run(self) -> None:
-        self._initiate_connection()
+    @staticmethod
+    def _header_tokens(headers: Dict[bytes, bytes], name: bytes) -> set:
+        return {token.strip().lower() for token in headers.get(name, b'').split(b',')}
+
+    def _upgrade(self, data: bytes) -> Optional[bytes]:
+        """
+        Upgrades an HTTP/1.1 request to h2c, the request is then answered on stream 1. Returns the bytes received after
+        the request, or None if it cannot be upgraded, in which case a 426 response was sent.
+        """
+        http1 = h11.Connection(h11.SERVER, max_incomplete_event_size=MAX_UPGRADE_REQUEST_SIZE)
+        http1.receive_data(data)
+        try:
+            request = http1.next_event()
+            while request is h11.NEED_DATA:
+                http1.receive_data(self._sock.recv(65535))
+                request = http1.next_event()
+        except h11.RemoteProtocolError:
+            return None
+        if not isinstance(request, h11.Request):  # the client left
+            return None
+
+        headers = dict(request.headers)
+        upgradable = (
+                b'h2c' in self._header_tokens(headers, b'upgrade')
+                and b'upgrade' in self._header_tokens(headers, b'connection')
+                and b'http2-settings' in headers
+                # the body of a request would come before the preface, we don't handle that
+                and headers.get(b'content-length', b'0') == b'0' and b'transfer-encoding' not in headers
+        )
+        if not upgradable:
+            self._buffer.write(http1.send(h11.Response(status_code=426, headers=[
+                (b'upgrade', b'h2c'), (b'connection', b'Upgrade, close'), (b'content-length', b'0'),
+                (b'server', self._server_name.encode())
+            ])))
+            return None
+
+        self._buffer.write(http1.send(h11.InformationalResponse(
+            status_code=101, headers=[(b'connection', b'Upgrade'), (b'upgrade', b'h2c')]
+        )))
+        self._initiate_connection(headers[b'http2-settings'])
+
+        # the request becomes stream 1, which h2 opened half-closed
+        event = events.RequestReceived(stream_id=1)
+        event.headers = [
+            (':method', request.method.decode()), (':scheme', 'http'), (':path', request.target.decode()),
+            (':authority', headers.get(b'host', b'').decode()),
+            *((name.decode(), value.decode()) for name, value in request.headers if name != b'host')
+        ]
+        self._start_stream(event)
+        return http1.trailing_data[0]
 
+    def _start_cleartext(self) -> Optional[bytes]:
+        """
+        Starts HTTP/2 on a cleartext connection. Returns the bytes received and not processed yet, or None if the
+        client does not speak HTTP/2.
+        """
+        data = self._read_preface()
+        if data.startswith(CONNECTION_PREFACE):
+            self._initiate_connection()
+            return data
+        if not data:
+            return None
+        return self._upgrade(data)
+
+    def _read_loop(self, data: bytes = b'') -> None:
+        """
+        :param data: bytes already received, processed before reading the socket.
+        """
+        metrics = self.metrics
         while True:
-            data = self._sock.recv(65535)
             if not data:
-                break
+                data = self._sock.recv(65535)
+                if not data:
+                    break
 
             h2_events = self._connection.receive_data(data)
+            if metrics is not None:
+                metrics.received_bytes.inc(len(data))
+                metrics.received_events.inc(len(h2_events))
+            data = b''
             for event in h2_events:
                 if isinstance(event, events.RequestReceived):
-                    self._handle_request(event)
+                    self._start_stream(event)
                 elif isinstance(event, events.DataReceived):
-                    self._connection.reset_stream(event.stream_id)
-                elif isinstance(event, events.WindowUpdated):
+                    # we don't expect request bodies, but the data still counts in the connection window
+                    self._connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    try:
+                        self._connection.reset_stream(event.stream_id)
+                    except StreamClosedError:  # already reset by a previous DATA frame
+                        pass
+                elif isinstance(event, (events.WindowUpdated, events.RemoteSettingsChanged)):
+                    # a new initial window size also changes the windows of the streams
                     self._handle_window_update(event)
+                elif isinstance(event, events.PriorityUpdated):
+                    self._scheduler.set_weight(event.stream_id, event.weight)
+                elif isinstance(event, events.StreamReset):
+                    self._handle_stream_reset(event)
+                elif isinstance(event, events.ConnectionTerminated):
+                    return
+
+            # acknowledgements, pings and settings produced by receive_data
+            self._flush()
+
+    def _do_handshake(self) -> None:
+        if self._sock.do_handshake_on_connect:  # already done by the server, its duration is unknown
+            return
+        started_at = time.perf_counter()
+        self._sock.settimeout(self.handshake_timeout)
+        try:
+            self._sock.do_handshake()
+        except OSError:
+            self.handshake_stats.failed += 1
+            if self.metrics is not None:
+                self.metrics.failed_handshakes.inc()
+            raise
+        self._sock.settimeout(None)
+        duration = time.perf_counter() - started_at
+        self.handshake_stats.record(duration, self._sock.session_reused)
+        if self.metrics is not None:
+            self.metrics.handshake_duration.observe(duration)
+            self.metrics.resumed_handshakes.inc(self._sock.session_reused)
 
-            data_to_send = self._connection.data_to_send()
-            if data_to_send:
-                self._sock.sendall(data_to_send)
-
-
-if __name__ == '__main__':
-    files_dir = sys.argv[1] if len(sys.argv) > 1 else f'{Path().cwd()}'
-    server = StreamServer(('127.0.0.1', 8080), partial(H2Worker, source_dir=files_dir),
-                          ssl_context=get_http2_tls_context())
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        server.close()
+    def _run(self) -> None:
+        # frames are already coalesced by the output buffer, don't let Nagle's algorithm delay them further
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        metrics = self.metrics
+        self._buffer = OutputBuffer(self._sock, self.high_watermark, self.low_watermark,
+                                    None if metrics is None else metrics.sent_bytes)
+        if metrics is not None:
+            metrics.connections.inc()
+            metrics.open_connections.inc()
+
+        try:
+            if isinstance(self._sock, ssl.SSLSocket):  # ALPN already negotiated h2
+                self._do_handshake()
+                self._initiate_connection()
+                data = b''
+            else:
+                data = self._start_cleartext()
+            if data is not None:
+                self._read_loop(data)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._release_streams()
+            if self._connection is not None:
+                try:
+                    self._flush()
+                except OSError:
+                    pass
+            self._buffer.close()
+            if metrics is not None:
+                metrics.open_connections.dec()
@@ -0,0 +1,111 @@
+import argparse
+import os
+from functools import partial
+from pathlib import Path
+
+import gevent
+from gevent.server import StreamServer
+
+from common.metrics import PrometheusExporter, Registry
+from common.prefork import PreforkServer
+from . import H2Worker, get_http2_tls_context
+from .cache import FileCache
+from .compression import CompressionCache
+from .metrics import H2Metrics
+from .push import PushManifest
+
+parser = argparse.ArgumentParser(prog='python -m h2_server', description='Serves the files of a directory over HTTP/2.')
+parser.add_argument('directory', nargs='?', default=f'{Path().cwd()}',
+                    help='directory to serve, the current one by default')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes, 0 for the number of CPUs, 1 (the default) disables pre-forking')
+parser.add_argument('--reuse-port', action='store_true', help='give each worker its own socket bound with SO_REUSEPORT')
+parser.add_argument('--compress', action='store_true',
+                    help='compress text files with gzip on the fly when they have no precompressed sibling')
+parser.add_argument('--push', action='store_true',
+                    help='push the stylesheets, scripts and fonts of the HTML pages found in the directory with them')
+parser.add_argument('--push-manifest', metavar='FILE',
+                    help='push the resources listed by a JSON file mapping page paths to lists of resource paths')
+parser.add_argument('--cleartext', action='store_true',
+                    help='serve HTTP/2 without TLS (h2c), with prior knowledge or an HTTP/1.1 upgrade')
+parser.add_argument('--cert', help='certificate file, the self-signed localhost one by default')
+parser.add_argument('--key', help='private key of the certificate')
+parser.add_argument('--tls13-only', action='store_true', help='refuse TLS 1.2 clients')
+parser.add_argument('--no-session-tickets', action='store_true',
+                    help='disable TLS session tickets, sessions are still resumed from the cache of each process')
+parser.add_argument('--handshake-stats', type=float, metavar='SECONDS',
+                    help='print the TLS handshake statistics of each process every SECONDS seconds')
+parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                    help='serve Prometheus metrics on http://METRICS_HOST:PORT/metrics, the workers take the ports '
+                         'following PORT')
+parser.add_argument('--metrics-host', default='127.0.0.1')
+args = parser.parse_args()
+if args.cleartext and (args.cert or args.key):
+    parser.error('--cert and --key cannot be used with --cleartext')
+if bool(args.cert) != bool(args.key):
+    parser.error('--cert and --key go together')
+if args.cleartext and (args.tls13_only or args.no_session_tickets or args.handshake_stats):
+    parser.error('TLS options cannot be used with --cleartext')
+if args.handshake_stats is not None and args.handshake_stats <= 0:
+    parser.error('--handshake-stats must be a strictly positive number')
+if args.push and args.push_manifest:
+    parser.error('--push and --push-manifest cannot be used together')
+
+push_manifest = None
+try:
+    if args.push:
+        push_manifest = PushManifest.scan(args.directory)
+    elif args.push_manifest:
+        push_manifest = PushManifest.load(args.push_manifest)
+except (OSError, ValueError) as e:
+    parser.error(f'cannot load the push manifest: {e}')
+if push_manifest is not None:
+    print(f'pushing the resources of {len(push_manifest)} pages', flush=True)
+
+# built before forking, so the workers share them
+handler = partial(
+    H2Worker, source_dir=args.directory, file_cache=FileCache(),
+    compression_cache=CompressionCache() if args.compress else None, push_manifest=push_manifest
+)
+ssl_context = None if args.cleartext else get_http2_tls_context(
+    args.cert, args.key, tls13_only=args.tls13_only, session_tickets=not args.no_session_tickets
+)
+
+
+def print_handshake_stats(interval: float) -> None:
+    while True:
+        gevent.sleep(interval)
+        print(f'[{os.getpid()}] {H2Worker.handshake_stats}', flush=True)
+
+
+def start_metrics_exporter() -> None:
+    # in the worker, each process has its own metrics
+    H2Worker.metrics = H2Metrics(Registry())
+    exporter = PrometheusExporter(H2Worker.metrics.registry, args.metrics_host, args.metrics_port,
+                                  port_range=args.workers or os.cpu_count() or 1)
+    exporter.start()
+    print(f'[{os.getpid()}] metrics served on http://{args.metrics_host}:{exporter.port}/metrics', flush=True)
+
+
+def create_server(listener) -> StreamServer:
+    if args.metrics_port is not None:
+        start_metrics_exporter()
+    if ssl_context is None:
+        return StreamServer(listener, handler)
+    if args.handshake_stats:
+        gevent.spawn(print_handshake_stats, args.handshake_stats)
+    # the workers do the handshake themselves, so they can time it
+    return StreamServer(listener, handler, ssl_context=ssl_context, do_handshake_on_connect=False)
+
+
+if args.workers == 1:
+    server = create_server((args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+else:
+    prefork = PreforkServer((args.host, args.port), create_server, args.workers or None, reuse_port=args.reuse_port)
+    prefork.serve_forever()
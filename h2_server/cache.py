@@ -0,0 +1,196 @@
+"""
+In-memory cache of the files served by the HTTP/2 server.
+
+Entries are keyed by path and hold the metadata needed to answer a request (size, modification time, content type,
+ETag, Last-Modified date and response headers). Small files also keep their content so they can be served straight
+from memory. The cache has a byte budget shared by all the connections of the process, the least recently used contents
+are evicted first.
+"""
+import mimetypes
+import os
+import stat
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, List, Tuple
+
+from .conditional import make_etag, make_http_date
+
+# content codings of the precompressed siblings of a file, by suffix
+ENCODING_SUFFIXES = {'.br': 'br', '.zst': 'zstd', '.gz': 'gzip'}
+
+
+def guess_type(path: Path) -> Tuple[Optional[str], Optional[str]]:
+    """Same as mimetypes.guess_type, but also knows zstd compressed files."""
+    encoding = ENCODING_SUFFIXES.get(path.suffix)
+    if encoding is not None:
+        return mimetypes.guess_type(str(path.with_suffix('')))[0], encoding
+    return mimetypes.guess_type(str(path))
+
+
+class CachedFile:
+    """Metadata and optional content of a file."""
+    __slots__ = (
+        'path', 'size', 'mtime', 'content_type', 'content_encoding', 'etag', 'last_modified', 'headers', 'data',
+        'checked_at', 'missing_encodings'
+    )
+
+    def __init__(self, path: Path, size: int, mtime: int, data: Optional[bytes], checked_at: float,
+                 content_encoding: str = None):
+        """
+        :param content_encoding: the content coding of data, when it is a compressed version of the file at path.
+        """
+        self.path = path
+        self.size = size
+        self.mtime = mtime  # in nanoseconds
+        self.content_type, guessed_encoding = guess_type(path)
+        self.content_encoding = content_encoding or guessed_encoding
+        self.etag = make_etag(size, mtime, self.content_encoding)
+        self.last_modified = make_http_date(mtime)
+        self.data = memoryview(data) if data is not None else None
+        self.checked_at = checked_at
+        # time at which we saw that a precompressed sibling was missing, by content coding
+        self.missing_encodings: Dict[str, float] = {}
+
+        # headers of a 200 response, without status and server name
+        headers: List[Tuple[str, str]] = [('content-length', str(size)), *self.validator_headers]
+        if self.content_type:
+            headers.append(('content-type', self.content_type))
+        if self.content_encoding:
+            headers.append(('content-encoding', self.content_encoding))
+        headers.append(('accept-ranges', 'bytes'))
+        self.headers = headers
+
+    @property
+    def validator_headers(self) -> List[Tuple[str, str]]:
+        """Headers a client uses to make conditional requests, also sent in 304 responses."""
+        return [('etag', self.etag), ('last-modified', self.last_modified)]
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+
+class FileCache:
+    """
+    LRU cache of files.
+
+    :param max_bytes: maximum amount of file contents kept in memory.
+    :param max_file_size: files bigger than this size are never kept in memory, only their metadata is cached.
+    :param max_entries: maximum number of files, in memory or not, tracked by the cache.
+    :param check_interval: number of seconds during which an entry is trusted before checking the file modification
+    time again. Set it to 0 to check on each access.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_file_size: int = 1024 * 1024, max_entries: int = 10000,
+                 check_interval: float = 1.0):
+        for name, value in [('max_bytes', max_bytes), ('max_file_size', max_file_size), ('max_entries', max_entries)]:
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(f'{name} must be a positive integer')
+        if not isinstance(check_interval, (int, float)) or check_interval < 0:
+            raise ValueError('check_interval must be a positive number')
+
+        self._max_bytes = max_bytes
+        self._max_file_size = max_file_size
+        self._max_entries = max_entries
+        self._check_interval = check_interval
+        self._entries: 'OrderedDict[str, CachedFile]' = OrderedDict()
+        self._memory = 0  # bytes of file contents currently held
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: Path) -> Optional[CachedFile]:
+        """
+        Returns the cached entry of a regular file or None if the path does not lead to one.
+        """
+        key = str(path)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry.checked_at < self._check_interval:
+            self._entries.move_to_end(key)
+            return entry
+
+        try:
+            file_stat = os.stat(key)
+        except OSError:
+            self.invalidate(path)
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            self.invalidate(path)
+            return None
+
+        if entry is not None and entry.mtime == file_stat.st_mtime_ns and entry.size == file_stat.st_size:
+            entry.checked_at = now
+            self._entries.move_to_end(key)
+            return entry
+
+        self.invalidate(path)
+        entry = self._load(path, file_stat.st_size, file_stat.st_mtime_ns, now)
+        self._store(key, entry)
+        return entry
+
+    def get_precompressed(self, entry: CachedFile, encoding: str) -> Optional[CachedFile]:
+        """
+        Returns the entry of the sibling of a file compressed with the given content coding, like style.css.br for
+        style.css, or None if there is none or if it is older than the file.
+        """
+        now = time.monotonic()
+        missing_at = entry.missing_encodings.get(encoding)
+        if missing_at is not None and now - missing_at < self._check_interval:
+            return None
+
+        suffix = next(suffix for suffix, name in ENCODING_SUFFIXES.items() if name == encoding)
+        sibling = self.get(entry.path.with_name(entry.path.name + suffix))
+        if sibling is None or sibling.mtime < entry.mtime:
+            entry.missing_encodings[encoding] = now
+            return None
+        entry.missing_encodings.pop(encoding, None)
+        return sibling
+
+    def _load(self, path: Path, size: int, mtime: int, now: float) -> CachedFile:
+        data = None
+        if size <= min(self._max_file_size, self._max_bytes):
+            try:
+                with path.open(mode='rb') as f:
+                    data = f.read()
+            except OSError:
+                pass
+            else:
+                if len(data) != size:  # the file is being modified, don't keep this version
+                    data = None
+        return CachedFile(path, size, mtime, data, now)
+
+    def _store(self, key: str, entry: CachedFile) -> None:
+        self._entries[key] = entry
+        if entry.in_memory:
+            self._memory += entry.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self._max_entries:
+            self._discard(next(iter(self._entries)))
+
+        if self._memory <= self._max_bytes:
+            return
+        # only entries holding content free memory, metadata entries are kept
+        for key in [key for key, entry in self._entries.items() if entry.in_memory]:
+            self._discard(key)
+            if self._memory <= self._max_bytes:
+                break
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.in_memory:
+            self._memory -= entry.size
+
+    def invalidate(self, path: Path) -> None:
+        self._discard(str(path))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._memory = 0
@@ -0,0 +1,159 @@
+"""
+Content negotiation of compressed responses.
+
+Precompressed siblings of a file (style.css.br, style.css.zst, style.css.gz) are served to the clients accepting their
+content coding. Text files without sibling can also be compressed with gzip on the fly, the results being kept in a
+CompressionCache. Compression runs in gevent's thread pool, zlib releases the GIL so the other connections are not
+stalled while a big file is compressed.
+"""
+import gzip
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from gevent import get_hub
+
+from .cache import CachedFile
+
+# content codings of the precompressed siblings, the first ones are preferred when the client accepts several of them
+# with the same quality
+PRECOMPRESSED_ENCODINGS = ('br', 'zstd', 'gzip')
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/manifest+json', 'application/xml', 'application/wasm',
+    'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon',
+}
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if content_type is None:
+        return False
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def parse_accept_encoding(value: str) -> Dict[str, float]:
+    """Returns the quality of each content coding listed in an Accept-Encoding header."""
+    qualities = {}
+    for item in value.split(','):
+        coding, *params = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def get_accepted_encodings(value: str) -> Tuple[str, ...]:
+    """Returns the content codings we know accepted by the client, the preferred ones first."""
+    qualities = parse_accept_encoding(value)
+    default = qualities.get('*', 0.0)
+    accepted = [
+        (qualities.get(encoding, default), index, encoding) for index, encoding in enumerate(PRECOMPRESSED_ENCODINGS)
+    ]
+    return tuple(encoding for quality, _, encoding in sorted(accepted, key=lambda item: (-item[0], item[1]))
+                 if quality > 0)
+
+
+class CompressionCache:
+    """
+    LRU cache of files compressed with gzip on the fly.
+
+    :param max_bytes: maximum amount of compressed data kept in memory.
+    :param max_file_size: files bigger than this size are never compressed on the fly.
+    :param min_size: files smaller than this size are never compressed, the gain does not pay for the work.
+    :param level: gzip compression level, between 1 and 9.
+    :param max_entries: maximum number of files tracked by the cache, including the ones not worth being compressed.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, max_file_size: int = 1024 * 1024, min_size: int = 1024,
+                 level: int = 6, max_entries: int = 10000):
+        for name, value in [('max_bytes', max_bytes), ('max_file_size', max_file_size), ('min_size', min_size),
+                            ('max_entries', max_entries)]:
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(f'{name} must be a positive integer')
+        if not isinstance(level, int) or not 1 <= level <= 9:
+            raise ValueError('level must be an integer between 1 and 9')
+
+        self._max_bytes = max_bytes
+        self._max_file_size = max_file_size
+        self._min_size = min_size
+        self._level = level
+        self._max_entries = max_entries
+        # by path: the ETag of the compressed file and its compressed version, None if compression did not help
+        self._entries: 'OrderedDict[str, Tuple[str, Optional[CachedFile]]]' = OrderedDict()
+        self._memory = 0
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def accepts(self, cached_file: CachedFile) -> bool:
+        """Tells if a file can be compressed on the fly."""
+        return (
+                cached_file.content_encoding is None and is_compressible(cached_file.content_type)
+                and self._min_size <= cached_file.size <= self._max_file_size
+        )
+
+    def get(self, cached_file: CachedFile) -> Optional[CachedFile]:
+        """
+        Returns the gzip version of a file, compressing it if needed, or None if it cannot be or is not worth being
+        compressed.
+        """
+        if not self.accepts(cached_file):
+            return None
+
+        key = str(cached_file.path)
+        item = self._entries.get(key)
+        if item is not None and item[0] == cached_file.etag:
+            self._entries.move_to_end(key)
+            return item[1]
+
+        data = cached_file.data if cached_file.in_memory else self._read(cached_file)
+        if data is None:
+            return None
+        compressed = get_hub().threadpool.apply(gzip.compress, (data, self._level), {'mtime': 0})
+        if len(compressed) >= cached_file.size * 0.9:
+            compressed_file = None
+        else:
+            compressed_file = CachedFile(cached_file.path, len(compressed), cached_file.mtime, compressed,
+                                         time.monotonic(), content_encoding='gzip')
+
+        self._discard(key)  # the entry may have been replaced while compressing
+        self._entries[key] = (cached_file.etag, compressed_file)
+        if compressed_file is not None:
+            self._memory += compressed_file.size
+        self._evict()
+        return compressed_file
+
+    @staticmethod
+    def _read(cached_file: CachedFile) -> Optional[bytes]:
+        try:
+            with cached_file.path.open(mode='rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data if len(data) == cached_file.size else None
+
+    def _evict(self) -> None:
+        while self._memory > self._max_bytes or len(self._entries) > self._max_entries:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: str) -> None:
+        item = self._entries.pop(key, None)
+        if item is not None and item[1] is not None:
+            self._memory -= item[1].size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._memory = 0
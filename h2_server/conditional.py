@@ -0,0 +1,128 @@
+"""
+Conditional and range requests, RFC 9110 Sections 13 and 14.
+
+The validators of a file, its ETag and Last-Modified date, are computed once with its cache entry, so checking a
+request costs a few string comparisons.
+"""
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+# ranges are (first byte, last byte included)
+Range = Tuple[int, int]
+
+# a Range header asking for more ranges than this is ignored, and the whole file is sent
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when none of the ranges asked overlaps the file."""
+
+
+def make_etag(size: int, mtime: int, encoding: str = None) -> str:
+    """
+    Strong ETag of a file given its size and modification time in nanoseconds. The content coding of a compressed
+    representation is part of it, so it never matches the ETag of another representation.
+    """
+    if encoding is None:
+        return f'"{size:x}-{mtime:x}"'
+    return f'"{size:x}-{mtime:x}-{encoding}"'
+
+
+def make_http_date(mtime: int) -> str:
+    return formatdate(mtime // 10 ** 9, usegmt=True)
+
+
+def parse_http_date(value: str) -> Optional[int]:
+    """Returns the timestamp of an HTTP date or None if it is invalid."""
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etags(value: str) -> List[str]:
+    return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+
+def _strip_weak(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(headers: Dict[str, str], etag: str, mtime: int) -> bool:
+    """
+    Tells if a GET or HEAD request can be answered with a 304 response. If-Modified-Since is only looked at when there
+    is no If-None-Match header.
+    """
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = _etags(if_none_match)
+        # weak comparison
+        return '*' in tags or _strip_weak(etag) in (_strip_weak(tag) for tag in tags)
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since is not None:
+        timestamp = parse_http_date(if_modified_since)
+        return timestamp is not None and mtime // 10 ** 9 <= timestamp
+    return False
+
+
+def if_range_matches(headers: Dict[str, str], etag: str, mtime: int) -> bool:
+    """Tells if the Range header must be honoured according to the If-Range header."""
+    if_range = headers.get('if-range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):  # strong comparison, a weak ETag never matches
+        return if_range == etag
+    timestamp = parse_http_date(if_range)
+    return timestamp is not None and mtime // 10 ** 9 == timestamp
+
+
+def parse_ranges(value: str, size: int) -> Optional[List[Range]]:
+    """
+    Parses a Range header for a file of the given size. Returns the ranges to send, sorted and with the overlapping ones
+    merged, or None if the header is invalid or must be ignored. Raises RangeNotSatisfiable if no range overlaps the
+    file.
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:  # suffix range: the last bytes of the file
+                if not last.isdigit():
+                    return None
+                length = int(last)
+                # a zero length suffix is valid but unsatisfiable, RFC 9110 Section 14.1.2
+                if length and size:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if not first.isdigit() or (last and not last.isdigit()) or (end is not None and end < start):
+            return None
+        end = size - 1 if end is None else end
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable(f'bytes */{size}')
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
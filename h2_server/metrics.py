@@ -0,0 +1,48 @@
+"""
+Metrics of the HTTP/2 connections of a process, enabled by setting H2Worker.metrics.
+"""
+from common.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, Registry
+
+
+class H2Metrics:
+    """
+    :param prefix: prefix of the metric names, to tell several servers of the same process apart.
+    """
+
+    def __init__(self, registry: Registry, prefix: str = 'h2'):
+        self.registry = registry
+        self.open_connections = registry.gauge(f'{prefix}_open_connections', 'Connections currently open.')
+        self.connections = registry.counter(f'{prefix}_connections_total', 'Connections accepted.')
+        self.open_streams = registry.gauge(f'{prefix}_open_streams', 'Requests currently being served.')
+        self.streams = registry.counter(f'{prefix}_streams_total', 'Requests received.')
+        self.received_bytes = registry.counter(f'{prefix}_received_bytes_total', 'Bytes received from the clients.')
+        self.sent_bytes = registry.counter(f'{prefix}_sent_bytes_total', 'Bytes sent to the clients.')
+        # h2 does not tell about the frames it parses, the events they produce are the closest we have
+        self.received_events = registry.counter(
+            f'{prefix}_received_events_total', 'Events (requests, window updates, resets...) produced by the frames '
+                                               'received.'
+        )
+        self.sent_frames = registry.counter(f'{prefix}_sent_frames_total', 'HEADERS and DATA frames sent.')
+        self.response_size = registry.histogram(
+            f'{prefix}_response_body_bytes', 'Size of the response bodies.', SIZE_BUCKETS
+        )
+        self.stream_duration = registry.histogram(
+            f'{prefix}_stream_duration_seconds', 'Time from the reception of a request to the end of its response.',
+            LATENCY_BUCKETS
+        )
+        self.flow_control_stall = registry.counter(
+            f'{prefix}_flow_control_stall_seconds_total',
+            'Time spent by connections with data to send and no open flow control window to send it.'
+        )
+        self.pushed_streams = registry.counter(f'{prefix}_pushed_streams_total', 'Responses pushed to the clients.')
+        self.skipped_pushes = registry.counter(
+            f'{prefix}_skipped_pushes_total', 'Resources of the push manifest not pushed because the client already '
+                                              'had them.'
+        )
+        self.handshake_duration = registry.histogram(
+            f'{prefix}_tls_handshake_seconds', 'Duration of the TLS handshakes.', LATENCY_BUCKETS
+        )
+        self.resumed_handshakes = registry.counter(
+            f'{prefix}_tls_resumed_handshakes_total', 'TLS handshakes resuming a previous session.'
+        )
+        self.failed_handshakes = registry.counter(f'{prefix}_tls_failed_handshakes_total', 'TLS handshakes failed.')
@@ -0,0 +1,163 @@
+"""
+Scheduling of the DATA frames of the streams of an HTTP/2 connection.
+
+Streams don't write their DATA frames themselves: they queue the data to send and a single sender greenlet picks, frame
+after frame, the stream to serve next. The choice follows the extensible priorities of RFC 9218:
+
+- the streams with the lowest urgency (0 to 7) are served first, the others wait.
+- among streams of the same urgency, non incremental ones are sent one after the other, in the order they were opened.
+- incremental streams of the same urgency share the bandwidth with a smooth weighted round-robin.
+
+Urgency and incremental flag come from the `priority` request header. Without it, a stream is not incremental (the
+RFC 9218 default). The weight of an incremental stream is the one of the RFC 7540 PRIORITY information sent by the
+client, if any. Dependencies between streams, which RFC 9113 deprecates, are ignored. When the client gives no urgency,
+it is guessed from the content type of the response, so that the documents and stylesheets blocking the rendering of a
+page get ahead of images and videos.
+"""
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from gevent.event import AsyncResult, Event
+from h2.exceptions import StreamClosedError
+
+DEFAULT_URGENCY = 3
+DEFAULT_WEIGHT = 16  # RFC 7540 Section 5.3.5
+
+# urgency of the responses whose request did not give one
+CONTENT_TYPE_URGENCY = {
+    'text/html': 1,
+    'text/css': 1,
+    'text/javascript': 2,
+    'application/javascript': 2,
+    'application/json': 2,
+}
+
+
+def parse_priority_header(value: str) -> Tuple[Optional[int], Optional[bool]]:
+    """
+    Returns the urgency and incremental flag of a `priority` header (RFC 9218 Section 4), None for the missing or
+    invalid ones.
+    """
+    urgency = incremental = None
+    for member in value.split(','):
+        key, _, item = member.strip().partition('=')
+        item = item.split(';')[0].strip()  # parameters are ignored
+        if key == 'u':
+            if item.isdigit() and 0 <= int(item) <= 7:
+                urgency = int(item)
+        elif key == 'i':
+            if not item or item == '?1':
+                incremental = True
+            elif item == '?0':
+                incremental = False
+    return urgency, incremental
+
+
+class StreamState:
+    """Priority and data waiting to be sent of a stream."""
+    __slots__ = ('stream_id', 'urgency', 'incremental', 'weight', 'explicit_urgency', 'pending', 'offset', 'current')
+
+    def __init__(self, stream_id: int, urgency: Optional[int], incremental: Optional[bool], weight: int):
+        self.stream_id = stream_id
+        self.explicit_urgency = urgency is not None
+        self.urgency = DEFAULT_URGENCY if urgency is None else urgency
+        self.incremental = False if incremental is None else incremental
+        self.weight = weight
+        # views to send with their end_stream flag and the result set once they are sent
+        self.pending: Deque[Tuple[memoryview, bool, AsyncResult]] = deque()
+        self.offset = 0  # bytes of the first pending view already sent
+        self.current = 0  # smooth weighted round-robin counter
+
+
+class StreamScheduler:
+    """Per-connection queues of the streams and choice of the next one to send a DATA frame for."""
+
+    def __init__(self):
+        self._streams: Dict[int, StreamState] = {}
+        self._wakeup = Event()
+
+    def __contains__(self, stream_id: int) -> bool:
+        return stream_id in self._streams
+
+    def add(self, stream_id: int, urgency: int = None, incremental: bool = None, weight: int = DEFAULT_WEIGHT) -> None:
+        self._streams[stream_id] = StreamState(stream_id, urgency, incremental, weight)
+
+    def get(self, stream_id: int) -> Optional[StreamState]:
+        return self._streams.get(stream_id)
+
+    def set_weight(self, stream_id: int, weight: int) -> None:
+        """Applies the weight of an RFC 7540 PRIORITY frame."""
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            stream.weight = weight
+
+    def guess_urgency(self, stream_id: int, content_type: Optional[str]) -> None:
+        """Sets the urgency of a stream from the content type of its response, unless the client gave one."""
+        stream = self._streams.get(stream_id)
+        if stream is not None and not stream.explicit_urgency and content_type is not None:
+            stream.urgency = CONTENT_TYPE_URGENCY.get(content_type, DEFAULT_URGENCY)
+
+    def push(self, stream_id: int, view: memoryview, end_stream: bool) -> AsyncResult:
+        """
+        Queues data to send on a stream. The returned result is set once it is sent, or fails with a StreamClosedError
+        if the stream is removed before.
+        """
+        result = AsyncResult()
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            result.set_exception(StreamClosedError(stream_id))
+            return result
+        stream.pending.append((view, end_stream, result))
+        self._wakeup.set()
+        return result
+
+    def has_pending(self) -> bool:
+        """Tells if a stream has data waiting to be sent."""
+        return any(stream.pending for stream in self._streams.values())
+
+    def remove(self, stream_id: int) -> None:
+        """Forgets a stream, the greenlets waiting for its data to be sent get a StreamClosedError."""
+        stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return
+        for _, _, result in stream.pending:
+            result.set_exception(StreamClosedError(stream_id))
+        stream.pending.clear()
+
+    def clear(self) -> None:
+        for stream_id in list(self._streams):
+            self.remove(stream_id)
+
+    def wake(self) -> None:
+        """To call when something may have made a stream ready, like a window update."""
+        self._wakeup.set()
+
+    def wait(self) -> None:
+        """Blocks until data is queued or wake is called."""
+        self._wakeup.wait()
+        self._wakeup.clear()
+
+    def next_stream(self, is_ready: Callable[[StreamState], bool]) -> Optional[StreamState]:
+        """
+        Returns the stream to send the next DATA frame for, among those having data to send and for which is_ready
+        returns True (typically because their flow control window is open), or None if there is none.
+        """
+        ready = [stream for stream in self._streams.values() if stream.pending and is_ready(stream)]
+        if not ready:
+            return None
+
+        urgency = min(stream.urgency for stream in ready)
+        candidates = [stream for stream in ready if stream.urgency == urgency]
+        sequential = [stream for stream in candidates if not stream.incremental]
+        if sequential:
+            return min(sequential, key=lambda stream: stream.stream_id)
+
+        total = 0
+        best = None
+        for stream in candidates:
+            stream.current += stream.weight
+            total += stream.weight
+            if best is None or stream.current > best.current:
+                best = stream
+        best.current -= total
+        return best
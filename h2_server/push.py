@@ -0,0 +1,193 @@
+"""
+Server push of the critical subresources of HTML pages, RFC 9113 Section 8.4.
+
+A manifest maps the path of each page to the stylesheets, scripts and fonts it needs to render. It is either built by
+scanning the served directory when the server starts, or loaded from a JSON file mapping paths to lists of paths:
+
+    {"/index.html": ["/css/site.css", "/js/app.js", "/fonts/text.woff2"]}
+
+Pushing a resource the client already has wastes the bandwidth the page needs, so it is skipped when:
+- the client disabled push with SETTINGS_ENABLE_PUSH.
+- it was already requested or pushed on the connection.
+- the push cookie of the client lists it. The response of a page carries a cookie holding a short digest of the path and
+ETag of each of its resources, so a resource is pushed again when it changes.
+"""
+import hashlib
+import json
+import re
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from urllib.parse import urljoin, urlsplit
+
+PUSH_COOKIE = 'h2push'
+# lifetime of the push cookie in seconds, a week like the usual lifetime of cached assets
+PUSH_COOKIE_MAX_AGE = 7 * 24 * 3600
+# digests kept in the cookie, the ones of the last pages visited come first
+MAX_COOKIE_DIGESTS = 32
+DIGEST_SIZE = 4  # bytes, 8 hexadecimal characters per resource in the cookie
+
+HTML_SUFFIXES = {'.html', '.htm'}
+FONT_SUFFIXES = {'.woff2', '.woff', '.ttf', '.otf'}
+# resources preloaded with <link rel="preload"> are pushed whatever their type
+PRELOAD_RELS = {'preload', 'modulepreload'}
+
+_FONT_FACE = re.compile(r'@font-face\s*{[^}]*}', re.IGNORECASE)
+_CSS_URL = re.compile(r'''url\(\s*['"]?([^'")\s]+)['"]?\s*\)''', re.IGNORECASE)
+
+
+class _SubresourceParser(HTMLParser):
+    """Collects the URLs of the stylesheets, scripts and preloaded resources of a page, in document order."""
+
+    def __init__(self):
+        super().__init__()
+        self.urls: List[str] = []
+        self.stylesheets: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        attributes = dict(attrs)
+        if tag == 'link':
+            rels = set((attributes.get('rel') or '').lower().split())
+            href = attributes.get('href')
+            if not href:
+                return
+            if 'stylesheet' in rels and 'alternate' not in rels:
+                self.urls.append(href)
+                self.stylesheets.append(href)
+            elif rels & PRELOAD_RELS:
+                self.urls.append(href)
+        elif tag == 'script':
+            # asynchronous scripts don't block the rendering
+            if attributes.get('src') and 'async' not in attributes:
+                self.urls.append(attributes['src'])
+
+
+def _local_path(base: str, url: str) -> Optional[str]:
+    """Returns the path of url relative to the page or stylesheet at base, or None if it is on another origin."""
+    parts = urlsplit(urljoin(base, url.strip()))
+    if parts.scheme or parts.netloc:
+        return None
+    return parts.path
+
+
+class PushManifest:
+    """
+    :param resources: paths of the resources to push, by path of page. Paths are the ones of the URLs, starting with
+    a slash.
+    """
+
+    def __init__(self, resources: Dict[str, List[str]]):
+        self._resources: Dict[str, List[str]] = {}
+        for page, paths in resources.items():
+            if not isinstance(page, str) or not page.startswith('/'):
+                raise ValueError(f'{page!r} is not a path starting with a slash')
+            if not isinstance(paths, list) or not all(isinstance(p, str) and p.startswith('/') for p in paths):
+                raise ValueError(f'the resources of {page} must be a list of paths starting with a slash')
+            # duplicates and the page itself are dropped, the order is kept
+            paths = [p for p in dict.fromkeys(paths) if p != page]
+            if paths:
+                self._resources[page] = paths
+        self.paths: Set[str] = {path for paths in self._resources.values() for path in paths}
+
+    def __len__(self) -> int:
+        return len(self._resources)
+
+    def get(self, page: str) -> List[str]:
+        return self._resources.get(page, [])
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'PushManifest':
+        """Loads a manifest from a JSON file."""
+        with open(path, encoding='utf-8') as f:
+            resources = json.load(f)
+        if not isinstance(resources, dict):
+            raise ValueError(f'{path} must hold a JSON object')
+        return cls(resources)
+
+    @classmethod
+    def scan(cls, source_dir: Union[str, Path], max_resources: int = 16) -> 'PushManifest':
+        """
+        Builds the manifest of the HTML files of a directory and its subdirectories. The resources of a page are the
+        stylesheets, the scripts not loaded asynchronously, the preloaded resources and the fonts of the @font-face
+        rules of its stylesheets, as long as they are files of the directory.
+
+        :param max_resources: maximum number of resources pushed for a page, the first ones in document order are kept.
+        """
+        if not isinstance(max_resources, int) or max_resources < 1:
+            raise ValueError('max_resources must be a strictly positive integer')
+        source_dir = Path(source_dir)
+        fonts_by_stylesheet: Dict[str, List[str]] = {}
+        resources = {}
+        for file in sorted(source_dir.rglob('*')):
+            if file.suffix.lower() not in HTML_SUFFIXES or not file.is_file():
+                continue
+            page = '/' + file.relative_to(source_dir).as_posix()
+            parser = _SubresourceParser()
+            try:
+                parser.feed(file.read_text(encoding='utf-8', errors='replace'))
+            except OSError:
+                continue
+
+            paths = []
+            for url in parser.urls:
+                path = _local_path(page, url)
+                if path is not None and _is_file(source_dir, path):
+                    paths.append(path)
+            for url in parser.stylesheets:
+                stylesheet = _local_path(page, url)
+                if stylesheet is None or not _is_file(source_dir, stylesheet):
+                    continue
+                if stylesheet not in fonts_by_stylesheet:
+                    fonts_by_stylesheet[stylesheet] = _scan_fonts(source_dir, stylesheet)
+                paths.extend(fonts_by_stylesheet[stylesheet])
+            paths = list(dict.fromkeys(paths))[:max_resources]
+            if paths:
+                resources[page] = paths
+        return cls(resources)
+
+
+def _is_file(source_dir: Path, path: str) -> bool:
+    # same mapping from URL path to file as the server
+    return (source_dir / path.lstrip('/')).is_file()
+
+
+def _scan_fonts(source_dir: Path, stylesheet: str) -> List[str]:
+    """Returns the paths of the fonts declared by the @font-face rules of a stylesheet."""
+    try:
+        css = (source_dir / stylesheet.lstrip('/')).read_text(encoding='utf-8', errors='replace')
+    except OSError:
+        return []
+    fonts = []
+    for rule in _FONT_FACE.findall(css):
+        for url in _CSS_URL.findall(rule):
+            path = _local_path(stylesheet, url)
+            if path is not None and Path(path).suffix.lower() in FONT_SUFFIXES and _is_file(source_dir, path):
+                fonts.append(path)
+    return fonts
+
+
+def resource_digest(path: str, etag: str) -> str:
+    """Digest of a version of a resource, as stored in the push cookie."""
+    return hashlib.blake2b(f'{path} {etag}'.encode(), digest_size=DIGEST_SIZE).hexdigest()
+
+
+def get_cookie_digests(headers: Iterable[Tuple[str, str]]) -> List[str]:
+    """
+    Returns the digests of the push cookie of a request. HTTP/2 clients may split the cookies in several headers.
+    """
+    for name, value in headers:
+        if name != 'cookie':
+            continue
+        for cookie in value.split(';'):
+            key, _, digests = cookie.strip().partition('=')
+            if key == PUSH_COOKIE:
+                size = DIGEST_SIZE * 2
+                return [digests[i:i + size] for i in range(0, len(digests), size)]
+    return []
+
+
+def make_push_cookie(digests: List[str], secure: bool) -> str:
+    """Returns the value of the set-cookie header storing the given digests."""
+    value = ''.join(digests[:MAX_COOKIE_DIGESTS])
+    cookie = f'{PUSH_COOKIE}={value}; Path=/; Max-Age={PUSH_COOKIE_MAX_AGE}; HttpOnly; SameSite=Lax'
+    return f'{cookie}; Secure' if secure else cookie
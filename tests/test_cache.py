@@ -0,0 +1,146 @@
+import os
+
+import pytest
+
+from h2_server.cache import FileCache
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    def make(name: str, size: int, content: bytes = None):
+        path = tmp_path / name
+        path.write_bytes(content if content is not None else b'x' * size)
+        return path
+
+    return make
+
+
+def touch(path, mtime_ns: int) -> None:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'max_bytes': -1}, {'max_file_size': 1.5}, {'max_entries': None}, {'check_interval': -1}
+])
+def test_invalid_settings(kwargs):
+    with pytest.raises(ValueError):
+        FileCache(**kwargs)
+
+
+def test_get_missing_file_and_directory(tmp_path):
+    cache = FileCache()
+    assert cache.get(tmp_path / 'missing.txt') is None
+    assert cache.get(tmp_path) is None
+    assert len(cache) == 0
+
+
+def test_small_file_is_kept_in_memory(make_file):
+    cache = FileCache()
+    path = make_file('style.css', 0, b'body {}')
+    entry = cache.get(path)
+
+    assert entry.in_memory
+    assert bytes(entry.data) == b'body {}'
+    assert entry.content_type == 'text/css'
+    assert ('content-length', '7') in entry.headers
+    assert cache.memory == 7
+    assert cache.get(path) is entry
+
+
+def test_big_file_only_keeps_metadata(make_file):
+    cache = FileCache(max_file_size=10)
+    entry = cache.get(make_file('big.bin', 11))
+
+    assert not entry.in_memory
+    assert entry.size == 11
+    assert cache.memory == 0
+    assert len(cache) == 1
+
+
+def test_least_recently_used_contents_are_evicted_first(make_file):
+    cache = FileCache(max_bytes=25)
+    first, second, third = (make_file(name, 10) for name in ('a', 'b', 'c'))
+    cache.get(first)
+    cache.get(second)
+    cache.get(first)  # second becomes the least recently used
+    cache.get(third)
+
+    assert cache.memory == 20
+    assert cache.get(first).in_memory and cache.get(third).in_memory
+    assert len(cache) == 2
+
+
+def test_metadata_entries_are_kept_when_memory_is_freed(make_file):
+    cache = FileCache(max_bytes=15, max_file_size=10)
+    big = cache.get(make_file('big', 100))
+    cache.get(make_file('a', 10))
+    cache.get(make_file('b', 10))
+
+    assert cache.memory == 10
+    assert len(cache) == 2
+    assert cache.get(big.path) is big
+
+
+def test_max_entries(make_file):
+    cache = FileCache(max_entries=2)
+    paths = [make_file(name, 1) for name in ('a', 'b', 'c')]
+    for path in paths:
+        cache.get(path)
+
+    assert len(cache) == 2
+    assert cache.memory == 2
+
+
+def test_entry_is_trusted_during_check_interval(make_file):
+    cache = FileCache(check_interval=3600)
+    path = make_file('page.html', 0, b'old')
+    entry = cache.get(path)
+    path.write_bytes(b'new content')
+
+    assert cache.get(path) is entry
+
+
+def test_modified_file_is_reloaded(make_file):
+    cache = FileCache(check_interval=0)
+    path = make_file('page.html', 0, b'old')
+    touch(path, 10 ** 18)
+    entry = cache.get(path)
+    assert cache.get(path) is entry  # checked again, but not modified
+
+    path.write_bytes(b'new content')
+    touch(path, 2 * 10 ** 18)
+    reloaded = cache.get(path)
+
+    assert reloaded is not entry
+    assert bytes(reloaded.data) == b'new content'
+    assert reloaded.etag != entry.etag
+    assert cache.memory == len(b'new content')
+
+
+def test_deleted_file_is_invalidated(make_file):
+    cache = FileCache(check_interval=0)
+    path = make_file('page.html', 5)
+    cache.get(path)
+    path.unlink()
+
+    assert cache.get(path) is None
+    assert len(cache) == 0
+    assert cache.memory == 0
+
+
+def test_precompressed_sibling(make_file):
+    cache = FileCache(check_interval=0)
+    path = make_file('app.js', 100)
+    touch(path, 10 ** 18)
+    entry = cache.get(path)
+    assert cache.get_precompressed(entry, 'gzip') is None
+
+    sibling = make_file('app.js.gz', 20)
+    touch(sibling, 10 ** 18 - 1)  # older than the file, it is stale
+    assert cache.get_precompressed(entry, 'gzip') is None
+
+    touch(sibling, 10 ** 18)
+    compressed = cache.get_precompressed(entry, 'gzip')
+    assert compressed.content_encoding == 'gzip'
+    assert compressed.content_type in ('text/javascript', 'application/javascript')
+    assert compressed.etag != entry.etag
@@ -0,0 +1,67 @@
+import gevent
+import pytest
+
+from common.timer_wheel import Timer
+from websockets.client import Client
+from websockets.server import BaseServer
+
+
+class SilentServer(BaseServer):
+    """Accepts the connections and never answers."""
+
+    def handle_request(self, request) -> None:
+        self.accept_request()
+
+    def handle_pong(self, data: bytes) -> None:
+        pass
+
+    def receive_text(self, data: str) -> None:
+        pass
+
+    def receive_bytes(self, data: bytes) -> None:
+        pass
+
+    def receive_json(self, data) -> None:
+        pass
+
+
+@pytest.fixture
+def client():
+    server = SilentServer('127.0.0.1', 0)
+    runner = gevent.spawn(server.run)
+    while server._server is None or not server._server.started:
+        gevent.sleep(0.01)
+    client = Client(f'ws://localhost:{server._server.server_port}/')
+    yield client
+    client.close()
+    server.close()
+    runner.join(timeout=5)
+
+
+def pending_timer(client: Client) -> Timer:
+    (_, timer), = client._pending_requests.values()
+    return timer
+
+
+def test_request_times_out(client):
+    result = client.request_json({'op': 'nothing'}, timeout=0.2)
+    timer = pending_timer(client)
+    assert isinstance(timer, Timer) and timer.active  # a timer of the shared wheel, not of the loop
+
+    with pytest.raises(TimeoutError):
+        result.get(timeout=2)
+    assert not client._pending_requests
+    assert not timer.active
+
+
+def test_pending_request_fails_when_the_connection_closes(client):
+    result = client.request_json({'op': 'nothing'}, timeout=60)
+    timer = pending_timer(client)
+    client.close()
+
+    with pytest.raises(ConnectionError):
+        result.get(timeout=2)
+    assert not client._pending_requests
+    assert not timer.active
+    with pytest.raises(ConnectionError):
+        client.request_json({'op': 'nothing'})
@@ -0,0 +1,100 @@
+import pytest
+
+from h2_server.conditional import (
+    MAX_RANGES, RangeNotSatisfiable, if_range_matches, is_not_modified, make_etag, make_http_date, parse_ranges
+)
+
+MTIME = 1_700_000_000 * 10 ** 9
+ETAG = make_etag(1000, MTIME)
+
+
+@pytest.mark.parametrize(('value', 'ranges'), [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=900-', [(900, 999)]),  # open-ended
+    ('bytes=-100', [(900, 999)]),  # suffix
+    ('bytes=-5000', [(0, 999)]),  # suffix longer than the file
+    ('bytes=990-5000', [(990, 999)]),  # last byte beyond the file
+    ('bytes=0-0, -1', [(0, 0), (999, 999)]),
+    (' Bytes = 0-9', [(0, 9)]),
+])
+def test_parse_ranges(value, ranges):
+    assert parse_ranges(value, 1000) == ranges
+
+
+@pytest.mark.parametrize(('value', 'ranges'), [
+    ('bytes=50-99, 0-49', [(0, 99)]),  # adjacent, sorted then merged
+    ('bytes=0-100, 50-60', [(0, 100)]),  # contained
+    ('bytes=0-10, 5-20, 30-40', [(0, 20), (30, 40)]),  # overlapping
+    ('bytes=-10, 995-', [(990, 999)]),
+    ('bytes=500-, 2000-3000', [(500, 999)]),  # unsatisfiable ranges are dropped
+])
+def test_overlapping_ranges_are_merged(value, ranges):
+    assert parse_ranges(value, 1000) == ranges
+
+
+@pytest.mark.parametrize('value', [
+    'items=0-10',
+    'bytes=',
+    'bytes=10',
+    'bytes=10-5',
+    'bytes=a-b',
+    'bytes=-',
+    'bytes=--5',
+    'bytes=+1-5',
+    'bytes=1-+5',
+    'bytes=-+5',
+])
+def test_invalid_ranges_are_ignored(value):
+    assert parse_ranges(value, 1000) is None
+
+
+def test_too_many_ranges_are_ignored():
+    specs = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(MAX_RANGES))
+    assert len(parse_ranges(f'bytes={specs}', 1000)) == MAX_RANGES
+    assert parse_ranges(f'bytes={specs},500-501', 1000) is None
+
+
+@pytest.mark.parametrize(('value', 'size'), [
+    ('bytes=1000-', 1000),
+    ('bytes=1000-2000, 3000-', 1000),
+    ('bytes=-0', 1000),  # a zero length suffix is unsatisfiable
+    ('bytes=0-10', 0),
+    ('bytes=-10', 0),
+])
+def test_unsatisfiable_ranges(value, size):
+    with pytest.raises(RangeNotSatisfiable) as exc_info:
+        parse_ranges(value, size)
+    assert str(exc_info.value) == f'bytes */{size}'
+
+
+def test_make_etag():
+    assert make_etag(255, 16) == '"ff-10"'
+    assert make_etag(255, 16, 'gzip') == '"ff-10-gzip"'
+
+
+@pytest.mark.parametrize(('headers', 'not_modified'), [
+    ({}, False),
+    ({'if-none-match': ETAG}, True),
+    ({'if-none-match': f'"other", W/{ETAG}'}, True),  # weak comparison
+    ({'if-none-match': '*'}, True),
+    ({'if-none-match': '"other"'}, False),
+    ({'if-modified-since': make_http_date(MTIME)}, True),
+    ({'if-modified-since': make_http_date(MTIME - 10 ** 9)}, False),
+    ({'if-modified-since': 'not a date'}, False),
+    # If-Modified-Since is ignored when If-None-Match is there
+    ({'if-none-match': '"other"', 'if-modified-since': make_http_date(MTIME)}, False),
+])
+def test_is_not_modified(headers, not_modified):
+    assert is_not_modified(headers, ETAG, MTIME) is not_modified
+
+
+@pytest.mark.parametrize(('headers', 'matches'), [
+    ({}, True),
+    ({'if-range': ETAG}, True),
+    ({'if-range': f'W/{ETAG}'}, False),  # strong comparison
+    ({'if-range': '"other"'}, False),
+    ({'if-range': make_http_date(MTIME)}, True),
+    ({'if-range': make_http_date(MTIME + 10 ** 9)}, False),
+])
+def test_if_range_matches(headers, matches):
+    assert if_range_matches(headers, ETAG, MTIME) is matches
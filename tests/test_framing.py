@@ -0,0 +1,120 @@
+import os
+
+import pytest
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import AcceptConnection, BytesMessage, Message, Request, TextMessage
+
+from websockets import framing
+from websockets.framing import (
+    BINARY_OPCODE, CONTINUATION_OPCODE, INT_MASKING_MAX_SIZE, TEXT_OPCODE, encode_data_frame, encode_frame,
+    get_masking_key, iter_frames, mask_payload
+)
+
+# around the limits of the 7 bits, 16 bits and 64 bits lengths and of the big integer masking
+SIZES = [0, 1, 3, 4, 5, 125, 126, 127, INT_MASKING_MAX_SIZE - 1, INT_MASKING_MAX_SIZE, INT_MASKING_MAX_SIZE + 1,
+         65535, 65536, 70001]
+
+
+def open_connections():
+    client, server = WSConnection(ConnectionType.CLIENT), WSConnection(ConnectionType.SERVER)
+    server.receive_data(client.send(Request(host='localhost', target='/')))
+    next(server.events())
+    client.receive_data(server.send(AcceptConnection()))
+    next(client.events())
+    return client, server
+
+
+def header_size(length: int) -> int:
+    return 2 + (0 if length < 126 else 2 if length < 1 << 16 else 8)
+
+
+def receive(ws: WSConnection, data: bytes) -> list:
+    ws.receive_data(data)
+    return list(ws.events())
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_server_frames_match_wsproto(size):
+    _, server = open_connections()
+    payload = os.urandom(size)
+    assert encode_frame(payload) == server.send(Message(payload))
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_client_frames_match_wsproto(size, monkeypatch):
+    client, _ = open_connections()
+    payload = os.urandom(size)
+    expected = client.send(Message(payload))
+    # the frame of wsproto gives the random key it used
+    key_offset = header_size(size)
+    monkeypatch.setattr(framing, 'get_masking_key', lambda: expected[key_offset:key_offset + 4])
+    assert encode_frame(payload, mask=True) == expected
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_masked_frames_are_parsed_by_wsproto(size):
+    _, server = open_connections()
+    payload = os.urandom(size)
+    events = receive(server, encode_frame(payload, mask=True))
+    assert len(events) == 1
+    assert isinstance(events[0], BytesMessage)
+    assert events[0].data == payload
+
+
+def test_text_frame():
+    _, server = open_connections()
+    text = 'héllo wörld ' * 20
+    assert encode_frame(text) == server.send(Message(text))
+    _, server = open_connections()
+    events = receive(server, encode_frame(text, mask=True))
+    assert isinstance(events[0], TextMessage)
+    assert events[0].data == text
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('key', [b'\x00\x00\x00\x00', b'\xff\xff\xff\xff', b'\x01\x02\x03\x04', b'\xa5\x00\x5a\xff'])
+def test_mask_payload(size, key):
+    payload = os.urandom(size)
+    expected = bytes(byte ^ key[index % 4] for index, byte in enumerate(payload))
+    masked = mask_payload(payload, key)
+    assert bytes(masked) == expected
+    assert bytes(mask_payload(masked, key)) == payload
+
+
+@pytest.mark.parametrize('size', [10, INT_MASKING_MAX_SIZE + 10])
+def test_mask_payload_accepts_memoryviews(size):
+    payload = os.urandom(size)
+    key = b'\x12\x34\x56\x78'
+    assert bytes(mask_payload(memoryview(payload), key)) == bytes(mask_payload(payload, key))
+
+
+def test_encode_data_frame_headers():
+    assert encode_data_frame(b'ab', TEXT_OPCODE) == b'\x81\x02ab'
+    assert encode_data_frame(b'ab', BINARY_OPCODE, fin=False) == b'\x02\x02ab'
+    assert encode_data_frame(b'', CONTINUATION_OPCODE) == b'\x80\x00'
+    assert encode_data_frame(b'a' * 126, BINARY_OPCODE)[:4] == b'\x82\x7e\x00\x7e'
+    assert encode_data_frame(b'a' * 65536, BINARY_OPCODE)[:10] == b'\x82\x7f' + (65536).to_bytes(8, 'big')
+    assert encode_data_frame(b'a', BINARY_OPCODE, mask=True)[1] == 0x81
+
+
+def test_masking_keys_are_not_repeated():
+    keys = {get_masking_key() for _ in range(3 * framing.MASKING_KEYS_BATCH)}
+    assert all(len(key) == 4 for key in keys)
+    # a collision among a few thousand random 32 bits keys is possible, but very unlikely
+    assert len(keys) > 3 * framing.MASKING_KEYS_BATCH - 10
+
+
+@pytest.mark.parametrize('mask', [False, True])
+@pytest.mark.parametrize('data', [os.urandom(70000), 'ça va ' * 5000], ids=['bytes', 'text'])
+def test_fragmented_messages_are_parsed_by_wsproto(data, mask):
+    client, server = open_connections()
+    frames = list(iter_frames(data, 16384, mask))
+    assert len(frames) == -(-len(data) // 16384)
+    events = receive(server if mask else client, b''.join(frames))
+    assert [event.message_finished for event in events] == [False] * (len(events) - 1) + [True]
+    assert data[:0].join(event.data for event in events) == data
+
+
+def test_encode_frame_rejects_other_types():
+    with pytest.raises(TypeError):
+        encode_frame(42)
@@ -0,0 +1,92 @@
+import gevent
+import pytest
+from gevent import socket
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import DataReceived
+
+from h2_server import H2Worker
+
+
+@pytest.fixture
+def hub_errors(monkeypatch):
+    """Errors of the greenlets reported to the hub, they would be printed with their traceback."""
+    errors = []
+    hub = gevent.get_hub()
+    monkeypatch.setattr(hub, 'handle_error', lambda context, kind, value, tb: errors.append(value))
+    return errors
+
+
+@pytest.fixture
+def connect(tmp_path):
+    (tmp_path / 'big.bin').write_bytes(b'x' * 1024 * 1024)
+    workers = []
+
+    def serve(sock: socket.socket) -> None:
+        # the socket is closed by the server once the worker returns
+        try:
+            H2Worker(sock, ('127.0.0.1', 0), source_dir=str(tmp_path))
+        finally:
+            sock.close()
+
+    def connect():
+        """Returns a cleartext connection to a worker and an h2 client which sent its preface."""
+        with socket.socket() as listener:  # TCP, the worker sets TCP_NODELAY
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            client_sock = socket.create_connection(listener.getsockname())
+            server_sock, _ = listener.accept()
+        workers.append(gevent.spawn(serve, server_sock))
+        client = H2Connection(H2Configuration(client_side=True, header_encoding='utf-8'))
+        client.initiate_connection()
+        return client_sock, client
+
+    yield connect
+    gevent.joinall(workers, timeout=5, raise_error=True)
+    assert all(worker.dead for worker in workers)
+
+
+def request(client: H2Connection, path: str) -> None:
+    client.send_headers(client.get_next_available_stream_id(), [
+        (':method', 'GET'), (':path', path), (':scheme', 'http'), (':authority', 'localhost')
+    ], end_stream=True)
+
+
+def read_until_closed(sock: socket.socket) -> None:
+    try:
+        while sock.recv(65535):
+            pass
+    except ConnectionResetError:  # the server closed with data of ours left unread
+        pass
+    sock.close()
+
+
+def test_streams_started_after_goaway_end_quietly(connect, hub_errors):
+    sock, client = connect()
+    sock.sendall(client.data_to_send())
+    client.receive_data(sock.recv(65535))  # once the server sent its preface, its sender greenlet is running
+    for _ in range(5):
+        request(client, '/big.bin')
+    # the requests and the GOAWAY arrive together: the stream greenlets only start while the sender is stopped,
+    # when h2 already considers the connection closed
+    client.close_connection()
+    sock.sendall(client.data_to_send())
+    sock.shutdown(socket.SHUT_WR)
+    read_until_closed(sock)
+    gevent.sleep(0.1)
+    assert hub_errors == []
+
+
+def test_connection_closed_while_streams_send(connect, hub_errors):
+    sock, client = connect()
+    for _ in range(5):
+        request(client, '/big.bin')
+    sock.sendall(client.data_to_send())
+
+    received = False
+    while not received:  # waits until the streams are sending their DATA frames
+        events = client.receive_data(sock.recv(65535))
+        received = any(isinstance(event, DataReceived) for event in events)
+    sock.close()
+    gevent.sleep(0.1)
+    assert hub_errors == []
@@ -0,0 +1,43 @@
+import pytest
+
+from common.metrics import Metric, Registry, render_prometheus
+
+
+def test_metric_without_samples_cannot_be_created():
+    class Incomplete(Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete('incomplete', 'Forgets to give its samples.')
+
+
+def test_names_are_unique():
+    registry = Registry()
+    registry.counter('requests_total', 'Requests.')
+    with pytest.raises(ValueError):
+        registry.gauge('requests_total', 'Requests.')
+
+
+def test_render_prometheus():
+    registry = Registry()
+    registry.counter('requests_total', 'Requests received.').inc(2)
+    registry.gauge('open_connections', 'Connections open.', function=lambda: 1.5)
+    histogram = registry.histogram('duration_seconds', 'Durations.', buckets=(1, 2))
+    histogram.observe(1)
+    histogram.observe(3)
+
+    assert render_prometheus(registry) == (
+        '# HELP requests_total Requests received.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total 2\n'
+        '# HELP open_connections Connections open.\n'
+        '# TYPE open_connections gauge\n'
+        'open_connections 1.5\n'
+        '# HELP duration_seconds Durations.\n'
+        '# TYPE duration_seconds histogram\n'
+        'duration_seconds_bucket{le="1"} 1\n'
+        'duration_seconds_bucket{le="2"} 1\n'
+        'duration_seconds_bucket{le="+Inf"} 2\n'
+        'duration_seconds_sum 4\n'
+        'duration_seconds_count 2\n'
+    )
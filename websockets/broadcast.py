@@ -0,0 +1,170 @@
+"""
+Topic based broadcast of messages to the sessions of a websocket server.
+
+A published message is framed once with websockets.framing.encode_frame and the same bytes are queued for every
+subscriber. Each subscriber has a bounded queue emptied by its own greenlet, so a slow client never blocks the
+publisher nor the other subscribers: when its queue is full, the slow consumer policy of the hub applies.
+Frames are sent uncompressed, which permessage-deflate allows even when it was negotiated.
+"""
+from collections import deque
+from enum import Enum
+from typing import TYPE_CHECKING, Deque, Dict, Iterable, Optional, Set, Tuple, Union
+
+from gevent import Greenlet, spawn
+from wsproto.connection import ConnectionState
+
+from .framing import encode_frame
+
+if TYPE_CHECKING:
+    from .server import Session
+
+
+class SlowConsumerPolicy(Enum):
+    """
+    What happens when a message is published to a subscriber whose queue is full.
+
+    DROP: the new message is not sent to this subscriber.
+    DISCONNECT: the connection of the subscriber is shut down.
+    COALESCE: the new message replaces the last queued message of the same topic, or the oldest queued message if there
+    is none, so the subscriber only gets the latest messages when it catches up.
+    """
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+    COALESCE = 'coalesce'
+
+
+class Subscriber:
+    """Topics and queue of frames of a session."""
+
+    def __init__(self, session: 'Session', max_queue: int, policy: SlowConsumerPolicy):
+        self.session = session
+        self.topics: Set[str] = set()
+        self.dropped = 0  # messages not sent because the queue was full
+        self._max_queue = max_queue
+        self._policy = policy
+        self._queue: Deque[Tuple[Optional[str], bytes]] = deque()
+        self._pump: Optional[Greenlet] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def put(self, topic: Optional[str], frame: bytes) -> bool:
+        """
+        Queues a frame without blocking. Returns False if it was dropped or if the session was disconnected.
+        """
+        if len(self._queue) >= self._max_queue:
+            if self._policy is SlowConsumerPolicy.DISCONNECT:
+                self._queue.clear()
+                self.session.abort()
+                return False
+            self.dropped += 1
+            if self._policy is SlowConsumerPolicy.DROP:
+                return False
+            self._coalesce(topic, frame)
+        else:
+            self._queue.append((topic, frame))
+
+        if self._pump is None:
+            self._pump = spawn(self._send_queue)
+        return True
+
+    def _coalesce(self, topic: Optional[str], frame: bytes) -> None:
+        for index in range(len(self._queue) - 1, -1, -1):
+            if self._queue[index][0] == topic:
+                self._queue[index] = (topic, frame)
+                return
+        self._queue.popleft()
+        self._queue.append((topic, frame))
+
+    def _send_queue(self) -> None:
+        try:
+            while self._queue:
+                _, frame = self._queue.popleft()
+                if not self.session.send_frame(frame):
+                    self._queue.clear()
+        except OSError:  # the connection is lost, the server will unsubscribe the session
+            self._queue.clear()
+        finally:
+            self._pump = None
+
+
+class Hub:
+    """
+    Registry of the topics and their subscribers.
+
+    :param max_queue: maximum number of messages waiting to be sent to a subscriber.
+    :param policy: what to do when a message is published to a subscriber whose queue is full.
+    """
+
+    def __init__(self, max_queue: int = 100, policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP):
+        if not isinstance(max_queue, int) or max_queue < 1:
+            raise ValueError('max_queue must be a strictly positive integer')
+        if not isinstance(policy, SlowConsumerPolicy):
+            raise TypeError('policy must be a SlowConsumerPolicy member')
+
+        self._max_queue = max_queue
+        self._policy = policy
+        self._topics: Dict[str, Set[Subscriber]] = {}
+        self._subscribers: Dict['Session', Subscriber] = {}
+
+    @property
+    def topics(self) -> Set[str]:
+        return set(self._topics)
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._topics.get(topic, ()))
+
+    def get_subscriber(self, session: 'Session') -> Subscriber:
+        subscriber = self._subscribers.get(session)
+        if subscriber is None:
+            subscriber = Subscriber(session, self._max_queue, self._policy)
+            self._subscribers[session] = subscriber
+        return subscriber
+
+    def subscribe(self, session: 'Session', topic: str) -> None:
+        if not isinstance(topic, str):
+            raise TypeError('topic must be a string')
+
+        subscriber = self.get_subscriber(session)
+        subscriber.topics.add(topic)
+        self._topics.setdefault(topic, set()).add(subscriber)
+
+    def unsubscribe(self, session: 'Session', topic: str = None) -> None:
+        """Unsubscribes a session from a topic, or from all its topics and forgets it if topic is None."""
+        subscriber = self._subscribers.get(session)
+        if subscriber is None:
+            return
+
+        topics = list(subscriber.topics) if topic is None else [topic]
+        for name in topics:
+            subscriber.topics.discard(name)
+            subscribers = self._topics.get(name)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._topics[name]
+        if topic is None:
+            del self._subscribers[session]
+
+    def publish(self, topic: str, data: Union[str, bytes]) -> int:
+        """Queues a message for all the subscribers of a topic, returns the number of subscribers it was queued for."""
+        subscribers = self._topics.get(topic)
+        if not subscribers:
+            return 0
+
+        frame = encode_frame(data)
+        # the set can change during the loop if a subscriber is disconnected
+        return sum(subscriber.put(topic, frame) for subscriber in list(subscribers))
+
+    def send_to(self, sessions: Iterable['Session'], data: Union[str, bytes]) -> int:
+        """Queues a message for the given open sessions, returns the number of sessions it was queued for."""
+        frame = None
+        count = 0
+        for session in list(sessions):
+            if session.state is not ConnectionState.OPEN:
+                continue
+            if frame is None:
+                frame = encode_frame(data)
+            count += self.get_subscriber(session).put(None, frame)
+        return count
@@ -2,15 +2,21 @@
 Simple websocket client
 """
 import io
-import json
+import itertools
 import re
+import time
+from collections import ChainMap
 from enum import Enum
-from typing import Callable, Tuple, List, Dict, Any, Union, AnyStr
+from types import MethodType
+from typing import Callable, Tuple, List, Dict, Any, Union, Optional
 
-from gevent import socket, spawn
+from gevent import socket, spawn, Timeout
 from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
 from wsproto import WSConnection, ConnectionType
 from wsproto.connection import ConnectionState
+from wsproto.extensions import Extension
+from wsproto.frame_protocol import CloseReason
 from wsproto.events import (
     Event, Request, AcceptConnection, CloseConnection, Pong, Ping, RejectConnection, RejectData, TextMessage,
     BytesMessage, Message
@@ -18,11 +24,21 @@ from wsproto.events import (
 from wsproto.typing import Headers
 from wsproto.utilities import ProtocolError
 
+from common.buffer import OutputBuffer
+from common.timer_wheel import Timer, get_timer_wheel
+from .codec import Codec, MessageMode, get_codec, decode_message
+from .compression import DeflateExtension
+from .framing import MessageData, check_message_data
+from .heartbeat import Heartbeat, check_timeouts
+from .metrics import WebsocketMetrics
+from .send_queue import SendQueue
+
 EventCallback = Callable[['Client', Event], Any]
 StrCallback = Callable[[str], Any]
 BytesCallback = Callable[[bytes], Any]
 JsonCallback = Callable[[Any], Any]
-Callback = Union[EventCallback, StrCallback, BytesCallback, JsonCallback]
+ChunkCallback = Callable[['Client', Union[str, bytes], bool], Any]
+Callback = Union[EventCallback, StrCallback, BytesCallback, JsonCallback, ChunkCallback]
 
 
 class EventType(Enum):
@@ -33,6 +49,8 @@ class EventType(Enum):
     JSON_MESSAGE = 'json'
     TEXT_MESSAGE = 'text'
     BINARY_MESSAGE = 'binary'
+    TEXT_CHUNK = 'text_chunk'
+    BINARY_CHUNK = 'binary_chunk'
 
 
 class ConnectionRejectedError(ProtocolError):
@@ -47,31 +65,126 @@ class ConnectionRejectedError(ProtocolError):
         return f'status = {self.status_code}, headers = {self.headers}, reason = {self.reason}'
 
 
+class hybridmethod:
+    """Like classmethod, but the method is bound to the instance when it is accessed through one."""
+
+    def __init__(self, func: Callable):
+        self.__func__ = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance: Any, owner: type) -> MethodType:
+        return MethodType(self.__func__, owner if instance is None else instance)
+
+
 class Client:
+    """
+    Websocket client. Callbacks registered on the class with the on_* decorators apply to all its instances and the
+    instances of its subclasses, callbacks registered on an instance (client.on_text_message(func)) only apply to it and
+    take precedence. Register instance callbacks right after creating the client, before yielding to other greenlets.
+    """
     _callbacks: Dict[EventType, Callable] = {}
     receive_bytes: int = 65535
     buffer_size: int = io.DEFAULT_BUFFER_SIZE
+    # bounds of the output buffer, sending blocks when the high watermark is reached until the low one is reached
+    high_watermark: int = 64 * 1024
+    low_watermark: int = 16 * 1024
+    # maximum size of a received message, in characters for text messages, None means no limit
+    max_message_size: Optional[int] = None
+    # field of the json messages holding the id used to match a reply with its request, see request_json
+    request_id_field: str = 'id'
+    # maximum number of requests waiting for their reply, request_json blocks when it is reached
+    max_pending_requests: int = 1000
+    # limits of the send queue, see websockets.send_queue.SendQueue
+    send_queue_bytes: int = 1024 * 1024
+    send_queue_messages: int = 1000
+    # keepalive and timeouts of the connection in seconds, None disables them, see websockets.heartbeat. The handshake
+    # timeout includes the TCP connection
+    ping_interval: Optional[float] = 20.0
+    ping_timeout: Optional[float] = 20.0
+    idle_timeout: Optional[float] = None
+    handshake_timeout: Optional[float] = 10.0
+    close_timeout: Optional[float] = 10.0
+    # metrics of all the clients of the process, nothing is measured when it is None
+    metrics: Optional[WebsocketMetrics] = None
 
     # noinspection PyTypeChecker
     def __init__(self, connect_uri: str, headers: Headers = None, extensions: List[str] = None,
-                 sub_protocols: List[str] = None):
+                 sub_protocols: List[str] = None, deflate_options: Dict[str, Any] = None,
+                 codec: Union[str, Codec] = 'json', message_mode: MessageMode = MessageMode.AUTO):
+        """
+        :param extensions: names of the extensions to offer to the server. Only permessage-deflate is supported.
+        :param deflate_options: arguments given to DeflateExtension when permessage-deflate is offered, to set the
+        window bits, context takeover, compression level and the size under which messages are not compressed.
+        :param codec: codec used by send_json and the json message callback, 'json', 'orjson' or a Codec instance.
+        :param message_mode: how text messages are routed to the json and text message callbacks, see MessageMode.
+        In AUTO mode, messages are only decoded when a json message callback is registered.
+        """
         self._check_ws_headers(headers)
         self._check_list_argument('extensions', extensions)
         self._check_list_argument('sub_protocols', sub_protocols)
+        ws_extensions = self._get_extensions(extensions, deflate_options)
+        if not isinstance(message_mode, MessageMode):
+            raise TypeError('message_mode must be a MessageMode member')
+        check_timeouts(ping_interval=self.ping_interval, ping_timeout=self.ping_timeout,
+                       idle_timeout=self.idle_timeout, handshake_timeout=self.handshake_timeout,
+                       close_timeout=self.close_timeout)
+        self._codec = get_codec(codec)
+        self._message_mode = message_mode
 
         self._sock: socket = None
+        self._buffer: OutputBuffer = None
         self._ws: WSConnection = None
+        self._send_queue: SendQueue = None
         # wsproto does not seem to like empty path, so we provide an arbitrary one
         self._default_path = '/path'
         self._running = True
         self._handshake_finished = AsyncResult()
+        self._message_size = 0  # size of the message being received
+        # fragments of the text or binary message being received
+        self._text_message: List[str] = []
+        self._binary_message = bytearray()
+        # status, headers and body of a rejection with a body
+        self._reject_status_code = 400
+        self._reject_headers: Headers = []
+        self._reject_data = bytearray()
+        # handlers of the wsproto events by exact type, a dict lookup is cheaper than a chain of isinstance calls
+        self._event_handlers: Dict[type, Callable[[Event], None]] = {
+            TextMessage: self._handle_text_or_json_message,
+            BytesMessage: self._handle_binary_message,
+            Ping: self._handle_ping,
+            Pong: self._handle_pong,
+            CloseConnection: self._handle_close,
+            AcceptConnection: self._handle_accept,
+            RejectConnection: self._handle_reject,
+            RejectData: self._handle_reject_data,
+        }
+        self._pong_waiters: Dict[bytes, AsyncResult] = {}
+        self._ping_ids = itertools.count()
+        self._request_ids = itertools.count(1)
+        # request id -> (result, timeout timer)
+        self._pending_requests: Dict[int, Tuple[AsyncResult, Optional[Timer]]] = {}
+        self._request_slots = BoundedSemaphore(self.max_pending_requests)
+        # callbacks of the instance first, then the ones of its class and parent classes
+        self._callbacks = ChainMap({}, *(
+            klass.__dict__['_callbacks'] for klass in type(self).__mro__ if '_callbacks' in klass.__dict__
+        ))
 
         host, port, path = self._get_connect_information(connect_uri)
+        self._connected_at = time.perf_counter() if self.metrics is not None else 0.0
         self._establish_tcp_connection(host, port)
-        self._establish_websocket_handshake(host, path, headers, extensions, sub_protocols)
+        self._establish_websocket_handshake(host, path, headers, ws_extensions, sub_protocols)
+        self._heartbeat = Heartbeat(
+            self._send_keepalive_ping, self._close_idle, self._abort, self.ping_interval, self.ping_timeout,
+            self.idle_timeout, self.close_timeout, self.metrics
+        )
+        self._heartbeat.start(self.handshake_timeout)
 
         self._green = spawn(self._run)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._callbacks = {}  # callbacks registered on a subclass don't leak to its parents
+
     @staticmethod
     def _check_ws_headers(headers: Headers) -> None:
         if headers is None:
@@ -100,6 +213,18 @@ class Client:
             if not isinstance(item, str):
                 raise TypeError(error_message)
 
+    @staticmethod
+    def _get_extensions(extensions: List[str], deflate_options: Dict[str, Any]) -> List[Extension]:
+        if deflate_options is not None and not isinstance(deflate_options, dict):
+            raise TypeError('deflate_options must be a dict')
+
+        ws_extensions = []
+        for name in extensions or []:
+            if name != DeflateExtension.name:
+                raise ValueError(f'extension {name} is not supported')
+            ws_extensions.append(DeflateExtension(**(deflate_options or {})))
+        return ws_extensions
+
     def _get_connect_information(self, connect_uri: str) -> Tuple[str, int, str]:
         if not isinstance(connect_uri, str):
             raise TypeError('Your uri must be a string')
@@ -118,69 +243,109 @@ class Client:
         if not isinstance(callback, callable):
             raise TypeError(f'{method} callback must be a callable')
 
-    @classmethod
-    def _on_callback(cls, event_type: EventType, func: Callback) -> Callback:
-        cls._callbacks[event_type] = func
+    @hybridmethod
+    def _on_callback(self, event_type: EventType, func: Callback) -> Callback:
+        # self is the class when the decorator is used on it
+        self._callbacks[event_type] = func
         return func
 
-    @classmethod
-    def on_connect(cls, func: EventCallback) -> EventCallback:
-        return cls._on_callback(EventType.CONNECT, func)
-
-    @classmethod
-    def on_disconnect(cls, func: EventCallback) -> EventCallback:
-        return cls._on_callback(EventType.DISCONNECT, func)
-
-    @classmethod
-    def on_ping(cls, func: BytesCallback) -> BytesCallback:
-        return cls._on_callback(EventType.PING, func)
-
-    @classmethod
-    def on_pong(cls, func: BytesCallback) -> BytesCallback:
-        return cls._on_callback(EventType.PONG, func)
-
-    @classmethod
-    def on_text_message(cls, func: StrCallback) -> StrCallback:
-        return cls._on_callback(EventType.TEXT_MESSAGE, func)
-
-    @classmethod
-    def on_json_message(cls, func: JsonCallback) -> JsonCallback:
-        return cls._on_callback(EventType.JSON_MESSAGE, func)
-
-    @classmethod
-    def on_binary_message(cls, func: BytesCallback) -> BytesCallback:
-        return cls._on_callback(EventType.BINARY_MESSAGE, func)
+    @hybridmethod
+    def on_connect(self, func: EventCallback) -> EventCallback:
+        return self._on_callback(EventType.CONNECT, func)
+
+    @hybridmethod
+    def on_disconnect(self, func: EventCallback) -> EventCallback:
+        return self._on_callback(EventType.DISCONNECT, func)
+
+    @hybridmethod
+    def on_ping(self, func: BytesCallback) -> BytesCallback:
+        return self._on_callback(EventType.PING, func)
+
+    @hybridmethod
+    def on_pong(self, func: BytesCallback) -> BytesCallback:
+        return self._on_callback(EventType.PONG, func)
+
+    @hybridmethod
+    def on_text_message(self, func: StrCallback) -> StrCallback:
+        return self._on_callback(EventType.TEXT_MESSAGE, func)
+
+    @hybridmethod
+    def on_json_message(self, func: JsonCallback) -> JsonCallback:
+        return self._on_callback(EventType.JSON_MESSAGE, func)
+
+    @hybridmethod
+    def on_binary_message(self, func: BytesCallback) -> BytesCallback:
+        return self._on_callback(EventType.BINARY_MESSAGE, func)
+
+    @hybridmethod
+    def on_text_chunk(self, func: ChunkCallback) -> ChunkCallback:
+        """
+        Registers a callback receiving text messages fragment by fragment as they arrive. It is called with the client,
+        the fragment and a boolean telling if it is the last fragment of the message. Text and json message callbacks
+        are not called anymore when this one is registered.
+        """
+        return self._on_callback(EventType.TEXT_CHUNK, func)
+
+    @hybridmethod
+    def on_binary_chunk(self, func: ChunkCallback) -> ChunkCallback:
+        """
+        Registers a callback receiving binary messages fragment by fragment as they arrive. It is called with the
+        client, the fragment and a boolean telling if it is the last fragment of the message. The binary message
+        callback is not called anymore when this one is registered.
+        """
+        return self._on_callback(EventType.BINARY_CHUNK, func)
 
     def _establish_tcp_connection(self, host: str, port: int) -> None:
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.connect((host, port))
-
-    def _establish_websocket_handshake(self, host: str, path: str, headers: Headers, extensions: List[str],
+        self._sock.settimeout(self.handshake_timeout)
+        try:
+            self._sock.connect((host, port))
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.settimeout(None)
+        self._buffer = OutputBuffer(self._sock, self.high_watermark, self.low_watermark,
+                                    None if self.metrics is None else self.metrics.sent_bytes)
+        if self.metrics is not None:
+            self.metrics.connections.inc()
+            self.metrics.open_connections.inc()
+
+    def _establish_websocket_handshake(self, host: str, path: str, headers: Headers, extensions: List[Extension],
                                        sub_protocols: List[str]) -> None:
         self._ws = WSConnection(ConnectionType.CLIENT)
         headers = headers if headers is not None else []
-        extensions = extensions if extensions is not None else []
         sub_protocols = sub_protocols if sub_protocols is not None else []
         request = Request(host=host, target=path, extra_headers=headers, extensions=extensions,
                           subprotocols=sub_protocols)
-        self._sock.sendall(self._ws.send(request))
+        self._buffer.write(self._ws.send(request))
+        self._send_queue = SendQueue(self._ws, self._buffer, self.buffer_size, self.send_queue_bytes,
+                                     self.send_queue_messages, self.metrics)
 
     def _handle_accept(self, event: AcceptConnection) -> None:
+        if self.metrics is not None:
+            self.metrics.handshake_duration.observe(time.perf_counter() - self._connected_at)
+        self._heartbeat.handshake_done()
+        if not event.extensions:
+            self._send_queue.enable_fast_framing()
         self._handshake_finished.set()
         if EventType.CONNECT in self._callbacks:
             self._callbacks[EventType.CONNECT](self, event)
 
     def _handle_reject(self, event: RejectConnection) -> None:
+        if event.has_body:  # the error is raised once the body is received
+            self._reject_status_code = event.status_code
+            self._reject_headers = event.headers
+            return
         self._handshake_finished.set_exception(
             ConnectionRejectedError(event.status_code, event.headers, b'')
         )
         self._running = False
 
-    def _handle_reject_data(self, event: RejectData, data: bytearray, status_code: int, headers: Headers) -> None:
-        data.extend(event.data)
+    def _handle_reject_data(self, event: RejectData) -> None:
+        self._reject_data.extend(event.data)
         if event.body_finished:
             self._handshake_finished.set_exception(
-                ConnectionRejectedError(status_code, headers, data)
+                ConnectionRejectedError(self._reject_status_code, self._reject_headers, self._reject_data)
             )
             self._running = False
 
@@ -190,33 +355,85 @@ class Client:
             self._callbacks[EventType.DISCONNECT](event)
         # if the server sends first a close connection we need to reply with another one
         if self._ws.state is ConnectionState.REMOTE_CLOSING:
-            self._sock.sendall(self._ws.send(event.response()))
+            self._buffer.write(self._ws.send(event.response()))
 
     def _handle_ping(self, event: Ping) -> None:
         if EventType.PING in self._callbacks:
             self._callbacks[EventType.PING](event.payload)
-        self._sock.sendall(self._ws.send(event.response()))
+        self._buffer.write(self._ws.send(event.response()))
 
     def _handle_pong(self, event: Pong) -> None:
+        if self._heartbeat.handle_pong(event.payload):
+            return
+        waiter = self._pong_waiters.pop(bytes(event.payload), None)
+        if waiter is not None:
+            waiter.set()
         if EventType.PONG in self._callbacks:
             self._callbacks[EventType.PONG](event.payload)
 
-    def _handle_text_or_json_message(self, event: TextMessage, text_message: List[str]) -> None:
-        text_message.append(event.data)
-        if event.message_finished:
-            if EventType.JSON_MESSAGE in self._callbacks:
-                str_message = ''.join(text_message)
-                try:
-                    self._callbacks[EventType.JSON_MESSAGE](self, json.loads(str_message))
-                    text_message.clear()
-                    return  # no need to process text handler if json handler already does the job
-                except json.JSONDecodeError:
-                    pass
-            if EventType.TEXT_MESSAGE in self._callbacks:
-                self._callbacks[EventType.TEXT_MESSAGE](self, ''.join(text_message))
+    def _check_message_size(self, event: Message) -> bool:
+        """
+        Returns False and closes the connection if the message being received is bigger than max_message_size.
+        """
+        if self._ws.state is not ConnectionState.OPEN:  # we are closing, probably because of a previous fragment
+            return False
+
+        message_size = self._message_size + len(event.data)
+        self._message_size = 0 if event.message_finished else message_size
+        if self.max_message_size is not None and message_size > self.max_message_size:
+            self._buffer.write(self._ws.send(
+                CloseConnection(code=CloseReason.MESSAGE_TOO_BIG, reason='message too big')
+            ))
+            self._heartbeat.closing()
+            return False
+        if event.message_finished and self.metrics is not None:
+            self.metrics.received_message_size.observe(message_size)
+        return True
+
+    def _handle_text_or_json_message(self, event: TextMessage) -> None:
+        self._heartbeat.message_received = True
+        text_message = self._text_message
+        if not self._check_message_size(event):
             text_message.clear()
+            return
+        if EventType.TEXT_CHUNK in self._callbacks:
+            self._callbacks[EventType.TEXT_CHUNK](self, event.data, event.message_finished)
+            return
+
+        text_message.append(event.data)
+        if not event.message_finished:
+            return
+        str_message = ''.join(text_message)
+        text_message.clear()
+
+        mode = self._message_mode
+        if mode is MessageMode.AUTO and EventType.JSON_MESSAGE not in self._callbacks and not self._pending_requests:
+            mode = MessageMode.TEXT
+        try:
+            is_json, value = decode_message(self._codec, mode, str_message)
+        except ValueError:
+            self._buffer.write(self._ws.send(
+                CloseConnection(code=CloseReason.INVALID_FRAME_PAYLOAD_DATA, reason='invalid json')
+            ))
+            self._heartbeat.closing()
+            return
+
+        if is_json and self._pending_requests and self._resolve_request(value):
+            return  # replies go to their request and not to the json message callback
+        event_type = EventType.JSON_MESSAGE if is_json else EventType.TEXT_MESSAGE
+        if event_type in self._callbacks:
+            self._callbacks[event_type](self, value)
+
+    def _handle_binary_message(self, event: BytesMessage) -> None:
+        self._heartbeat.message_received = True
+        binary_message = self._binary_message
+        if not self._check_message_size(event):
+            binary_message.clear()
+            return
+        if EventType.BINARY_CHUNK in self._callbacks:
+            self._callbacks[EventType.BINARY_CHUNK](self, event.data, event.message_finished)
+            return
 
-    def _handle_binary_message(self, event: BytesMessage, binary_message: bytearray) -> None:
         binary_message.extend(event.data)
         if event.message_finished:
             if EventType.BINARY_MESSAGE in self._callbacks:
@@ -224,88 +441,186 @@ class Client:
             binary_message.clear()
 
     def _run(self) -> None:
-        reject_data = bytearray()
-        reject_status_code = 400
-        reject_headers = []
-        text_message = []
-        binary_message = bytearray()
+        metrics = self.metrics
+        event_handlers = self._event_handlers
 
         while self._running:
-            data = self._sock.recv(self.receive_bytes)
+            try:
+                data = self._sock.recv(self.receive_bytes)
+            except OSError:  # the connection was reset, handled like a connection closed by the peer
+                data = None
             if not data:
                 data = None
+            else:
+                self._heartbeat.received = True
+                if metrics is not None:
+                    metrics.received_bytes.inc(len(data))
             self._ws.receive_data(data)
 
             for event in self._ws.events():
-                if isinstance(event, AcceptConnection):
-                    self._handle_accept(event)
-
-                elif isinstance(event, RejectConnection):
-                    if not event.has_body:
-                        self._handle_reject(event)
-                    else:
-                        reject_status_code = event.status_code
-                        reject_headers = event.headers
-
-                elif isinstance(event, RejectData):
-                    self._handle_reject_data(event, reject_data, reject_status_code, reject_headers)
-
-                elif isinstance(event, CloseConnection):
-                    self._handle_close(event)
-
-                elif isinstance(event, Ping):
-                    self._handle_ping(event)
+                if metrics is not None:
+                    metrics.received_frames.inc()
+                    started_at = time.perf_counter()
+
+                handler = event_handlers.get(type(event))
+                if handler is not None:
+                    handler(event)
+                elif metrics is not None:
+                    metrics.unknown_events.inc()
+
+                if metrics is not None:
+                    # noinspection PyUnboundLocalVariable
+                    metrics.handler_duration.observe(time.perf_counter() - started_at)
+
+        self._heartbeat.stop()
+        if not self._handshake_finished.ready():
+            self._handshake_finished.set_exception(ConnectionError('the connection closed during the handshake'))
+        for waiter in self._pong_waiters.values():
+            waiter.set_exception(ConnectionError('the connection is closed'))
+        self._pong_waiters.clear()
+        self._send_queue.close()
+        for request_id in list(self._pending_requests):
+            self._finish_request(request_id).set_exception(ConnectionError('the connection is closed'))
+        self._buffer.close()
+        self._sock.close()
+        if metrics is not None:
+            metrics.open_connections.dec()
 
-                elif isinstance(event, Pong):
-                    self._handle_pong(event)
+    @property
+    def send_queue(self) -> SendQueue:
+        """The queue of outgoing messages, its depth, queued_bytes and latency tell how much the server lags."""
+        return self._send_queue
 
-                elif isinstance(event, TextMessage):
-                    self._handle_text_or_json_message(event, text_message)
+    @property
+    def rtt(self) -> Optional[float]:
+        """Round trip time of the last keepalive ping answered, None before the first one."""
+        return self._heartbeat.rtt
 
-                elif isinstance(event, BytesMessage):
-                    self._handle_binary_message(event, binary_message)
+    def _send_keepalive_ping(self, payload: bytes) -> None:
+        if self._ws.state is ConnectionState.OPEN:
+            self._buffer.write(self._ws.send(Ping(payload)))
 
-                else:
-                    print('unknown event', event)
+    def _close_idle(self, code: int, reason: str) -> None:
+        try:
+            self._send_queue.put_close(CloseConnection(code=code, reason=reason))
+        except ConnectionError:  # already closing
+            pass
 
-        self._sock.close()
+    def _abort(self) -> None:
+        if not self._handshake_finished.ready():
+            self._handshake_finished.set_exception(TimeoutError('the opening handshake timed out'))
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:  # already closed
+            pass
+
+    @property
+    def connected(self) -> bool:
+        """Tells if the handshake succeeded and the connection is still open."""
+        return self._running and self._ws.state is ConnectionState.OPEN
+
+    def check_alive(self, timeout: float = 5.0) -> bool:
+        """
+        Sends a ping and returns True if the matching pong is received before the timeout, False otherwise.
+        """
+        try:
+            self._handshake_finished.get(timeout=timeout)
+        except (Timeout, ConnectionRejectedError):
+            return False
+        if not self.connected:
+            return False
+
+        payload = b'check %d' % next(self._ping_ids)
+        waiter = self._pong_waiters[payload] = AsyncResult()
+        try:
+            self.ping(payload)
+            waiter.get(timeout=timeout)
+        except (Timeout, OSError):
+            return False
+        finally:
+            self._pong_waiters.pop(payload, None)
+        return True
 
     def ping(self, data: bytes = b'hello') -> None:
         self._handshake_finished.get()
         if not isinstance(data, bytes):
             raise TypeError('data must be bytes')
 
-        self._sock.sendall(self._ws.send(Ping(data)))
-
-    def _send_data(self, data: AnyStr) -> None:
-        if isinstance(data, str):
-            io_object = io.StringIO(data)
-        else:
-            io_object = io.BytesIO(data)
-
-        with io_object as f:
-            chunk = f.read(self.buffer_size)
-            while chunk:
-                if len(chunk) < self.buffer_size:
-                    self._sock.sendall(self._ws.send(Message(data, message_finished=True)))
-                    break
-                else:
-                    self._sock.sendall(self._ws.send(Message(data, message_finished=False)))
-                chunk = f.read(self.buffer_size)
-
-    def send(self, data: AnyStr) -> None:
+        self._buffer.write(self._ws.send(Ping(data)))
+        self._buffer.drain()
+
+    def send(self, data: MessageData, block: bool = True, timeout: float = None) -> None:
+        """
+        Queues a message. data can also be an iterable or a generator of strings or bytes, it is then consumed lazily
+        and sent as a single fragmented message. When the send queue is full, waits for room if block is True,
+        otherwise or if the timeout expires, raises websockets.send_queue.SendQueueFull.
+        """
         self._handshake_finished.get()
-        if not isinstance(data, (bytes, str)):
-            raise TypeError('data must be bytes or string')
+        check_message_data(data)
 
-        self._send_data(data)
+        self._send_queue.put(data, block, timeout)
 
-    def send_json(self, data: Any) -> None:
-        self.send(json.dumps(data))
+    def send_json(self, data: Any, block: bool = True, timeout: float = None) -> None:
+        self.send(self._codec.dumps(data), block, timeout)
+
+    def _finish_request(self, request_id: int) -> AsyncResult:
+        result, timer = self._pending_requests.pop(request_id)
+        if timer is not None:
+            timer.cancel()
+        self._request_slots.release()
+        return result
+
+    def _expire_request(self, request_id: int) -> None:
+        if request_id in self._pending_requests:
+            self._finish_request(request_id).set_exception(
+                TimeoutError(f'no reply was received for request {request_id}')
+            )
+
+    def _resolve_request(self, reply: Any) -> bool:
+        if not isinstance(reply, dict):
+            return False
+        request_id = reply.get(self.request_id_field)
+        if not isinstance(request_id, int) or request_id not in self._pending_requests:
+            return False
+        self._finish_request(request_id).set(reply)
+        return True
+
+    def request_json(self, payload: Dict[str, Any], timeout: float = None) -> AsyncResult:
+        """
+        Sends payload with an id added in the request_id_field and returns an AsyncResult holding the first json
+        reply carrying the same id. Many requests can wait for their reply at the same time, when max_pending_requests
+        is reached, this method blocks until one of them finishes.
+
+        :param payload: a dict, it is not modified.
+        :param timeout: number of seconds after which the result fails with a TimeoutError if no reply was received.
+        The same timeout applies to the wait for a free request slot.
+        """
+        if not isinstance(payload, dict):
+            raise TypeError('payload must be a dict')
+        self._handshake_finished.get()
+        if not self.connected:
+            raise ConnectionError('the connection is closed')
+        if not self._request_slots.acquire(timeout=timeout):
+            raise TimeoutError(f'{self.max_pending_requests} requests are already waiting for their reply')
+
+        request_id = next(self._request_ids)
+        result = AsyncResult()
+        timer = None
+        if timeout is not None:
+            # run by the timer wheel shared with the keepalive of the connections, like them it may fire one tick late
+            timer = get_timer_wheel().schedule(timeout, self._expire_request, request_id)
+        self._pending_requests[request_id] = (result, timer)
+        try:
+            self.send_json({**payload, self.request_id_field: request_id})
+        except BaseException:
+            self._finish_request(request_id)
+            raise
+        return result
 
     def _close_ws_connection(self):
-        close_data = self._ws.send(CloseConnection(code=1000, reason='nothing more to do'))
-        self._sock.sendall(close_data)
+        # queued, so that the messages sent before are not lost
+        self._send_queue.put_close(CloseConnection(code=1000, reason='nothing more to do'))
+        self._heartbeat.closing()
 
     def close(self) -> None:
         self._handshake_finished.get()
@@ -0,0 +1,100 @@
+"""
+Codecs used to encode and decode json messages, and the modes telling how text messages are routed.
+"""
+import json
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Any, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+# characters a json document can start with once leading whitespaces are removed, N and I are for NaN and Infinity
+# which the json module accepts
+JSON_FIRST_CHARACTERS = frozenset('{["-0123456789tfnNI')
+
+
+class MessageMode(Enum):
+    """
+    How text messages of a connection are handled.
+
+    AUTO: messages that look like json are decoded and given to the json handler, the others go to the text handler.
+    JSON: all messages are decoded, a message which is not valid json closes the connection with code 1007.
+    TEXT: messages are never decoded and always go to the text handler.
+    """
+    AUTO = 'auto'
+    JSON = 'json'
+    TEXT = 'text'
+
+
+class Codec(ABC):
+    """Encodes and decodes json messages."""
+
+    @abstractmethod
+    def dumps(self, data: Any) -> str:
+        pass
+
+    @abstractmethod
+    def loads(self, data: str) -> Any:
+        """Decodes a message, raises a ValueError if it is not valid."""
+        pass
+
+
+class JsonCodec(Codec):
+    """Codec using the json module of the standard library."""
+
+    def dumps(self, data: Any) -> str:
+        return json.dumps(data)
+
+    def loads(self, data: str) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    """Codec using orjson, it needs to be installed."""
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError('orjson is not installed')
+
+    def dumps(self, data: Any) -> str:
+        return orjson.dumps(data).decode()
+
+    def loads(self, data: str) -> Any:
+        return orjson.loads(data)
+
+
+def get_codec(codec: Union[str, Codec]) -> Codec:
+    """Returns a codec given its name (json or orjson) or the codec itself."""
+    if isinstance(codec, Codec):
+        return codec
+    if codec == 'json':
+        return JsonCodec()
+    if codec == 'orjson':
+        return OrjsonCodec()
+    raise ValueError(f'unknown codec {codec}, you can use json, orjson or a Codec instance')
+
+
+def looks_like_json(data: str) -> bool:
+    """Cheap check telling if decoding a message has a chance to succeed."""
+    stripped = data.lstrip()
+    return bool(stripped) and stripped[0] in JSON_FIRST_CHARACTERS
+
+
+def decode_message(codec: Codec, mode: MessageMode, data: str) -> Tuple[bool, Any]:
+    """
+    Returns a tuple (True, decoded value) if the message must go to the json handler and (False, data) if it must go
+    to the text handler. Raises a ValueError in JSON mode if the message is not valid json.
+    """
+    if mode is MessageMode.TEXT:
+        return False, data
+    if mode is MessageMode.JSON:
+        return True, codec.loads(data)
+    if not looks_like_json(data):  # don't pay for a failed parse and its exception on plain text
+        return False, data
+    try:
+        return True, codec.loads(data)
+    except ValueError:
+        return False, data
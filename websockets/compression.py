@@ -0,0 +1,51 @@
+"""
+permessage-deflate extension (RFC 7692) with a few more knobs than the wsproto one.
+"""
+import zlib
+from typing import Tuple, Union
+
+from wsproto.extensions import PerMessageDeflate
+from wsproto.frame_protocol import FrameDecoder, FrameProtocol, Opcode, RsvBits
+
+
+class DeflateExtension(PerMessageDeflate):
+    """
+    permessage-deflate extension.
+
+    :param client_no_context_takeover: the client resets its compression context after each message.
+    :param client_max_window_bits: size of the LZ77 window used by the client, between 9 and 15.
+    :param server_no_context_takeover: the server resets its compression context after each message.
+    :param server_max_window_bits: size of the LZ77 window used by the server, between 9 and 15.
+    :param compression_level: zlib compression level, from 0 to 9 or -1 for the zlib default.
+    :param threshold: messages sent in a single frame and smaller than this number of bytes are not compressed.
+    """
+
+    def __init__(self, client_no_context_takeover: bool = False, client_max_window_bits: int = None,
+                 server_no_context_takeover: bool = False, server_max_window_bits: int = None,
+                 compression_level: int = zlib.Z_DEFAULT_COMPRESSION, threshold: int = 0):
+        if not isinstance(compression_level, int) or not -1 <= compression_level <= 9:
+            raise ValueError('compression_level must be an integer between -1 and 9')
+        if not isinstance(threshold, int) or threshold < 0:
+            raise ValueError('threshold must be a positive integer')
+
+        super().__init__(client_no_context_takeover, client_max_window_bits, server_no_context_takeover,
+                         server_max_window_bits)
+        self.compression_level = compression_level
+        self.threshold = threshold
+        self._outbound_compressed = True  # whether the message being sent is compressed
+
+    def frame_outbound(self, proto: Union[FrameDecoder, FrameProtocol], opcode: Opcode, rsv: RsvBits, data: bytes,
+                       fin: bool) -> Tuple[RsvBits, bytes]:
+        if not self._compressible_opcode(opcode):
+            return rsv, data
+
+        if opcode is not Opcode.CONTINUATION:
+            # the size of a fragmented message is unknown, only messages sent in one frame can skip compression
+            self._outbound_compressed = not fin or len(data) >= self.threshold
+        if not self._outbound_compressed:
+            return rsv, data
+
+        if self._compressor is None:
+            bits = self.client_max_window_bits if proto.client else self.server_max_window_bits
+            self._compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -int(bits))
+        return super().frame_outbound(proto, opcode, rsv, data, fin)
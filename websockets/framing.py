@@ -0,0 +1,159 @@
+"""
+Helpers to split websocket messages into frames.
+
+Once the opening handshake is done and when no extension is negotiated, data frames are encoded here instead of by
+wsproto: a frame is a header built from precomputed tables and the payload, masked with big integer or translate table
+operations instead of byte by byte, which is several times faster for the small messages most applications send.
+wsproto still does the handshake, the control frames, the compressed and the streamed messages, and all the parsing.
+"""
+import os
+import struct
+from collections.abc import Iterable, Mapping
+from typing import Dict, Iterator, List, Tuple, Union, Iterable as IterableType
+
+Data = Union[str, bytes, bytearray, memoryview]
+Fragment = Union[str, memoryview]
+MessageData = Union[Data, IterableType[Data]]
+
+CONTINUATION_OPCODE = 0x0
+TEXT_OPCODE = 0x1
+BINARY_OPCODE = 0x2
+FIN_BIT = 0x80
+MASK_BIT = 0x80
+
+# payloads up to this size are masked with a big integer xor, bigger ones with translate tables which scale better
+INT_MASKING_MAX_SIZE = 512
+# XOR_TABLES[k] maps each byte to itself xor k
+XOR_TABLES = [bytes(byte ^ key for byte in range(256)) for key in range(256)]
+# headers of the frames with a payload shorter than 126 bytes, by first byte then by second byte (mask bit and length)
+SHORT_HEADERS: Dict[int, List[bytes]] = {
+    fin | opcode: [bytes((fin | opcode, second_byte)) for second_byte in range(256)]
+    for fin in (0, FIN_BIT) for opcode in (CONTINUATION_OPCODE, TEXT_OPCODE, BINARY_OPCODE)
+}
+HEADER_16 = struct.Struct('!BBH')
+HEADER_64 = struct.Struct('!BBQ')
+# number of masking keys drawn from the system random generator at once
+MASKING_KEYS_BATCH = 1024
+
+_masking_keys = b''
+_masking_key_offset = 0
+_masking_keys_pid = 0
+
+
+def check_message_data(data: MessageData) -> None:
+    if isinstance(data, (str, bytes, bytearray, memoryview)):
+        return
+    if not isinstance(data, Iterable) or isinstance(data, Mapping):
+        raise TypeError('data must be a string, binary data or an iterable of one of them')
+
+
+def iter_fragments(data: MessageData, fragment_size: int) -> Iterator[Tuple[Fragment, bool]]:
+    """
+    Splits a message in fragments of at most fragment_size characters or bytes.
+    Yields tuples (fragment, message_finished). Binary data is sliced through a memoryview so no copy is made.
+
+    :param data: a string, binary data, or an iterable of strings or binary data (but not both) which will be consumed
+    lazily, so that a generator can produce a message bigger than the available memory.
+    :param fragment_size: the maximum size of a fragment.
+    """
+    if isinstance(data, (str, bytes, bytearray, memoryview)):
+        data = (data,)
+
+    kind = None
+    pending = None  # we need to know if a fragment is the last one before yielding it
+    for chunk in data:
+        if isinstance(chunk, str):
+            chunk_kind = str
+        elif isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk_kind = bytes
+            chunk = memoryview(chunk).cast('B')
+        else:
+            raise TypeError('message parts must be strings or binary data')
+
+        if kind is None:
+            kind = chunk_kind
+        elif kind is not chunk_kind:
+            raise TypeError('a message cannot mix text and binary data')
+
+        for offset in range(0, len(chunk), fragment_size):
+            if pending is not None:
+                yield pending, False
+            pending = chunk[offset:offset + fragment_size]
+
+    if pending is None:  # empty message
+        pending = '' if kind is str else memoryview(b'')
+    yield pending, True
+
+
+def get_masking_key() -> bytes:
+    """
+    Returns 4 bytes from the system random generator, as RFC 6455 asks. They are read in batches, the batch is not
+    shared with the processes forked after it was read.
+    """
+    global _masking_keys, _masking_key_offset, _masking_keys_pid
+    if _masking_key_offset >= len(_masking_keys) or _masking_keys_pid != os.getpid():
+        _masking_keys = os.urandom(4 * MASKING_KEYS_BATCH)
+        _masking_key_offset = 0
+        _masking_keys_pid = os.getpid()
+    key = _masking_keys[_masking_key_offset:_masking_key_offset + 4]
+    _masking_key_offset += 4
+    return key
+
+
+def mask_payload(payload: Union[bytes, bytearray, memoryview], key: bytes) -> Union[bytes, bytearray]:
+    """Xors a payload with a 4 bytes masking key repeated over its length, masking and unmasking being the same."""
+    length = len(payload)
+    if length <= INT_MASKING_MAX_SIZE:
+        # one xor of two big integers instead of a python operation per byte
+        repeated_key = (key * (length // 4 + 1))[:length]
+        return (int.from_bytes(payload, 'little') ^ int.from_bytes(repeated_key, 'little')).to_bytes(length, 'little')
+
+    masked = bytearray(payload)
+    for index in range(4):
+        masked[index::4] = masked[index::4].translate(XOR_TABLES[key[index]])
+    return masked
+
+
+def encode_data_frame(payload: Union[bytes, bytearray, memoryview], opcode: int, fin: bool = True,
+                      mask: bool = False) -> bytes:
+    """
+    Encodes a data frame. Clients must mask their frames, servers must not.
+
+    :param payload: bytes, already encoded in utf-8 for a text frame.
+    :param opcode: TEXT_OPCODE or BINARY_OPCODE for the first frame of a message, CONTINUATION_OPCODE for the next ones.
+    """
+    first_byte = FIN_BIT | opcode if fin else opcode
+    mask_bit = MASK_BIT if mask else 0
+    length = len(payload)
+    if length < 126:
+        header = SHORT_HEADERS[first_byte][mask_bit | length]
+    elif length < 1 << 16:
+        header = HEADER_16.pack(first_byte, mask_bit | 126, length)
+    else:
+        header = HEADER_64.pack(first_byte, mask_bit | 127, length)
+
+    if not mask:
+        return header + payload
+    key = get_masking_key()
+    return header + key + mask_payload(payload, key)
+
+
+def encode_frame(data: Data, mask: bool = False) -> bytes:
+    """
+    Encodes a whole message in a single frame. Unmasked frames, the way a server sends them, can be written as is to
+    any number of connections, so a message sent to many clients is only framed once.
+    """
+    if isinstance(data, str):
+        return encode_data_frame(data.encode(), TEXT_OPCODE, mask=mask)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return encode_data_frame(memoryview(data).cast('B'), BINARY_OPCODE, mask=mask)
+    raise TypeError('data must be a string or binary data')
+
+
+def iter_frames(data: Data, fragment_size: int, mask: bool = False) -> Iterator[bytes]:
+    """Encodes a message in frames of at most fragment_size characters or bytes, like iter_fragments splits it."""
+    opcode = TEXT_OPCODE if isinstance(data, str) else BINARY_OPCODE
+    for fragment, finished in iter_fragments(data, fragment_size):
+        payload = fragment.encode() if isinstance(fragment, str) else fragment
+        yield encode_data_frame(payload, opcode, finished, mask)
+        opcode = CONTINUATION_OPCODE
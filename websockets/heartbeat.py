@@ -0,0 +1,154 @@
+"""
+Keepalive and timeouts of a websocket connection, run by the timer wheel shared by the connections of the process.
+
+A connection has at most one timer at a time. Reads only set a flag, which the timer looks at when it fires, so the
+keepalive costs nothing per frame received:
+- the opening handshake must be done within handshake_timeout seconds.
+- when nothing was received during ping_interval seconds, a ping is sent and its pong must come back within ping_timeout
+seconds. Its round trip time is kept in rtt.
+- when no message was received during idle_timeout seconds, the connection is closed with a close frame.
+- once a close frame was sent, the peer has close_timeout seconds to close the connection.
+
+A connection which misses a deadline is aborted: its socket is shut down, which ends its read loop like a peer leaving.
+Timeouts set to None are disabled.
+"""
+import itertools
+import time
+from typing import Callable, Optional
+
+from wsproto.frame_protocol import CloseReason
+
+from common.timer_wheel import Timer, get_timer_wheel
+from .metrics import WebsocketMetrics
+
+# payloads of the keepalive pings start with it, followed by a number unique in the process
+PING_PREFIX = b'keepalive '
+# weight of the last measure in the smoothed round trip time
+RTT_SMOOTHING = 0.125
+
+_ping_ids = itertools.count()
+
+
+def check_timeouts(**timeouts: Optional[float]) -> None:
+    for name, value in timeouts.items():
+        if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f'{name} must be a strictly positive number or None')
+
+
+class Heartbeat:
+    """
+    :param send_ping: sends a ping with the given payload, without blocking.
+    :param close: sends a close frame with the given code and reason, without blocking.
+    :param abort: shuts the connection down.
+    :param ping_timeout: defaults to ping_interval.
+    """
+
+    def __init__(self, send_ping: Callable[[bytes], None], close: Callable[[int, str], None],
+                 abort: Callable[[], None], ping_interval: Optional[float] = None, ping_timeout: Optional[float] = None,
+                 idle_timeout: Optional[float] = None, close_timeout: Optional[float] = None,
+                 metrics: WebsocketMetrics = None):
+        self._send_ping = send_ping
+        self._close = close
+        self._abort = abort
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout if ping_timeout is not None else ping_interval
+        self._idle_timeout = idle_timeout
+        self._close_timeout = close_timeout
+        self._metrics = metrics
+        self._wheel = get_timer_wheel()
+        self._timer: Optional[Timer] = None
+        # set by the read loop, cleared by the timer
+        self.received = False
+        self.message_received = False
+        self._idle_since = 0.0
+        self._ping_payload: Optional[bytes] = None
+        self._ping_sent_at = 0.0
+        self._closing = False
+        self.rtt: Optional[float] = None
+        self.smoothed_rtt: Optional[float] = None
+
+    def _schedule(self, delay: Optional[float], callback: Callable) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None if delay is None else self._wheel.schedule(delay, callback)
+
+    def _check_interval(self) -> Optional[float]:
+        intervals = [value for value in (self._ping_interval, self._idle_timeout) if value is not None]
+        return min(intervals) if intervals else None
+
+    def _timeout(self) -> None:
+        if self._metrics is not None:
+            self._metrics.timeouts.inc()
+        self._timer = None
+        self._abort()
+
+    def start(self, handshake_timeout: Optional[float]) -> None:
+        """To call when the connection is established, before the opening handshake."""
+        self._schedule(handshake_timeout, self._timeout)
+
+    def handshake_done(self) -> None:
+        """To call once the opening handshake succeeded."""
+        if self._closing:
+            return
+        self._idle_since = time.monotonic()
+        self.received = self.message_received = False
+        self._schedule(self._check_interval(), self._check)
+
+    def closing(self) -> None:
+        """To call when a close frame is sent, or when the handshake failed."""
+        if self._closing:
+            return
+        self._closing = True
+        self._ping_payload = None
+        self._schedule(self._close_timeout, self._timeout)
+
+    def stop(self) -> None:
+        """To call when the connection is closed."""
+        self._closing = True
+        self._schedule(None, self._timeout)
+
+    def handle_pong(self, payload: bytes) -> bool:
+        """
+        Returns True if the pong answers the keepalive ping waiting for it, it then must not reach the application.
+        Any other pong, even one looking like a keepalive pong, belongs to the application.
+        """
+        if self._ping_payload is None or payload != self._ping_payload:
+            return False
+        self._ping_payload = None
+        self.rtt = time.monotonic() - self._ping_sent_at
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = self.rtt
+        else:
+            self.smoothed_rtt += (self.rtt - self.smoothed_rtt) * RTT_SMOOTHING
+        if self._metrics is not None:
+            self._metrics.ping_rtt.observe(self.rtt)
+        return True
+
+    def _check(self) -> None:
+        self._timer = None
+        now = time.monotonic()
+        if self._ping_payload is not None:  # the timer of a keepalive ping fired before its pong came back
+            self._timeout()
+            return
+
+        if self.message_received:
+            self._idle_since = now
+        if self._idle_timeout is not None and now - self._idle_since >= self._idle_timeout:
+            try:
+                self._close(CloseReason.NORMAL_CLOSURE, 'idle timeout')
+            except OSError:
+                return
+            self.closing()
+            return
+
+        if self._ping_interval is not None and not self.received:
+            self._ping_payload = PING_PREFIX + str(next(_ping_ids)).encode()
+            self._ping_sent_at = now
+            try:
+                self._send_ping(self._ping_payload)
+            except OSError:  # the connection is lost, its read loop will stop
+                return
+            self._schedule(self._ping_timeout, self._check)
+        else:
+            self._schedule(self._check_interval(), self._check)
+        self.received = self.message_received = False
@@ -0,0 +1,45 @@
+"""
+Metrics of websocket connections, enabled by setting the metrics attribute of a Client or BaseServer class.
+"""
+from common.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, Registry
+
+
+class WebsocketMetrics:
+    """
+    :param prefix: prefix of the metric names. Clients and servers running in the same process and sharing a registry
+    need different prefixes, for example 'websocket_client' and 'websocket_server'.
+    """
+
+    def __init__(self, registry: Registry, prefix: str = 'websocket'):
+        self.registry = registry
+        self.open_connections = registry.gauge(f'{prefix}_open_connections', 'Connections currently open.')
+        self.connections = registry.counter(f'{prefix}_connections_total', 'Connections opened.')
+        self.received_bytes = registry.counter(f'{prefix}_received_bytes_total', 'Bytes received from the peers.')
+        self.sent_bytes = registry.counter(f'{prefix}_sent_bytes_total', 'Bytes sent to the peers.')
+        self.received_frames = registry.counter(
+            f'{prefix}_received_frames_total', 'Frames received, control frames included.'
+        )
+        self.sent_frames = registry.counter(f'{prefix}_sent_frames_total', 'Data frames sent by the send queues.')
+        self.received_message_size = registry.histogram(
+            f'{prefix}_received_message_size', 'Size of the messages received, in bytes or characters.', SIZE_BUCKETS
+        )
+        self.sent_message_size = registry.histogram(
+            f'{prefix}_sent_message_size', 'Size of the messages queued, in bytes or characters. Messages given as '
+                                           'iterables are not counted.', SIZE_BUCKETS
+        )
+        self.handler_duration = registry.histogram(
+            f'{prefix}_handler_duration_seconds', 'Time spent handling a received frame, callbacks included.',
+            LATENCY_BUCKETS
+        )
+        self.handshake_duration = registry.histogram(
+            f'{prefix}_handshake_seconds', 'Time from the TCP connection to the handshake response.', LATENCY_BUCKETS
+        )
+        self.ping_rtt = registry.histogram(
+            f'{prefix}_ping_rtt_seconds', 'Round trip time of the keepalive pings.', LATENCY_BUCKETS
+        )
+        self.timeouts = registry.counter(
+            f'{prefix}_timeouts_total', 'Connections aborted because of a handshake, ping or close timeout.'
+        )
+        self.unknown_events = registry.counter(
+            f'{prefix}_unknown_events_total', 'Events of wsproto the connections do not know how to handle.'
+        )
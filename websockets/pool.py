@@ -0,0 +1,188 @@
+"""
+Pool of websocket client connections.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+import gevent
+from gevent import Greenlet, spawn
+from gevent.lock import BoundedSemaphore
+
+from .client import Client, ConnectionRejectedError
+
+ClientFactory = Callable[[str], Client]
+
+
+class ClientPool:
+    """
+    Keeps connections open so that greenlets talking to the same endpoints reuse them instead of doing a TCP connection
+    and a websocket handshake each time. A connection is used by one greenlet at a time, between acquire and release.
+
+    :param client_factory: callable creating a connected client given an uri, Client by default. Use a subclass with its
+    own callbacks, or a functools.partial to give headers, extensions or a codec.
+    :param max_per_host: maximum number of connections, idle or not, to a host. acquire blocks when it is reached.
+    :param idle_timeout: number of seconds after which an idle connection is closed.
+    :param health_check_interval: number of seconds between two checks of the idle connections. Each check closes the
+    connections idle for too long and pings the others, the ones not answering within ping_timeout are closed.
+    :param ping_timeout: number of seconds to wait for the pong of a health check.
+    """
+
+    def __init__(self, client_factory: ClientFactory = Client, max_per_host: int = 10, idle_timeout: float = 60.0,
+                 health_check_interval: float = 30.0, ping_timeout: float = 5.0):
+        if not callable(client_factory):
+            raise TypeError('client_factory must be a callable')
+        if not isinstance(max_per_host, int) or max_per_host < 1:
+            raise ValueError('max_per_host must be a strictly positive integer')
+        for name, value in [('idle_timeout', idle_timeout), ('health_check_interval', health_check_interval),
+                            ('ping_timeout', ping_timeout)]:
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f'{name} must be a strictly positive number')
+
+        self._client_factory = client_factory
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._health_check_interval = health_check_interval
+        self._ping_timeout = ping_timeout
+        # idle connections by uri, the most recently released at the right
+        self._idle: Dict[str, Deque[Tuple[Client, float]]] = {}
+        self._in_use: Dict[Client, str] = {}
+        # limits the connections in use, idle connections are closed to make room when needed
+        self._semaphores: Dict[Tuple[str, int], BoundedSemaphore] = {}
+        self._closed = False
+        self._maintainer: Greenlet = spawn(self._maintain)
+
+    @staticmethod
+    def _close_client(client: Client) -> None:
+        try:
+            client.close()
+        except (OSError, ConnectionRejectedError):  # the connection is already lost
+            pass
+
+    @staticmethod
+    def _get_host(uri: str) -> Tuple[str, int]:
+        parts = urlsplit(uri)
+        return parts.hostname, parts.port or 80
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(connections) for connections in self._idle.values())
+
+    @property
+    def in_use_count(self) -> int:
+        return len(self._in_use)
+
+    def acquire(self, uri: str, timeout: float = None) -> Client:
+        """
+        Returns an open connection to uri, reusing an idle one if possible. Raises a TimeoutError if max_per_host
+        connections to the host are in use and none is released before the timeout.
+        """
+        if self._closed:
+            raise RuntimeError('the pool is closed')
+
+        host = self._get_host(uri)
+        semaphore = self._semaphores.setdefault(host, BoundedSemaphore(self._max_per_host))
+        if not semaphore.acquire(timeout=timeout):
+            raise TimeoutError(f'no connection to {host[0]}:{host[1]} was available within {timeout} seconds')
+
+        try:
+            client = self._pop_idle(uri)
+            if client is None:
+                self._make_room(host)
+                client = self._client_factory(uri)
+        except BaseException:
+            semaphore.release()
+            raise
+        self._in_use[client] = uri
+        return client
+
+    def release(self, client: Client) -> None:
+        """Gives back a connection obtained with acquire, it is closed if it is not usable anymore."""
+        uri = self._in_use.pop(client)
+        self._semaphores[self._get_host(uri)].release()
+        if self._closed or not client.connected:
+            self._close_client(client)
+            return
+        self._idle.setdefault(uri, deque()).append((client, time.monotonic()))
+
+    @contextmanager
+    def connection(self, uri: str, timeout: float = None) -> Iterator[Client]:
+        client = self.acquire(uri, timeout)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def _pop_idle(self, uri: str) -> Optional[Client]:
+        connections = self._idle.get(uri)
+        while connections:
+            client, _ = connections.pop()
+            if client.connected:
+                return client
+            self._close_client(client)
+        return None
+
+    def _make_room(self, host: Tuple[str, int]) -> None:
+        """Closes the oldest idle connections of a host until a new one can be opened."""
+        while True:
+            idle = [uri for uri, connections in self._idle.items() if connections and self._get_host(uri) == host]
+            count = sum(len(self._idle[uri]) for uri in idle)
+            count += sum(1 for uri in self._in_use.values() if self._get_host(uri) == host)
+            if not idle or count < self._max_per_host:
+                return
+            uri = min(idle, key=lambda item: self._idle[item][0][1])
+            client, _ = self._idle[uri].popleft()
+            self._close_client(client)
+
+    def _remove_idle(self, client: Client) -> bool:
+        for connections in self._idle.values():
+            for item in connections:
+                if item[0] is client:
+                    connections.remove(item)
+                    return True
+        return False
+
+    def _check_idle_connections(self) -> None:
+        now = time.monotonic()
+        to_close = []
+        to_check = []
+        for connections in self._idle.values():
+            for item in list(connections):
+                client, released_at = item
+                if now - released_at >= self._idle_timeout or not client.connected:
+                    connections.remove(item)
+                    to_close.append(client)
+                else:
+                    to_check.append(client)
+        # closing yields to other greenlets, so it is done once the idle connections are not iterated anymore
+        for client in to_close:
+            self._close_client(client)
+
+        checks = [(client, spawn(client.check_alive, self._ping_timeout)) for client in to_check]
+        gevent.joinall([check for _, check in checks])
+        for client, check in checks:
+            # a connection acquired during the check is left to its user
+            if not check.value and self._remove_idle(client):
+                self._close_client(client)
+
+    def _maintain(self) -> None:
+        while not self._closed:
+            gevent.sleep(self._health_check_interval)
+            self._check_idle_connections()
+
+    def close(self) -> None:
+        """Closes the idle connections, the ones in use are closed when released."""
+        self._closed = True
+        self._maintainer.kill()
+        idle = [client for connections in self._idle.values() for client, _ in connections]
+        self._idle.clear()
+        for client in idle:
+            self._close_client(client)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,286 @@
+"""
+Outbound queue of a websocket connection.
+
+Messages are framed by a single writer greenlet, in the order they were queued, so greenlets sending to the same peer
+never interleave the frames of their messages. The queue is bounded in messages and bytes, which bounds the memory spent
+on a slow peer: once a limit is reached, senders either wait or get a SendQueueFull error.
+
+Messages given as iterables are not copied in the queue: when their turn comes, the writer lets the sending greenlet
+stream them itself, so they are still sent in order and the errors raised by the iterable reach the sender.
+"""
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple, Any, Union
+
+from gevent import spawn
+from gevent.event import Event
+from wsproto import WSConnection
+from wsproto.connection import ConnectionState
+from wsproto.events import Event as WSEvent, Message
+from wsproto.utilities import LocalProtocolError
+
+from common.buffer import OutputBuffer
+from .framing import MessageData, encode_frame, iter_fragments, iter_frames
+from .metrics import WebsocketMetrics
+
+# kinds of queued items
+MESSAGE = 'message'
+FRAME = 'frame'
+EVENT = 'event'
+STREAM = 'stream'
+
+# weight of the last message in the average latency
+LATENCY_SMOOTHING = 0.1
+
+
+class SendQueueFull(Exception):
+    """Raised when a message cannot be queued because the send queue is full."""
+
+
+class SendQueue:
+    """
+    :param ws: the wsproto connection framing the messages.
+    :param buffer: the output buffer of the connection, the writer drains it after each frame.
+    :param fragment_size: maximum size of the frames of a message.
+    :param max_bytes: maximum amount of bytes or characters queued. A message bigger than this value can still be sent
+    when the queue is empty. Messages given as iterables are streamed and don't count.
+    :param max_messages: maximum number of queued messages.
+    :param metrics: metrics updated with the messages queued and the frames sent.
+    """
+
+    def __init__(self, ws: WSConnection, buffer: OutputBuffer, fragment_size: int, max_bytes: int = 1024 * 1024,
+                 max_messages: int = 1000, metrics: WebsocketMetrics = None):
+        for name, value in [('max_bytes', max_bytes), ('max_messages', max_messages)]:
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f'{name} must be a strictly positive integer')
+
+        self._ws = ws
+        self._buffer = buffer
+        self._fragment_size = fragment_size
+        self._max_bytes = max_bytes
+        self._max_messages = max_messages
+        self._metrics = metrics
+        self._fast_framing = False
+        self._mask = ws.client
+        # items are (kind, payload, size, time at which they were queued)
+        self._items: Deque[Tuple[str, Any, int, float]] = deque()
+        self._bytes = 0
+        self._not_empty = Event()
+        self._not_full = Event()
+        self._not_full.set()
+        self._empty = Event()
+        self._empty.set()
+        self._closing = False  # a close frame was queued, nothing can be queued after it
+        self._closed = False
+        self._error: Optional[Exception] = None
+        self._latency = 0.0
+        self._max_latency = 0.0
+        self._writer = spawn(self._write_loop)
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be sent, including the one being sent."""
+        return len(self._items)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def latency(self) -> float:
+        """Moving average of the time between the moment a message is queued and the moment it is fully written."""
+        return self._latency
+
+    @property
+    def max_latency(self) -> float:
+        return self._max_latency
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @staticmethod
+    def _get_size(data: Any) -> int:
+        if isinstance(data, memoryview):
+            return data.nbytes
+        if isinstance(data, (str, bytes, bytearray)):
+            return len(data)
+        return 0
+
+    def _is_full(self, size: int) -> bool:
+        if not self._items:
+            return False
+        return len(self._items) >= self._max_messages or self._bytes + size > self._max_bytes
+
+    def _check_open(self) -> None:
+        if self._error is not None:
+            raise self._error
+        if self._closed or self._closing or self._ws.state is not ConnectionState.OPEN:
+            raise ConnectionError('the connection is not open')
+
+    def _put(self, kind: str, payload: Any, block: bool, timeout: Optional[float]) -> None:
+        self._check_open()
+        size = self._get_size(payload)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._is_full(size):
+            if not block:
+                raise SendQueueFull(f'{len(self._items)} messages and {self._bytes} bytes are waiting to be sent')
+            self._not_full.clear()
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self._not_full.wait(remaining):
+                raise SendQueueFull(f'the send queue stayed full for {timeout} seconds')
+            self._check_open()
+
+        self._items.append((kind, payload, size, time.monotonic()))
+        self._bytes += size
+        if self._metrics is not None and kind != STREAM:
+            self._metrics.sent_message_size.observe(size)
+        self._empty.clear()
+        self._not_empty.set()
+
+    def put(self, data: MessageData, block: bool = True, timeout: float = None) -> None:
+        """
+        Queues a message. If the queue is full, waits for room when block is True, or raises SendQueueFull. It also
+        raises SendQueueFull if the timeout expires before the message could be queued. An iterable is sent before
+        this method returns.
+        """
+        if isinstance(data, (str, bytes, bytearray, memoryview)):
+            self._put(MESSAGE, data, block, timeout)
+            return
+
+        turn, done = Event(), Event()
+        self._put(STREAM, (turn, done), block, timeout)
+        turn.wait()
+        try:
+            self._check_open()
+            self._stream(data)
+        finally:
+            done.set()
+
+    def put_frame(self, frame: bytes, block: bool = True, timeout: float = None) -> None:
+        """Queues a message already encoded by websockets.framing.encode_frame."""
+        self._put(FRAME, frame, block, timeout)
+
+    def put_close(self, event: WSEvent) -> None:
+        """Queues a CloseConnection event, it is sent after the messages already queued. It never blocks."""
+        if self._closing:
+            return
+        self._check_open()
+        self._closing = True
+        self._items.append((EVENT, event, 0, time.monotonic()))
+        self._empty.clear()
+        self._not_empty.set()
+
+    def enable_fast_framing(self) -> None:
+        """
+        Frames the messages with websockets.framing instead of wsproto. To call once the handshake is done, if no
+        extension was negotiated.
+        """
+        self._fast_framing = True
+
+    def join(self, timeout: float = None) -> bool:
+        """Waits until everything queued is written to the output buffer. Returns False if the timeout expired."""
+        return self._empty.wait(timeout)
+
+    def close(self) -> None:
+        """Stops the writer greenlet, the messages not sent yet are discarded."""
+        if self._closed:
+            return
+        self._closed = True
+        self._discard()
+        # the writer may be blocked by a peer not reading anymore, nothing it does matters now
+        self._writer.kill()
+
+    def _discard(self) -> None:
+        for kind, payload, _, _ in self._items:
+            if kind == STREAM:
+                payload[0].set()  # the streaming greenlet sees that the queue is closed
+        self._items.clear()
+        self._bytes = 0
+        self._empty.set()
+        self._not_full.set()  # senders waiting for room see that the queue is closed
+
+    def _send_message(self, data: Union[str, bytes, bytearray, memoryview]) -> None:
+        if self._fast_framing:
+            if len(data) <= self._fragment_size:  # the usual case, a message in one frame
+                self._buffer.write(encode_frame(data, self._mask))
+                if self._metrics is not None:
+                    self._metrics.sent_frames.inc()
+                self._buffer.drain()
+                return
+            frames = iter_frames(data, self._fragment_size, self._mask)
+        else:
+            frames = (
+                self._ws.send(Message(fragment, message_finished=finished))
+                for fragment, finished in iter_fragments(data, self._fragment_size)
+            )
+
+        for frame in frames:
+            # the peer may close the connection or a protocol error be sent between two fragments
+            if self._ws.state is not ConnectionState.OPEN:
+                return
+            self._buffer.write(frame)
+            if self._metrics is not None:
+                self._metrics.sent_frames.inc()
+            self._buffer.drain()
+
+    def _stream(self, data: MessageData) -> None:
+        last_fragment = None  # last fragment sent of an unfinished message
+        try:
+            for fragment, finished in iter_fragments(data, self._fragment_size):
+                if self._ws.state is not ConnectionState.OPEN:
+                    return
+                self._buffer.write(self._ws.send(Message(fragment, message_finished=finished)))
+                if self._metrics is not None:
+                    self._metrics.sent_frames.inc()
+                last_fragment = None if finished else fragment
+                self._buffer.drain()
+        except Exception:
+            # ends the message so that the next ones can be sent
+            if last_fragment is not None and self._ws.state is ConnectionState.OPEN:
+                self._buffer.write(self._ws.send(Message(last_fragment[:0], message_finished=True)))
+            raise
+
+    def _send_item(self, kind: str, payload: Any) -> None:
+        if kind == STREAM:  # the streaming greenlet checks the connection state itself
+            turn, done = payload
+            turn.set()
+            done.wait()
+        elif self._ws.state is not ConnectionState.OPEN:
+            return
+        elif kind == EVENT:
+            self._buffer.write(self._ws.send(payload))
+        elif kind == FRAME:
+            self._buffer.write(payload)
+            if self._metrics is not None:
+                self._metrics.sent_frames.inc()
+            self._buffer.drain()
+        else:
+            self._send_message(payload)
+
+    def _write_loop(self) -> None:
+        while True:
+            self._not_empty.wait()
+            if self._closed:
+                break
+            if not self._items:
+                self._not_empty.clear()
+                self._empty.set()
+                continue
+
+            kind, payload, size, queued_at = self._items[0]
+            try:
+                self._send_item(kind, payload)
+            except (OSError, LocalProtocolError) as e:
+                self._error = e if isinstance(e, OSError) else ConnectionError(str(e))
+                self._closed = True
+                self._discard()
+                break
+
+            latency = time.monotonic() - queued_at
+            self._latency += (latency - self._latency) * LATENCY_SMOOTHING
+            self._max_latency = max(self._max_latency, latency)
+            self._items.popleft()
+            self._bytes -= size
+            if not self._is_full(0):
+                self._not_full.set()
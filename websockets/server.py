@@ -1,33 +1,99 @@
 import io
-import json
+import os
 import sys
+import time
 from abc import ABC, abstractmethod
-from typing import Tuple, AnyStr, Any
+from typing import Tuple, Any, List, Optional, Iterator, Dict, Union, Set, FrozenSet, Callable
 
 from gevent import socket
+from gevent.local import local
 from gevent.server import StreamServer
 from wsproto import WSConnection, ConnectionType
 from wsproto.connection import ConnectionState
+from wsproto.frame_protocol import CloseReason
 from wsproto.events import (
-    Request, AcceptConnection, RejectConnection, RejectData, CloseConnection, Message,
+    Event, Request, AcceptConnection, RejectConnection, RejectData, CloseConnection, Message,
     TextMessage, BytesMessage, Ping, Pong
 )
 from wsproto.typing import Headers
 
-
-class BaseServer(ABC):
-    bytes_to_receive: int = 65535
-    buffer_size: int = io.DEFAULT_BUFFER_SIZE
-
-    # noinspection PyTypeChecker
-    def __init__(self, host: str, port: int):
-        self._check_init_arguments(host, port)
-        self._host = host
-        self._port = port
-        self._server: StreamServer = None
+from common.buffer import OutputBuffer
+from common.metrics import PrometheusExporter
+from common.prefork import PreforkServer
+from .codec import Codec, MessageMode, get_codec, decode_message
+from .compression import DeflateExtension
+from .broadcast import Hub, SlowConsumerPolicy
+from .framing import MessageData, check_message_data
+from .heartbeat import Heartbeat, check_timeouts
+from .metrics import WebsocketMetrics
+from .send_queue import SendQueue
+
+
+class Session:
+    """State of a websocket connection accepted by the server"""
+
+    def __init__(self, client: socket, address: Tuple[str, int], buffer_size: int = io.DEFAULT_BUFFER_SIZE,
+                 high_watermark: int = 64 * 1024, low_watermark: int = 16 * 1024,
+                 deflate_options: Dict[str, Any] = None, codec: Codec = None,
+                 message_mode: MessageMode = MessageMode.AUTO, send_queue_bytes: int = 1024 * 1024,
+                 send_queue_messages: int = 1000, metrics: WebsocketMetrics = None,
+                 heartbeat_options: Dict[str, Any] = None):
+        """
+        :param heartbeat_options: keepalive and timeouts of the connection, arguments of websockets.heartbeat.Heartbeat.
+        """
+        self._client = client  # client socket provided by the StreamServer
+        self.connected_at = time.perf_counter()
+        self._buffer = OutputBuffer(client, high_watermark, low_watermark,
+                                    None if metrics is None else metrics.sent_bytes)
+        self._address = address
         self._ws = WSConnection(ConnectionType.SERVER)
-        self._client: socket = None  # client socket provided by the StreamServer
-        self._running = True
+        self._send_queue = SendQueue(self._ws, self._buffer, buffer_size, send_queue_bytes, send_queue_messages,
+                                     metrics)
+        self._deflate_options = deflate_options
+        self._deflate: Optional[DeflateExtension] = None
+        self.codec = codec if codec is not None else get_codec('json')
+        # can be changed in handle_request, for example depending on the negotiated subprotocol
+        self.message_mode = message_mode
+        self.running = True
+        # fragments of the text or binary message being received
+        self.text_message: List[str] = []
+        self.binary_message = bytearray()
+        self.message_size = 0
+        self.heartbeat = Heartbeat(self._send_keepalive_ping, self._close_idle, self.abort, metrics=metrics,
+                                   **(heartbeat_options or {}))
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._address
+
+    @property
+    def state(self) -> ConnectionState:
+        return self._ws.state
+
+    @property
+    def send_queue(self) -> SendQueue:
+        """The queue of outgoing messages, its depth, queued_bytes and latency tell how much a client lags."""
+        return self._send_queue
+
+    @property
+    def compressed(self) -> bool:
+        """Tells if permessage-deflate was negotiated with the client."""
+        return self._deflate is not None and self._deflate.enabled()
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """Round trip time of the last keepalive ping answered, None before the first one."""
+        return self.heartbeat.rtt
+
+    def _send_keepalive_ping(self, payload: bytes) -> None:
+        if self._ws.state is ConnectionState.OPEN:
+            self._buffer.write(self._ws.send(Ping(payload)))
+
+    def _close_idle(self, code: int, reason: str) -> None:
+        try:
+            self._send_queue.put_close(CloseConnection(code, reason))
+        except ConnectionError:  # already closing
+            pass
 
     @staticmethod
     def _check_ws_headers(headers: Headers) -> None:
@@ -45,9 +111,11 @@ class BaseServer(ABC):
         except ValueError:  # in case it is not a list of tuples
             raise TypeError(error_message)
 
-    @abstractmethod
-    def handle_request(self, request: Request) -> None:
-        pass
+    def receive_data(self, data: Optional[bytes]) -> None:
+        self._ws.receive_data(data)
+
+    def events(self) -> Iterator[Event]:
+        return self._ws.events()
 
     def accept_request(self, extra_headers: Headers = None, sub_protocol: str = None) -> None:
         self._check_ws_headers(extra_headers)
@@ -55,7 +123,16 @@ class BaseServer(ABC):
             raise TypeError('sub_protocol must be a string')
 
         extra_headers = extra_headers if extra_headers else []
-        self._client.sendall(self._ws.send(AcceptConnection(extra_headers=extra_headers, subprotocol=sub_protocol)))
+        extensions = []
+        if self._deflate_options is not None:
+            # the extension keeps the compression state of the connection, so each session needs its own
+            self._deflate = DeflateExtension(**self._deflate_options)
+            extensions.append(self._deflate)
+        self._buffer.write(self._ws.send(
+            AcceptConnection(extra_headers=extra_headers, subprotocol=sub_protocol, extensions=extensions)
+        ))
+        if not self.compressed:
+            self._send_queue.enable_fast_framing()
 
     def reject_request(self, status_code: int = 400, reason: str = None) -> None:
         if not isinstance(status_code, int):
@@ -64,26 +141,187 @@ class BaseServer(ABC):
             raise TypeError('reason must be a string')
 
         if not reason:
-            self._client.sendall(self._ws.send(RejectConnection(status_code=status_code)))
+            self._buffer.write(self._ws.send(RejectConnection(status_code=status_code)))
         else:
-            data = bytearray(self._ws.send(RejectConnection(has_body=True, headers=[(b'Content-type', b'text/txt')])))
-            data.extend(self._ws.send(RejectData(reason.encode())))
-            self._client.sendall(bytes(data))
+            self._buffer.write(self._ws.send(RejectConnection(has_body=True, headers=[(b'Content-type', b'text/txt')])))
+            self._buffer.write(self._ws.send(RejectData(reason.encode())))
 
     def close_request(self, code: int = 1000, reason: str = None) -> None:
+        """Closes the connection once the messages already queued are sent."""
         if not isinstance(code, int):
             raise TypeError('code must be an integer')
         if not isinstance(reason, str):
             raise TypeError('reason must be a string')
 
-        self._client.sendall(self._ws.send(CloseConnection(code, reason)))
+        self._send_queue.put_close(CloseConnection(code, reason))
+        self.heartbeat.closing()
 
-    def _handle_close_event(self, event: CloseConnection) -> None:
+    def close_now(self, code: int, reason: str) -> None:
+        """Closes the connection without waiting for the queued messages, which are then discarded."""
+        self._buffer.write(self._ws.send(CloseConnection(code, reason)))
+        self.heartbeat.closing()
+
+    def handle_close_event(self, event: CloseConnection) -> None:
         if self._ws.state is ConnectionState.REMOTE_CLOSING:
-            self._client.sendall(self._ws.send(event.response()))
+            self._buffer.write(self._ws.send(event.response()))
+        self.running = False
+
+    def handle_ping(self, event: Ping) -> None:
+        self._buffer.write(self._ws.send(event.response()))
+
+    def send_frame(self, frame: bytes) -> bool:
+        """
+        Queues a message already encoded by websockets.framing.encode_frame, waiting for room in the send queue if
+        needed. Returns False if the connection is not open anymore.
+        """
+        if self._ws.state is not ConnectionState.OPEN:
+            return False
+        self._send_queue.put_frame(frame)
+        return True
 
-    def _handle_ping(self, event: Ping) -> None:
-        self._client.sendall(self._ws.send(event.response()))
+    def ping(self, data: bytes = b'hello') -> None:
+        if not isinstance(data, bytes):
+            raise TypeError('data must be bytes')
+
+        self._buffer.write(self._ws.send(Ping(data)))
+        self._buffer.drain()
+
+    def send(self, data: MessageData, block: bool = True, timeout: float = None) -> None:
+        """
+        Queues a message. data can also be an iterable or a generator of strings or bytes, it is then consumed lazily
+        and sent as a single fragmented message. When the send queue is full, waits for room if block is True,
+        otherwise or if the timeout expires, raises websockets.send_queue.SendQueueFull.
+        """
+        check_message_data(data)
+
+        self._send_queue.put(data, block, timeout)
+
+    def send_json(self, data: Any, block: bool = True, timeout: float = None) -> None:
+        self.send(self.codec.dumps(data), block, timeout)
+
+    def abort(self) -> None:
+        """
+        Shuts the connection down without waiting for anything, the greenlet handling it then closes the session.
+        """
+        self.running = False
+        try:
+            self._client.shutdown(socket.SHUT_RDWR)
+        except OSError:  # already closed
+            pass
+
+    def close(self) -> None:
+        self.running = False
+        self.heartbeat.stop()
+        self._send_queue.close()
+        self._buffer.close()
+        self._client.close()
+
+
+class BaseServer(ABC):
+    """
+    Abstract websocket server. Each accepted connection gets its own Session, and the methods acting on a connection
+    (accept_request, send, ping, ...) apply to the session of the greenlet handling it, so they can be called
+    as is in the abstract handlers.
+    """
+    bytes_to_receive: int = 65535
+    buffer_size: int = io.DEFAULT_BUFFER_SIZE
+    # bounds of the output buffer of each connection, see Client
+    high_watermark: int = 64 * 1024
+    low_watermark: int = 16 * 1024
+    # maximum size of a received message, in characters for text messages, None means no limit
+    max_message_size: Optional[int] = None
+    # arguments of DeflateExtension, permessage-deflate is accepted when clients offer it if it is not None
+    deflate_options: Optional[Dict[str, Any]] = None
+    # codec used by send_json and receive_json, 'json', 'orjson' or a Codec instance
+    codec: Union[str, Codec] = 'json'
+    # how text messages are routed to receive_text and receive_json, see MessageMode
+    message_mode: MessageMode = MessageMode.AUTO
+    # message mode of the connections accepted with a given subprotocol, e.g. {'chat': MessageMode.TEXT}
+    sub_protocol_modes: Dict[str, MessageMode] = {}
+    # number of broadcast messages waiting to be sent to a client, and what to do with a client too slow to keep up
+    broadcast_queue_size: int = 100
+    slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP
+    # limits of the send queue of each connection, see websockets.send_queue.SendQueue
+    send_queue_bytes: int = 1024 * 1024
+    send_queue_messages: int = 1000
+    # keepalive and timeouts of the connections in seconds, None disables them, see websockets.heartbeat
+    ping_interval: Optional[float] = 20.0
+    ping_timeout: Optional[float] = 20.0
+    idle_timeout: Optional[float] = None
+    handshake_timeout: Optional[float] = 10.0
+    close_timeout: Optional[float] = 10.0
+    # metrics of all the connections of the process, nothing is measured when it is None
+    metrics: Optional[WebsocketMetrics] = None
+
+    # noinspection PyTypeChecker
+    def __init__(self, host: str, port: int):
+        self._check_init_arguments(host, port)
+        if self.deflate_options is not None:
+            DeflateExtension(**self.deflate_options)  # checks the options before serving anyone
+        self._codec = get_codec(self.codec)
+        self._check_message_modes()
+        for name in ('send_queue_bytes', 'send_queue_messages'):
+            value = getattr(self, name)
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f'{name} must be a strictly positive integer')
+        check_timeouts(ping_interval=self.ping_interval, ping_timeout=self.ping_timeout,
+                       idle_timeout=self.idle_timeout, handshake_timeout=self.handshake_timeout,
+                       close_timeout=self.close_timeout)
+        self._heartbeat_options = {
+            'ping_interval': self.ping_interval, 'ping_timeout': self.ping_timeout, 'idle_timeout': self.idle_timeout,
+            'close_timeout': self.close_timeout
+        }
+        self._host = host
+        self._port = port
+        self._server: StreamServer = None
+        self._prefork: Optional[PreforkServer] = None
+        self._exporter: Optional[PrometheusExporter] = None
+        self._local = local()  # holds the session of each connection greenlet
+        self._sessions: Set[Session] = set()
+        self.hub = Hub(self.broadcast_queue_size, self.slow_consumer_policy)
+        # handlers of the wsproto events by exact type, a dict lookup is cheaper than a chain of isinstance calls
+        self._event_handlers: Dict[type, Callable[[Session, Event], None]] = {
+            TextMessage: self._handle_text_event,
+            BytesMessage: self._handle_bytes_event,
+            Ping: Session.handle_ping,
+            Pong: self._handle_pong_event,
+            CloseConnection: Session.handle_close_event,
+            Request: self._handle_request_event,
+        }
+
+    @property
+    def session(self) -> Session:
+        """The session of the connection handled by the current greenlet."""
+        try:
+            return self._local.session
+        except AttributeError:
+            raise RuntimeError('no websocket session is bound to the current greenlet') from None
+
+    @property
+    def sessions(self) -> FrozenSet[Session]:
+        """The sessions of all the connections currently handled by the server."""
+        return frozenset(self._sessions)
+
+    @abstractmethod
+    def handle_request(self, request: Request) -> None:
+        pass
+
+    def _check_message_modes(self) -> None:
+        modes = [self.message_mode, *self.sub_protocol_modes.values()]
+        if not all(isinstance(mode, MessageMode) for mode in modes):
+            raise TypeError('message modes must be MessageMode members')
+
+    def accept_request(self, extra_headers: Headers = None, sub_protocol: str = None) -> None:
+        session = self.session
+        session.accept_request(extra_headers, sub_protocol)
+        if sub_protocol in self.sub_protocol_modes:
+            session.message_mode = self.sub_protocol_modes[sub_protocol]
+
+    def reject_request(self, status_code: int = 400, reason: str = None) -> None:
+        self.session.reject_request(status_code, reason)
+
+    def close_request(self, code: int = 1000, reason: str = None) -> None:
+        self.session.close_request(code, reason)
 
     @abstractmethod
     def receive_text(self, data: str) -> None:
@@ -101,36 +339,70 @@ class BaseServer(ABC):
     def handle_pong(self, data: bytes) -> None:
         pass
 
-    def _send_data(self, data: AnyStr) -> None:
-        if isinstance(data, str):
-            io_object = io.StringIO(data)
-        else:
-            io_object = io.BytesIO(data)
-
-        with io_object as f:
-            chunk = f.read(self.buffer_size)
-            while chunk:
-                if len(chunk) < self.buffer_size:
-                    self._client.sendall(self._ws.send(Message(data, message_finished=True)))
-                    break
-                else:
-                    self._client.sendall(self._ws.send(Message(data, message_finished=False)))
-                chunk = f.read(self.buffer_size)
+    def receive_text_chunk(self, data: str, message_finished: bool) -> None:
+        """
+        Called for each fragment of a text message as soon as it arrives. The default implementation gathers the
+        fragments and calls receive_json or receive_text with the whole message, depending on the message mode of the
+        session. Override it to process big messages without keeping them in memory.
+        """
+        session = self.session
+        session.text_message.append(data)
+        if message_finished:
+            str_data = ''.join(session.text_message)
+            session.text_message.clear()
+            try:
+                is_json, value = decode_message(session.codec, session.message_mode, str_data)
+            except ValueError:
+                session.close_now(CloseReason.INVALID_FRAME_PAYLOAD_DATA, 'invalid json')
+                return
+            if is_json:
+                self.receive_json(value)
+            else:
+                self.receive_text(value)
+
+    def receive_bytes_chunk(self, data: bytes, message_finished: bool) -> None:
+        """
+        Called for each fragment of a binary message as soon as it arrives. The default implementation gathers the
+        fragments and calls receive_bytes with the whole message. Override it to process big messages without keeping
+        them in memory.
+        """
+        session = self.session
+        session.binary_message.extend(data)
+        if message_finished:
+            data = bytes(session.binary_message)
+            session.binary_message.clear()
+            self.receive_bytes(data)
 
     def ping(self, data: bytes = b'hello') -> None:
-        if not isinstance(data, bytes):
-            raise TypeError('data must be bytes')
+        self.session.ping(data)
+
+    def send(self, data: MessageData, block: bool = True, timeout: float = None) -> None:
+        self.session.send(data, block, timeout)
 
-        self._client.sendall(self._ws.send(Ping(data)))
+    def send_json(self, data: Any, block: bool = True, timeout: float = None) -> None:
+        self.session.send_json(data, block, timeout)
 
-    def send(self, data: AnyStr) -> None:
-        if not isinstance(data, (bytes, str)):
-            raise TypeError('data must be either a string or binary data')
+    def subscribe(self, topic: str) -> None:
+        """Subscribes the current session to a topic."""
+        self.hub.subscribe(self.session, topic)
 
-        self._send_data(data)
+    def unsubscribe(self, topic: str = None) -> None:
+        """Unsubscribes the current session from a topic, or from all its topics if topic is None."""
+        self.hub.unsubscribe(self.session, topic)
 
-    def send_json(self, data: Any) -> None:
-        self.send(json.dumps(data))
+    def publish(self, topic: str, data: Union[str, bytes]) -> int:
+        """
+        Sends a message to all the subscribers of a topic, it can be called from any greenlet. The message is framed
+        once and the same bytes are queued for every subscriber. Returns the number of subscribers reached.
+        """
+        return self.hub.publish(topic, data)
+
+    def publish_json(self, topic: str, data: Any) -> int:
+        return self.hub.publish(topic, self._codec.dumps(data))
+
+    def broadcast(self, data: Union[str, bytes]) -> int:
+        """Sends a message to all the connected clients, returns the number of clients reached."""
+        return self.hub.send_to(self._sessions, data)
 
     @staticmethod
     def _check_init_arguments(host: str, port: int) -> None:
@@ -142,54 +414,139 @@ class BaseServer(ABC):
         if port < 0:
             raise TypeError(error_message)
 
+    def _check_message_size(self, session: Session, event: Message) -> bool:
+        """
+        Returns False and closes the connection if the message being received is bigger than max_message_size.
+        """
+        if session.state is not ConnectionState.OPEN:  # we are closing, probably because of a previous fragment
+            return False
+
+        message_size = session.message_size + len(event.data)
+        session.message_size = 0 if event.message_finished else message_size
+        if self.max_message_size is not None and message_size > self.max_message_size:
+            session.text_message.clear()
+            session.binary_message.clear()
+            session.close_now(CloseReason.MESSAGE_TOO_BIG, 'message too big')
+            return False
+        if event.message_finished and self.metrics is not None:
+            self.metrics.received_message_size.observe(message_size)
+        return True
+
+    def _handle_request_event(self, session: Session, event: Request) -> None:
+        self.handle_request(event)
+        if session.state is ConnectionState.OPEN:
+            session.heartbeat.handshake_done()
+        else:  # rejected, the client has close_timeout seconds to leave
+            session.heartbeat.closing()
+        if self.metrics is not None:
+            self.metrics.handshake_duration.observe(time.perf_counter() - session.connected_at)
+
+    def _handle_pong_event(self, session: Session, event: Pong) -> None:
+        if not session.heartbeat.handle_pong(event.payload):
+            self.handle_pong(event.payload)
+
+    def _handle_text_event(self, session: Session, event: TextMessage) -> None:
+        session.heartbeat.message_received = True
+        if self._check_message_size(session, event):
+            self.receive_text_chunk(event.data, event.message_finished)
+
+    def _handle_bytes_event(self, session: Session, event: BytesMessage) -> None:
+        session.heartbeat.message_received = True
+        if self._check_message_size(session, event):
+            self.receive_bytes_chunk(event.data, event.message_finished)
+
     def _handler(self, client: socket, address: Tuple[str, int]) -> None:
-        self._client = client
-        text_message = []
-        binary_message = bytearray()
-
-        while self._running:
-            data = client.recv(self.bytes_to_receive)
-            self._ws.receive_data(data)
-
-            for event in self._ws.events():
-                if isinstance(event, Request):
-                    self.handle_request(event)
-
-                elif isinstance(event, CloseConnection):
-                    self._handle_close_event(event)
-                    self._running = False
-
-                elif isinstance(event, Ping):
-                    self._handle_ping(event)
-
-                elif isinstance(event, Pong):
-                    self.handle_pong(event.payload)
-
-                elif isinstance(event, TextMessage):
-                    text_message.append(event.data)
-                    if event.message_finished:
-                        str_data = ''.join(text_message)
-                        try:
-                            self.receive_json(json.loads(str_data))
-                        except json.JSONDecodeError:
-                            self.receive_text(str_data)
-                        text_message.clear()
-
-                elif isinstance(event, BytesMessage):
-                    binary_message.extend(event.data)
-                    if event.message_finished:
-                        self.receive_bytes(bytes(binary_message))
-                        binary_message.clear()
+        metrics = self.metrics
+        event_handlers = self._event_handlers
+        if metrics is not None:
+            metrics.connections.inc()
+            metrics.open_connections.inc()
+        session = Session(client, address, self.buffer_size, self.high_watermark, self.low_watermark,
+                          self.deflate_options, self._codec, self.message_mode, self.send_queue_bytes,
+                          self.send_queue_messages, metrics, self._heartbeat_options)
+        self._local.session = session
+        self._sessions.add(session)
+        heartbeat = session.heartbeat
+        heartbeat.start(self.handshake_timeout)
+
+        try:
+            while session.running:
+                data = client.recv(self.bytes_to_receive)
+                if not data:
+                    data = None  # wsproto expects None when the peer closed the connection
                 else:
-                    print('unknown event:', event)
+                    heartbeat.received = True
+                    if metrics is not None:
+                        metrics.received_bytes.inc(len(data))
+                session.receive_data(data)
+
+                for event in session.events():
+                    if metrics is not None:
+                        metrics.received_frames.inc()
+                        started_at = time.perf_counter()
+
+                    handler = event_handlers.get(type(event))
+                    if handler is not None:
+                        handler(session, event)
+                    elif metrics is not None:
+                        metrics.unknown_events.inc()
+
+                    if metrics is not None:
+                        # noinspection PyUnboundLocalVariable
+                        metrics.handler_duration.observe(time.perf_counter() - started_at)
+
+                if data is None:
+                    break
+        except OSError:  # the connection was reset by the peer
+            pass
+        finally:
+            self._sessions.discard(session)
+            self.hub.unsubscribe(session)
+            session.close()
+            if metrics is not None:
+                metrics.open_connections.dec()
+
+    def _start_metrics_exporter(self, host: str, port: int, workers: Optional[int]) -> None:
+        self._exporter = PrometheusExporter(self.metrics.registry, host, port, port_range=workers or 1)
+        self._exporter.start()
+
+    def run(self, backlog: int = 256, spawn: str = 'default', workers: int = 1, reuse_port: bool = False,
+            metrics_port: int = None, metrics_host: str = '127.0.0.1', **kwargs) -> None:
+        """
+        Serves clients until close is called. With workers > 1 (or None for the number of CPUs), the server runs in
+        that many processes forked from this one, see common.prefork.PreforkServer. Each worker has its own sessions
+        and hub, so broadcasts only reach the clients connected to the same worker.
+
+        With metrics_port, the metrics of the server are served in the Prometheus format on
+        http://metrics_host:metrics_port/metrics. Workers have their own metrics, served on the ports following
+        metrics_port. The metrics attribute must be set.
+        """
+        if metrics_port is not None and self.metrics is None:
+            raise ValueError('metrics must be set to serve them')
+        if workers == 1:
+            self._server = StreamServer((self._host, self._port), self._handler, backlog=backlog, spawn=spawn,
+                                        **kwargs)
+            if metrics_port is not None:
+                self._start_metrics_exporter(metrics_host, metrics_port, workers)
+            self._server.serve_forever()
+            return
+
+        def create_server(listener: socket.socket) -> StreamServer:
+            self._server = StreamServer(listener, self._handler, spawn=spawn, **kwargs)
+            if metrics_port is not None:
+                self._start_metrics_exporter(metrics_host, metrics_port, workers or os.cpu_count())
+            return self._server
 
-    def run(self, backlog: int = 256, spawn: str = 'default', **kwargs) -> None:
-        self._server = StreamServer((self._host, self._port), self._handler, backlog=backlog, spawn=spawn, **kwargs)
-        self._server.serve_forever()
+        self._prefork = PreforkServer((self._host, self._port), create_server, workers, backlog, reuse_port)
+        self._prefork.serve_forever()
 
     def close(self) -> None:
+        if self._prefork is not None:
+            self._prefork.stop()
         if self._server is not None:
             self._server.close()
+        if self._exporter is not None:
+            self._exporter.stop()
 
 
 if __name__ == '__main__':